@@ -17,16 +17,29 @@ Hosted Agent を Azure AI Foundry に登録するスクリプト
         --subscription-id <sub-id> \
         --resource-group <rg-name>
 
+    # 宣言的に適用（定義・Application・Deployment のうち変更があった手順だけ実行）:
+    python scripts/register_hosted_agent.py apply \
+        --endpoint "https://<account>.services.ai.azure.com/api/projects/<project>" \
+        --image "acrname.azurecr.io/hosted-agent:v2" \
+        --name "demo-hosted-agent" \
+        --subscription-id <sub-id> \
+        --resource-group <rg-name>
+
 前提条件:
     - pip install azure-ai-projects>=2.0.0b3 azure-identity requests
     - az login でログイン済み
 """
 
 import argparse
+import hashlib
+import json
+import os
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import AzureCliCredential
 from azure.ai.projects import AIProjectClient
 from azure.ai.projects.models import (
@@ -36,6 +49,94 @@ from azure.ai.projects.models import (
 )
 
 
+ARM_API_VERSION = "2025-10-01-preview"
+
+# エージェントバージョンのメタデータに記録する定義のハッシュのキー
+DEFINITION_HASH_KEY = "definition_sha256"
+
+# apply が前回適用した状態を保存するファイル
+DEFAULT_STATE_FILE = ".hosted-agent-state.json"
+
+
+def project_arm_url(subscription_id: str, resource_group: str, account_name: str, project_name: str) -> str:
+    """プロジェクトの ARM リソース URL"""
+    return f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{account_name}/projects/{project_name}"
+
+
+def arm_headers(credential: AzureCliCredential) -> dict:
+    """ARM 用トークン付きのヘッダー"""
+    token = credential.get_token("https://management.azure.com/.default").token
+    return {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+
+def application_payload(app_name: str, agent_name: str) -> dict:
+    """Agent Application の PUT 本文"""
+    return {
+        "properties": {
+            "displayName": app_name,
+            "agents": [{"agentName": agent_name}],
+        }
+    }
+
+
+def deployment_payload(
+    deployment_name: str,
+    agent_name: str,
+    agent_version: str,
+    deployment_type: str = "Hosted",
+    min_replicas: int = 1,
+    max_replicas: int = 1,
+) -> dict:
+    """Deployment の PUT 本文"""
+    payload = {
+        "properties": {
+            "displayName": deployment_name,
+            "deploymentType": deployment_type,
+            "protocols": [
+                {"protocol": "responses", "version": "1.0"}
+            ],
+            "agents": [
+                {"agentName": agent_name, "agentVersion": agent_version}
+            ],
+        }
+    }
+    
+    # Hostedの場合はreplica設定を追加
+    if deployment_type == "Hosted":
+        payload["properties"]["minReplicas"] = min_replicas
+        payload["properties"]["maxReplicas"] = max_replicas
+    return payload
+
+
+def put_resource(url: str, headers: dict, payload: dict, label: str) -> bool:
+    """ARM リソースを作成/更新"""
+    resp = requests.put(url, headers=headers, json=payload)
+    if resp.status_code not in [200, 201, 202]:
+        print(f"✗ Failed to create {label}: {resp.status_code}")
+        print(f"  Response: {resp.text}")
+        return False
+    print(f"  ✓ {label} created/updated")
+    return True
+
+
+def wait_for_deployment(deploy_url: str, headers: dict, attempts: int = 6) -> None:
+    """デプロイメントが Running になるまで待機（5 秒間隔で最大 attempts 回）"""
+    print("Waiting for deployment to start...")
+    for _ in range(attempts):
+        time.sleep(5)
+        resp = requests.get(deploy_url, headers=headers)
+        if resp.status_code == 200:
+            data = resp.json()
+            state = data.get("properties", {}).get("state", "Unknown")
+            prov_state = data.get("properties", {}).get("provisioningState", "Unknown")
+            print(f"  State: {state}, ProvisioningState: {prov_state}")
+            if state == "Running":
+                break
+
+
 def publish_agent(
     credential: AzureCliCredential,
     subscription_id: str,
@@ -46,6 +147,8 @@ def publish_agent(
     agent_version: str,
     app_name: str | None = None,
     deployment_type: str = "Hosted",
+    min_replicas: int = 1,
+    max_replicas: int = 1,
 ) -> bool:
     """
     エージェントをPublish（Agent ApplicationとDeploymentを作成）
@@ -60,89 +163,70 @@ def publish_agent(
         agent_version: エージェントバージョン
         app_name: アプリケーション名（省略時はエージェント名を使用）
         deployment_type: "Hosted" または "Managed"
+        min_replicas: 最小レプリカ数（Hosted のみ、size_hosted_agent.py で見積もり可能）
+        max_replicas: 最大レプリカ数（Hosted のみ）
     """
     if app_name is None:
         app_name = f"{agent_name}-app"
     
     deployment_name = f"{agent_name}-deployment"
-    api_version = "2025-10-01-preview"
-    
-    # ARM用トークンを取得
-    token = credential.get_token("https://management.azure.com/.default").token
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    
-    base_url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{account_name}/projects/{project_name}"
+    headers = arm_headers(credential)
+    base_url = project_arm_url(subscription_id, resource_group, account_name, project_name)
     
     # 1. Agent Applicationを作成
     print(f"Creating Agent Application: {app_name}")
-    app_url = f"{base_url}/applications/{app_name}?api-version={api_version}"
-    app_payload = {
-        "properties": {
-            "displayName": app_name,
-            "agents": [{"agentName": agent_name}],
-        }
-    }
-    
-    resp = requests.put(app_url, headers=headers, json=app_payload)
-    if resp.status_code not in [200, 201, 202]:
-        print(f"✗ Failed to create Agent Application: {resp.status_code}")
-        print(f"  Response: {resp.text}")
+    app_url = f"{base_url}/applications/{app_name}?api-version={ARM_API_VERSION}"
+    if not put_resource(app_url, headers, application_payload(app_name, agent_name), "Agent Application"):
         return False
-    print(f"  ✓ Agent Application created/updated")
     
     # 2. Deploymentを作成
     print(f"Creating Deployment: {deployment_name}")
-    deploy_url = f"{base_url}/applications/{app_name}/agentdeployments/{deployment_name}?api-version={api_version}"
-    
-    deploy_payload = {
-        "properties": {
-            "displayName": deployment_name,
-            "deploymentType": deployment_type,
-            "protocols": [
-                {"protocol": "responses", "version": "1.0"}
-            ],
-            "agents": [
-                {"agentName": agent_name, "agentVersion": agent_version}
-            ],
-        }
-    }
-    
-    # Hostedの場合はreplica設定を追加
-    if deployment_type == "Hosted":
-        deploy_payload["properties"]["minReplicas"] = 1
-        deploy_payload["properties"]["maxReplicas"] = 1
-    
-    resp = requests.put(deploy_url, headers=headers, json=deploy_payload)
-    if resp.status_code not in [200, 201, 202]:
-        print(f"✗ Failed to create Deployment: {resp.status_code}")
-        print(f"  Response: {resp.text}")
+    deploy_url = f"{base_url}/applications/{app_name}/agentdeployments/{deployment_name}?api-version={ARM_API_VERSION}"
+    deploy_payload = deployment_payload(
+        deployment_name, agent_name, agent_version, deployment_type, min_replicas, max_replicas
+    )
+    if not put_resource(deploy_url, headers, deploy_payload, "Deployment"):
         return False
-    print(f"  ✓ Deployment created/updated")
     
     # 3. デプロイメント状態を確認（オプション）
-    print("Waiting for deployment to start...")
-    for _ in range(6):  # 最大30秒待機
-        time.sleep(5)
-        resp = requests.get(deploy_url, headers=headers)
-        if resp.status_code == 200:
-            data = resp.json()
-            state = data.get("properties", {}).get("state", "Unknown")
-            prov_state = data.get("properties", {}).get("provisioningState", "Unknown")
-            print(f"  State: {state}, ProvisioningState: {prov_state}")
-            if state == "Running":
-                break
+    wait_for_deployment(deploy_url, headers)
     
     print()
     print(f"✓ Agent published successfully!")
     print(f"  Application: {app_name}")
     print(f"  Deployment: {deployment_name}")
+    if deployment_type == "Hosted":
+        print(f"  Replicas: {min_replicas}-{max_replicas}")
     print(f"  Endpoint: https://{account_name}.services.ai.azure.com/api/projects/{project_name}/applications/{app_name}/protocols/openai")
     return True
 
 
+def build_environment(openai_endpoint: str, model_name: str, app_insights_conn_str: str | None = None) -> dict:
+    """コンテナの環境変数を構築"""
+    # Note: Azure AI Foundry では AZURE_AI_PROJECT_ENDPOINT が推奨
+    env_vars = {
+        "AZURE_AI_PROJECT_ENDPOINT": openai_endpoint,  # Program.cs で使用
+        "AZURE_OPENAI_ENDPOINT": openai_endpoint,
+        "AZURE_OPENAI_DEPLOYMENT_NAME": model_name,
+    }
+    if app_insights_conn_str:
+        env_vars["APPLICATIONINSIGHTS_CONNECTION_STRING"] = app_insights_conn_str
+    return env_vars
+
+
+def build_definition(image: str, cpu: str, memory: str, env_vars: dict) -> ImageBasedHostedAgentDefinition:
+    """Hosted Agent の定義"""
+    return ImageBasedHostedAgentDefinition(
+        container_protocol_versions=[
+            ProtocolVersionRecord(protocol=AgentProtocol.RESPONSES, version="v1")
+        ],
+        cpu=cpu,
+        memory=memory,
+        image=image,
+        environment_variables=env_vars,
+    )
+
+
 def create_hosted_agent(
     endpoint: str,
     image: str,
@@ -153,8 +237,10 @@ def create_hosted_agent(
     publish: bool = False,
     subscription_id: str | None = None,
     resource_group: str | None = None,
-) -> None:
-    """Hosted Agent を作成/更新"""
+    min_replicas: int = 1,
+    max_replicas: int = 1,
+):
+    """Hosted Agent を作成/更新（作成したエージェントのバージョンを返す）"""
     print(f"Creating hosted agent: {name}")
     print(f"  Endpoint: {endpoint}")
     print(f"  Image: {image}")
@@ -182,14 +268,7 @@ def create_hosted_agent(
     print(f"  ⚠ Application Insights lookup skipped (can be configured later)")
 
     # 環境変数を構築
-    # Note: Azure AI Foundry では AZURE_AI_PROJECT_ENDPOINT が推奨
-    env_vars = {
-        "AZURE_AI_PROJECT_ENDPOINT": openai_endpoint,  # Program.cs で使用
-        "AZURE_OPENAI_ENDPOINT": openai_endpoint,
-        "AZURE_OPENAI_DEPLOYMENT_NAME": model_name,
-    }
-    if app_insights_conn_str:
-        env_vars["APPLICATIONINSIGHTS_CONNECTION_STRING"] = app_insights_conn_str
+    env_vars = build_environment(openai_endpoint, model_name, app_insights_conn_str)
     
     print(f"  Environment variables:")
     print(f"    AZURE_AI_PROJECT_ENDPOINT: {openai_endpoint}")
@@ -198,15 +277,9 @@ def create_hosted_agent(
     try:
         agent = client.agents.create_version(
             agent_name=name,
-            definition=ImageBasedHostedAgentDefinition(
-                container_protocol_versions=[
-                    ProtocolVersionRecord(protocol=AgentProtocol.RESPONSES, version="v1")
-                ],
-                cpu=cpu,
-                memory=memory,
-                image=image,
-                environment_variables=env_vars,
-            ),
+            definition=build_definition(image, cpu, memory, env_vars),
+            # apply が同じ定義のバージョンを再利用できるようにハッシュを記録
+            metadata={DEFINITION_HASH_KEY: definition_hash(image, cpu, memory, env_vars)},
         )
         print(f"✓ Agent created successfully")
         print(f"  Name: {agent.name}")
@@ -238,6 +311,8 @@ def create_hosted_agent(
                 agent_name=agent.name,
                 agent_version=str(agent.version),
                 deployment_type="Hosted",
+                min_replicas=min_replicas,
+                max_replicas=max_replicas,
             )
             if not success:
                 sys.exit(1)
@@ -252,6 +327,244 @@ def create_hosted_agent(
     except Exception as e:
         print(f"✗ Agent creation failed: {e}", file=sys.stderr)
         sys.exit(1)
+    return agent
+
+
+def definition_hash(image: str, cpu: str, memory: str, env_vars: dict) -> str:
+    """定義（イメージ・CPU・メモリ・環境変数・プロトコル）のハッシュ"""
+    spec = {
+        "image": image,
+        "cpu": cpu,
+        "memory": memory,
+        "environment_variables": env_vars,
+        "protocols": [[AgentProtocol.RESPONSES.value, "v1"]],
+    }
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def load_state(path: str) -> dict:
+    """前回 apply した状態（なければ空）"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def find_agent_version(client: AIProjectClient, name: str, digest: str) -> tuple[bool, str | None]:
+    """
+    定義のハッシュが一致する既存バージョンを探す
+
+    Returns:
+        (エージェントが存在するか, 一致したバージョン（なければ None）)
+    """
+    try:
+        versions = list(client.agents.list_versions(agent_name=name))
+    except ResourceNotFoundError:
+        return False, None
+    for version in versions:
+        metadata = getattr(version, "metadata", None) or {}
+        if metadata.get(DEFINITION_HASH_KEY) == digest:
+            return True, str(version.version)
+    return bool(versions), None
+
+
+def get_resource(url: str, headers: dict) -> dict | None:
+    """ARM リソースを取得（存在しなければ None）"""
+    resp = requests.get(url, headers=headers)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+
+def deployment_arm_url(endpoint: str, subscription_id: str, resource_group: str, agent_name: str) -> str | None:
+    """プロジェクトエンドポイントから Publish 先の Deployment の ARM リソース URL（抽出できなければ None）"""
+    match = re.match(r"https://([^.]+)\.services\.ai\.azure\.com", endpoint)
+    project_match = re.search(r"/projects/([^/]+)", endpoint)
+    if not (match and project_match):
+        return None
+    base_url = project_arm_url(subscription_id, resource_group, match.group(1), project_match.group(1))
+    return (
+        f"{base_url}/applications/{agent_name}-app/agentdeployments/{agent_name}-deployment"
+        f"?api-version={ARM_API_VERSION}"
+    )
+
+
+def wait_for_agent_version(
+    deploy_url: str, headers: dict, agent_version: str, timeout: float = 300.0, interval: float = 5.0
+) -> bool:
+    """
+    デプロイメントが agent_version だけを参照して Running になるまで待機
+
+    Publish 直後は旧バージョンのレプリカが応答し続けるため、エンドポイントの応答ではなく
+    ARM の Deployment リソースでロールアウトの完了を確認します。
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            data = get_resource(deploy_url, headers)
+        except requests.RequestException:
+            data = None
+        if data:
+            properties = data.get("properties", {})
+            versions = {str(agent.get("agentVersion")) for agent in properties.get("agents", [])}
+            if properties.get("state") == "Running" and versions == {str(agent_version)}:
+                return True
+        time.sleep(interval)
+    return False
+
+
+def resource_matches(current: dict | None, desired: dict) -> bool:
+    """desired の properties がすべて current と一致するか（サーバー側で付与される項目は無視）"""
+    if current is None:
+        return False
+    properties = current.get("properties", {})
+    return all(properties.get(key) == value for key, value in desired["properties"].items())
+
+
+def apply_hosted_agent(
+    endpoint: str,
+    image: str,
+    name: str = "demo-hosted-agent",
+    cpu: str = "1",
+    memory: str = "2Gi",
+    model_name: str = "gpt-4o-mini",
+    subscription_id: str | None = None,
+    resource_group: str | None = None,
+    min_replicas: int = 1,
+    max_replicas: int = 1,
+    state_file: str = DEFAULT_STATE_FILE,
+    refresh: bool = False,
+    dry_run: bool = False,
+) -> None:
+    """
+    Hosted Agent を宣言的に適用（変更のあった手順だけを実行）
+
+    定義のハッシュをバージョンのメタデータと state_file に記録し、同じ定義のバージョンが
+    既にあれば create_version を省略して再利用します。Application / Deployment は現在の
+    ARM リソースと比較し、差分がある場合だけ PUT します。互いに依存しない手順
+    （既存エージェントの新バージョン作成と Application の更新、現在の状態の取得）は並列に実行します。
+    subscription_id / resource_group を省略した場合はバージョンの作成だけを行います。
+    """
+    match = re.match(r"https://([^.]+)\.services\.ai\.azure\.com", endpoint)
+    account_name = match.group(1) if match else None
+    openai_endpoint = f"https://{account_name}.cognitiveservices.azure.com/" if account_name else endpoint
+    project_match = re.search(r"/projects/([^/]+)", endpoint)
+    project_name = project_match.group(1) if project_match else None
+
+    publish = bool(subscription_id and resource_group)
+    if publish and not (account_name and project_name):
+        print("✗ Could not extract account/project name from endpoint", file=sys.stderr)
+        sys.exit(1)
+
+    env_vars = build_environment(openai_endpoint, model_name)
+    digest = definition_hash(image, cpu, memory, env_vars)
+    state = load_state(state_file)
+    state_key = f"{endpoint.rstrip('/')}#{name}"
+    cached = state.get(state_key, {})
+
+    credential = AzureCliCredential()
+    client = AIProjectClient(endpoint=endpoint, credential=credential)
+
+    app_name = f"{name}-app"
+    deployment_name = f"{name}-deployment"
+    headers = app_url = deploy_url = None
+    if publish:
+        headers = arm_headers(credential)
+        base_url = project_arm_url(subscription_id, resource_group, account_name, project_name)
+        app_url = f"{base_url}/applications/{app_name}?api-version={ARM_API_VERSION}"
+        deploy_url = f"{base_url}/applications/{app_name}/agentdeployments/{deployment_name}?api-version={ARM_API_VERSION}"
+
+    # 現在の状態を並列に取得（キャッシュのハッシュが一致すればバージョンの検索は省略）
+    use_cache = not refresh and cached.get(DEFINITION_HASH_KEY) == digest and cached.get("agent_version")
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        version_future = None if use_cache else pool.submit(find_agent_version, client, name, digest)
+        app_future = pool.submit(get_resource, app_url, headers) if publish else None
+        deploy_future = pool.submit(get_resource, deploy_url, headers) if publish else None
+        if use_cache:
+            agent_exists, agent_version = True, cached["agent_version"]
+        else:
+            agent_exists, agent_version = version_future.result()
+        current_app = app_future.result() if app_future else None
+        current_deploy = deploy_future.result() if deploy_future else None
+
+    app_payload = application_payload(app_name, name)
+    update_app = publish and not resource_matches(current_app, app_payload)
+    update_deploy = False
+    if publish:
+        update_deploy = agent_version is None or not resource_matches(
+            current_deploy,
+            deployment_payload(deployment_name, name, agent_version, "Hosted", min_replicas, max_replicas),
+        )
+
+    print(f"Plan for hosted agent: {name} (definition {digest[:12]})")
+    print(f"  Agent version: {f'unchanged (v{agent_version})' if agent_version else 'create'}")
+    if publish:
+        print(f"  Application:   {'create/update' if update_app else 'unchanged'}")
+        print(f"  Deployment:    {'create/update' if update_deploy else 'unchanged'}")
+    print()
+    if dry_run:
+        return
+    if agent_version and not update_app and not update_deploy:
+        print("✓ No changes")
+        state[state_key] = {DEFINITION_HASH_KEY: digest, "agent_version": agent_version}
+        save_state(state_file, state)
+        return
+
+    def create_version() -> str:
+        agent = client.agents.create_version(
+            agent_name=name,
+            definition=build_definition(image, cpu, memory, env_vars),
+            metadata={DEFINITION_HASH_KEY: digest},
+        )
+        print(f"  ✓ Agent version {agent.version} created")
+        return str(agent.version)
+
+    def put_application() -> bool:
+        return put_resource(app_url, headers, app_payload, "Agent Application")
+
+    try:
+        if agent_version is None and update_app and agent_exists:
+            # 既存エージェントなので、新バージョンの作成と Application の更新は互いに依存しない
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                version_future = pool.submit(create_version)
+                app_future = pool.submit(put_application)
+                agent_version = version_future.result()
+                app_ok = app_future.result()
+        else:
+            if agent_version is None:
+                agent_version = create_version()
+            app_ok = put_application() if update_app else True
+    except Exception as e:
+        print(f"✗ Apply failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    state[state_key] = {DEFINITION_HASH_KEY: digest, "agent_version": agent_version}
+    save_state(state_file, state)
+    if not app_ok:
+        sys.exit(1)
+
+    if update_deploy:
+        deploy_payload = deployment_payload(
+            deployment_name, name, agent_version, "Hosted", min_replicas, max_replicas
+        )
+        if not put_resource(deploy_url, headers, deploy_payload, "Deployment"):
+            sys.exit(1)
+        wait_for_deployment(deploy_url, headers)
+
+    print()
+    print(f"✓ Applied: {name} v{agent_version}")
+    if publish:
+        print(f"  Replicas: {min_replicas}-{max_replicas}")
+        print(f"  Endpoint: https://{account_name}.services.ai.azure.com/api/projects/{project_name}/applications/{app_name}/protocols/openai")
 
 
 def list_agents(endpoint: str) -> None:
@@ -309,6 +622,53 @@ def main():
     create_parser.add_argument(
         "--resource-group", help="リソースグループ名（--publish時に必要）"
     )
+    create_parser.add_argument(
+        "--min-replicas", type=int, default=1, help="最小レプリカ数（--publish時, default: 1）"
+    )
+    create_parser.add_argument(
+        "--max-replicas", type=int, default=1, help="最大レプリカ数（--publish時, default: 1）"
+    )
+
+    # apply コマンド
+    apply_parser = subparsers.add_parser(
+        "apply", help="変更があった手順だけを実行してエージェントを適用"
+    )
+    apply_parser.add_argument(
+        "--endpoint", required=True, help="AI Foundry Project endpoint"
+    )
+    apply_parser.add_argument(
+        "--image", required=True, help="コンテナイメージ (例: acr.azurecr.io/agent:v1)"
+    )
+    apply_parser.add_argument(
+        "--name", default="demo-hosted-agent", help="エージェント名"
+    )
+    apply_parser.add_argument("--cpu", default="1", help="CPU (default: 1)")
+    apply_parser.add_argument("--memory", default="2Gi", help="メモリ (default: 2Gi)")
+    apply_parser.add_argument(
+        "--model", default="gpt-4o-mini", help="モデル名 (default: gpt-4o-mini)"
+    )
+    apply_parser.add_argument(
+        "--subscription-id", help="AzureサブスクリプションID（省略時はPublishしない）"
+    )
+    apply_parser.add_argument(
+        "--resource-group", help="リソースグループ名（省略時はPublishしない）"
+    )
+    apply_parser.add_argument(
+        "--min-replicas", type=int, default=1, help="最小レプリカ数 (default: 1)"
+    )
+    apply_parser.add_argument(
+        "--max-replicas", type=int, default=1, help="最大レプリカ数 (default: 1)"
+    )
+    apply_parser.add_argument(
+        "--state-file", default=DEFAULT_STATE_FILE,
+        help=f"前回適用した状態を保存するファイル (default: {DEFAULT_STATE_FILE})"
+    )
+    apply_parser.add_argument(
+        "--refresh", action="store_true", help="状態ファイルを使わずにエージェントのバージョンを確認"
+    )
+    apply_parser.add_argument(
+        "--dry-run", action="store_true", help="実行する手順を表示するだけで変更しない"
+    )
 
     # list コマンド
     list_parser = subparsers.add_parser("list", help="エージェント一覧")
@@ -336,6 +696,24 @@ def main():
             publish=args.publish,
             subscription_id=getattr(args, 'subscription_id', None),
             resource_group=getattr(args, 'resource_group', None),
+            min_replicas=args.min_replicas,
+            max_replicas=args.max_replicas,
+        )
+    elif args.command == "apply":
+        apply_hosted_agent(
+            endpoint=args.endpoint,
+            image=args.image,
+            name=args.name,
+            cpu=args.cpu,
+            memory=args.memory,
+            model_name=args.model,
+            subscription_id=args.subscription_id,
+            resource_group=args.resource_group,
+            min_replicas=args.min_replicas,
+            max_replicas=args.max_replicas,
+            state_file=args.state_file,
+            refresh=args.refresh,
+            dry_run=args.dry_run,
         )
     elif args.command == "list":
         list_agents(endpoint=args.endpoint)
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+"""
+Hosted Agent のレプリカ数・リソースを負荷試験から見積もるスクリプト
+
+CPU / メモリの設定ごとに 1 レプリカへ段階的に同時実行数を上げながら Responses API を呼び出し、
+レイテンシ目標（--target-p95）とエラー率 1% 以下を満たす最大スループットを
+レプリカあたりの処理能力とします。想定トラフィック（--base-rps / --peak-rps）から
+設定ごとに必要なレプリカ数を計算し、vCPU の合計が最小になる設定を推奨します。
+
+- local:  ローカルの Docker コンテナ（docker run --cpus / --memory）をレプリカの代わりに計測
+- remote: デプロイ済みエージェントのエンドポイントを計測。--settings を指定すると設定ごとに
+          新しいバージョンを作成して 1 レプリカで Publish し直してから計測し、計測後は
+          元のバージョンとレプリカ数に戻します（計測中は本番のトラフィックにも影響します）。
+
+--apply を指定すると推奨した CPU / メモリで新しいバージョンを作成し、
+推奨したレプリカ数（minReplicas / maxReplicas）で Publish します。
+
+使用方法:
+    # ローカルコンテナで設定ごとに計測
+    python scripts/size_hosted_agent.py local \
+        --image hosted-agent:v1 \
+        --settings 0.5/1Gi,1/2Gi,2/4Gi \
+        --env AZURE_OPENAI_ENDPOINT=https://<account>.cognitiveservices.azure.com/ \
+        --peak-rps 5
+
+    # デプロイ済みエージェントを計測して推奨値を適用
+    python scripts/size_hosted_agent.py remote \
+        --endpoint "https://<account>.services.ai.azure.com/api/projects/<project>" \
+        --image "acrname.azurecr.io/hosted-agent:v1" \
+        --name "demo-hosted-agent" \
+        --settings 1/2Gi,2/4Gi \
+        --subscription-id <sub-id> \
+        --resource-group <rg-name> \
+        --peak-rps 5 --apply
+
+前提条件:
+    - pip install requests（remote / --apply は azure-ai-projects>=2.0.0b3 azure-identity も必要）
+    - local は Docker、remote は az login でログイン済み
+"""
+
+import argparse
+import json
+import math
+import re
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+import requests
+
+# Hosted Agent コンテナが Responses API をホストするポート（agent.yaml）
+CONTAINER_PORT = 8088
+
+# 想定トラフィックに対して各レプリカを使い切らない余裕（処理能力の 70% までで計画する）
+DEFAULT_HEADROOM = 0.7
+
+# 許容するエラー率
+MAX_ERROR_RATE = 0.01
+
+PROBE_INPUT = "Azure AI Foundry の Hosted Agent について 1 文で説明してください。"
+
+
+@dataclass
+class StepResult:
+    """1 つの同時実行数での計測結果"""
+
+    concurrency: int
+    requests: int
+    errors: int
+    duration: float
+    p50: float | None
+    p95: float | None
+
+    @property
+    def throughput(self) -> float:
+        """成功したリクエストの 1 秒あたりの件数"""
+        return (self.requests - self.errors) / self.duration if self.duration else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 1.0
+
+
+@dataclass
+class SettingResult:
+    """1 つの CPU / メモリ設定での計測結果"""
+
+    cpu: str
+    memory: str
+    steps: list[StepResult] = field(default_factory=list)
+    # レイテンシ目標を満たす最大スループット（レプリカあたり）
+    capacity: float = 0.0
+    concurrency: int = 0
+    min_replicas: int = 0
+    max_replicas: int = 0
+
+    @property
+    def vcpus(self) -> float:
+        """最大レプリカ数で動かしたときの vCPU の合計（コストの目安）"""
+        return float(self.cpu) * self.max_replicas
+
+
+def parse_settings(value: str) -> list[tuple[str, str]]:
+    """'0.5/1Gi,1/2Gi' を [(cpu, memory), ...] に変換"""
+    settings = []
+    for item in value.split(","):
+        cpu, _, memory = item.strip().partition("/")
+        if not cpu or not memory:
+            raise ValueError(f"設定の形式が不正です（CPU/メモリ、例: 1/2Gi）: {item}")
+        float(cpu)
+        settings.append((cpu, memory))
+    return settings
+
+
+def memory_mib(memory: str) -> int:
+    """Kubernetes 形式のメモリ（2Gi / 512Mi / 1.5Gi）を MiB に換算"""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([GM])i", memory)
+    if not match:
+        raise ValueError(f"メモリの形式が不正です（例: 2Gi, 512Mi）: {memory}")
+    amount, unit = match.groups()
+    return int(float(amount) * (1024 if unit == "G" else 1))
+
+
+def _quantile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def run_step(
+    url: str,
+    headers: dict,
+    concurrency: int,
+    duration: float,
+    timeout: float = 120.0,
+) -> StepResult:
+    """
+    concurrency 本のスレッドで duration 秒間リクエストを送り続ける（クローズドループ）
+
+    各スレッドは前のリクエストが完了してから次を送ります。
+    """
+    body = json.dumps({"input": PROBE_INPUT}).encode("utf-8")
+    latencies: list[float] = []
+    counts = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+    end = time.monotonic() + duration
+
+    def worker() -> None:
+        session = requests.Session()
+        while time.monotonic() < end:
+            start = time.monotonic()
+            try:
+                resp = session.post(url, headers=headers, data=body, timeout=timeout)
+                ok = resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.monotonic() - start
+            with lock:
+                counts["requests"] += 1
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    counts["errors"] += 1
+        session.close()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return StepResult(
+        concurrency=concurrency,
+        requests=counts["requests"],
+        errors=counts["errors"],
+        duration=time.monotonic() - started,
+        p50=_quantile(latencies, 0.5),
+        p95=_quantile(latencies, 0.95),
+    )
+
+
+def run_profile(
+    url: str,
+    headers: dict,
+    levels: list[int],
+    step_duration: float,
+    target_p95: float,
+) -> list[StepResult]:
+    """同時実行数を段階的に上げて計測（レイテンシ目標を大きく超えたら打ち切る）"""
+    steps = []
+    for concurrency in levels:
+        step = run_step(url, headers, concurrency, step_duration)
+        steps.append(step)
+        p95 = f"{step.p95:.2f}s" if step.p95 is not None else "-"
+        print(
+            f"    concurrency={concurrency:<3} throughput={step.throughput:6.2f} rps  "
+            f"p95={p95:>7}  errors={step.error_rate:.1%}",
+            flush=True,
+        )
+        if step.error_rate > 0.5 or (step.p95 is not None and step.p95 > 2 * target_p95):
+            # 飽和しているので、これ以上上げても処理能力は増えない
+            break
+    return steps
+
+
+def measure_capacity(result: SettingResult, target_p95: float) -> None:
+    """レイテンシ目標とエラー率を満たす最大スループットを処理能力とする"""
+    passing = [
+        s for s in result.steps
+        if s.p95 is not None and s.p95 <= target_p95 and s.error_rate <= MAX_ERROR_RATE
+    ]
+    if passing:
+        best = max(passing, key=lambda s: s.throughput)
+        result.capacity = best.throughput
+        result.concurrency = best.concurrency
+
+
+def replica_bounds(capacity: float, base_rps: float, peak_rps: float, headroom: float) -> tuple[int, int]:
+    """処理能力 × headroom で base_rps / peak_rps を割り、(minReplicas, maxReplicas) を求める"""
+    usable = capacity * headroom
+    min_replicas = max(1, math.ceil(base_rps / usable))
+    return min_replicas, max(min_replicas, math.ceil(peak_rps / usable))
+
+
+def recommend(
+    results: list[SettingResult],
+    base_rps: float,
+    peak_rps: float,
+    headroom: float = DEFAULT_HEADROOM,
+) -> SettingResult | None:
+    """
+    設定ごとに必要なレプリカ数を計算し、vCPU の合計が最小の設定を返す
+
+    min_replicas は base_rps、max_replicas は peak_rps を、処理能力 × headroom で割って求めます。
+    レイテンシ目標を満たせなかった設定は候補から外します。
+    """
+    candidates = []
+    for result in results:
+        if result.capacity <= 0:
+            continue
+        result.min_replicas, result.max_replicas = replica_bounds(result.capacity, base_rps, peak_rps, headroom)
+        candidates.append(result)
+    if not candidates:
+        return None
+    return min(candidates, key=lambda r: (r.vcpus, memory_mib(r.memory)))
+
+
+def wait_until_ready(url: str, headers: dict, timeout: float = 300.0) -> bool:
+    """エンドポイントが 200 を返すまで待機"""
+    deadline = time.monotonic() + timeout
+    body = {"input": "ping"}
+    while time.monotonic() < deadline:
+        try:
+            resp = requests.post(url, headers=headers, json=body, timeout=60)
+            if resp.status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(5)
+    return False
+
+
+def measure_local(args: argparse.Namespace, cpu: str, memory: str) -> SettingResult:
+    """Docker コンテナを 1 つ起動してレプリカの代わりに計測"""
+    result = SettingResult(cpu=cpu, memory=memory)
+    command = [
+        "docker", "run", "-d", "--rm",
+        "--cpus", cpu,
+        "--memory", f"{memory_mib(memory)}m",
+        "-p", f"{args.port}:{CONTAINER_PORT}",
+    ]
+    for env in args.env or []:
+        command += ["-e", env]
+    if args.env_file:
+        command += ["--env-file", args.env_file]
+    command.append(args.image)
+
+    container = subprocess.run(command, check=True, capture_output=True, text=True).stdout.strip()
+    try:
+        url = f"http://localhost:{args.port}/responses"
+        if not wait_until_ready(url, {}, args.ready_timeout):
+            print(f"  ✗ Container did not become ready within {args.ready_timeout:g}s")
+            return result
+        result.steps = run_profile(url, {}, args.levels, args.step_duration, args.target_p95)
+    finally:
+        subprocess.run(["docker", "stop", container], capture_output=True)
+    return result
+
+
+def _remote_target(args: argparse.Namespace, credential) -> tuple[str, dict]:
+    """Publish 済みエージェントの Responses エンドポイントと認証ヘッダー"""
+    url = args.url
+    if not url:
+        url = f"{args.endpoint.rstrip('/')}/applications/{args.name}-app/protocols/openai/responses"
+    if "api-version=" not in url:
+        url += f"{'&' if '?' in url else '?'}api-version={args.api_version}"
+    token = credential.get_token("https://ai.azure.com/.default").token
+    return url, {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+
+
+def measure_remote(args: argparse.Namespace, credential, cpu: str, memory: str, redeploy: bool) -> SettingResult:
+    """
+    デプロイ済みエージェントを計測
+
+    redeploy なら cpu / memory の新バージョンを 1 レプリカで Publish し、Deployment が
+    そのバージョンで Running になってから計測します（旧バージョンのレプリカを計測しないため）。
+    """
+    from register_hosted_agent import (
+        arm_headers,
+        create_hosted_agent,
+        deployment_arm_url,
+        wait_for_agent_version,
+    )
+
+    result = SettingResult(cpu=cpu, memory=memory)
+    if redeploy:
+        agent = create_hosted_agent(
+            endpoint=args.endpoint,
+            image=args.image,
+            name=args.name,
+            cpu=cpu,
+            memory=memory,
+            model_name=args.model,
+            publish=True,
+            subscription_id=args.subscription_id,
+            resource_group=args.resource_group,
+            min_replicas=1,
+            max_replicas=1,
+        )
+        # ロールアウト中は旧バージョンのレプリカも 200 を返すため、新バージョンが Running になるまで待つ
+        deploy_url = deployment_arm_url(args.endpoint, args.subscription_id, args.resource_group, args.name)
+        if deploy_url is None or not wait_for_agent_version(
+            deploy_url, arm_headers(credential), str(agent.version), args.ready_timeout
+        ):
+            print(f"  ✗ Version {agent.version} did not become Running within {args.ready_timeout:g}s")
+            return result
+    url, headers = _remote_target(args, credential)
+    if not wait_until_ready(url, headers, args.ready_timeout):
+        print(f"  ✗ Endpoint did not become ready within {args.ready_timeout:g}s")
+        return result
+    result.steps = run_profile(url, headers, args.levels, args.step_duration, args.target_p95)
+    return result
+
+
+def snapshot_deployment(args: argparse.Namespace, credential) -> dict | None:
+    """計測前の Deployment のバージョンとレプリカ数を記録（Deployment がなければ None）"""
+    from register_hosted_agent import arm_headers, deployment_arm_url, get_resource
+
+    deploy_url = deployment_arm_url(args.endpoint, args.subscription_id, args.resource_group, args.name)
+    data = get_resource(deploy_url, arm_headers(credential)) if deploy_url else None
+    if not data:
+        return None
+    properties = data.get("properties", {})
+    agents = properties.get("agents", [])
+    if not agents:
+        return None
+    return {
+        "agent_version": str(agents[0].get("agentVersion")),
+        "min_replicas": properties.get("minReplicas", 1),
+        "max_replicas": properties.get("maxReplicas", 1),
+    }
+
+
+def restore_deployment(args: argparse.Namespace, credential, snapshot: dict | None) -> None:
+    """snapshot_deployment で記録したバージョンとレプリカ数に Deployment を戻す"""
+    from register_hosted_agent import (
+        arm_headers,
+        deployment_arm_url,
+        deployment_payload,
+        put_resource,
+        wait_for_agent_version,
+    )
+
+    print()
+    if snapshot is None:
+        print("⚠ No deployment existed before sizing; leaving the last measured version published")
+        return
+    print(
+        f"Restoring deployment: version {snapshot['agent_version']}, "
+        f"replicas {snapshot['min_replicas']}-{snapshot['max_replicas']}"
+    )
+    deploy_url = deployment_arm_url(args.endpoint, args.subscription_id, args.resource_group, args.name)
+    headers = arm_headers(credential)
+    payload = deployment_payload(
+        f"{args.name}-deployment",
+        args.name,
+        snapshot["agent_version"],
+        "Hosted",
+        snapshot["min_replicas"],
+        snapshot["max_replicas"],
+    )
+    if not put_resource(deploy_url, headers, payload, "Deployment"):
+        print("✗ Failed to restore the deployment; restore it manually", file=sys.stderr)
+        return
+    if not wait_for_agent_version(deploy_url, headers, snapshot["agent_version"], args.ready_timeout):
+        print(f"  ⚠ Version {snapshot['agent_version']} did not become Running within {args.ready_timeout:g}s")
+
+
+def print_report(results: list[SettingResult], best: SettingResult | None, args: argparse.Namespace) -> None:
+    """設定ごとの処理能力と推奨値を表形式で出力"""
+    print()
+    print("=" * 60)
+    print(f"Sizing (target p95 <= {args.target_p95:g}s, base {args.base_rps:g} rps, peak {args.peak_rps:g} rps)")
+    print("=" * 60)
+    print(f"  {'CPU':>5} {'Memory':>7} {'rps/replica':>12} {'conc':>5} {'replicas':>9} {'vCPU':>6}")
+    for r in results:
+        if r.capacity <= 0:
+            print(f"  {r.cpu:>5} {r.memory:>7} {'-':>12} {'-':>5} {'-':>9} {'-':>6}  (latency target not met)")
+            continue
+        marker = "  ← recommended" if r is best else ""
+        print(
+            f"  {r.cpu:>5} {r.memory:>7} {r.capacity:>12.2f} {r.concurrency:>5} "
+            f"{f'{r.min_replicas}-{r.max_replicas}':>9} {r.vcpus:>6g}{marker}"
+        )
+    print()
+    if best is None:
+        print("✗ No setting met the latency target; try larger settings or a higher --target-p95")
+        return
+    print(f"✓ Recommended: --cpu {best.cpu} --memory {best.memory} "
+          f"--min-replicas {best.min_replicas} --max-replicas {best.max_replicas}")
+
+
+def apply_recommendation(args: argparse.Namespace, best: SettingResult) -> None:
+    """推奨した CPU / メモリで新しいバージョンを作成し、推奨したレプリカ数で Publish"""
+    from register_hosted_agent import create_hosted_agent
+
+    print()
+    print("Applying recommendation...")
+    create_hosted_agent(
+        endpoint=args.endpoint,
+        image=args.image,
+        name=args.name,
+        cpu=best.cpu,
+        memory=best.memory,
+        model_name=args.model,
+        publish=True,
+        subscription_id=args.subscription_id,
+        resource_group=args.resource_group,
+        min_replicas=best.min_replicas,
+        max_replicas=best.max_replicas,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Hosted Agent のレプリカ数・リソースを負荷試験から見積もる"
+    )
+    subparsers = parser.add_subparsers(dest="command", help="計測対象")
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--settings", help="計測する CPU/メモリ設定（カンマ区切り、例: 0.5/1Gi,1/2Gi,2/4Gi）"
+    )
+    common.add_argument(
+        "--levels", default="1,2,4,8,16", help="同時実行数の段階（カンマ区切り, default: 1,2,4,8,16）"
+    )
+    common.add_argument(
+        "--step-duration", type=float, default=30.0, help="各段階の計測時間（秒, default: 30）"
+    )
+    common.add_argument(
+        "--target-p95", type=float, default=10.0, help="レイテンシ目標 p95（秒, default: 10）"
+    )
+    common.add_argument(
+        "--base-rps", type=float, default=1.0, help="平常時のリクエスト数/秒（minReplicas の計算, default: 1）"
+    )
+    common.add_argument(
+        "--peak-rps", type=float, required=True, help="ピーク時のリクエスト数/秒（maxReplicas の計算）"
+    )
+    common.add_argument(
+        "--headroom", type=float, default=DEFAULT_HEADROOM,
+        help="処理能力のうち計画に使う割合 (default: 0.7)"
+    )
+    common.add_argument(
+        "--ready-timeout", type=float, default=300.0, help="起動待ちの上限（秒, default: 300）"
+    )
+    common.add_argument("--output", "-o", help="計測結果と推奨値を書き出す JSON ファイル")
+    common.add_argument("--endpoint", help="AI Foundry Project endpoint（remote / --apply 時に必要）")
+    common.add_argument("--image", help="コンテナイメージ（local では必須）")
+    common.add_argument("--name", default="demo-hosted-agent", help="エージェント名")
+    common.add_argument("--model", default="gpt-4o-mini", help="モデル名 (default: gpt-4o-mini)")
+    common.add_argument("--subscription-id", help="AzureサブスクリプションID（再デプロイ / --apply 時に必要）")
+    common.add_argument("--resource-group", help="リソースグループ名（再デプロイ / --apply 時に必要）")
+    common.add_argument(
+        "--apply", action="store_true", help="推奨した CPU / メモリ / レプリカ数でエージェントを更新"
+    )
+
+    local_parser = subparsers.add_parser("local", parents=[common], help="ローカルの Docker コンテナで計測")
+    local_parser.add_argument("--port", type=int, default=18088, help="コンテナを公開するローカルポート (default: 18088)")
+    local_parser.add_argument("--env", action="append", help="コンテナの環境変数 KEY=VALUE（複数指定可）")
+    local_parser.add_argument("--env-file", help="コンテナの環境変数ファイル")
+
+    remote_parser = subparsers.add_parser("remote", parents=[common], help="デプロイ済みエージェントで計測")
+    remote_parser.add_argument(
+        "--url", help="Responses エンドポイント（省略時は --endpoint と --name から組み立てる）"
+    )
+    remote_parser.add_argument(
+        "--api-version", default="2025-11-15-preview", help="Responses API の api-version"
+    )
+
+    args = parser.parse_args()
+    if args.command not in ("local", "remote"):
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        args.levels = [int(level) for level in args.levels.split(",")]
+        settings = parse_settings(args.settings) if args.settings else []
+        for _, memory in settings:
+            memory_mib(memory)
+        if args.command == "local" and (not args.image or not settings):
+            raise ValueError("local には --image と --settings が必要です")
+        if args.command == "remote" and not (args.endpoint or args.url):
+            raise ValueError("remote には --endpoint（または --url）が必要です")
+        if args.apply and not settings:
+            raise ValueError("--apply には --settings が必要です（推奨する CPU / メモリを計測するため）")
+        if (args.apply or (args.command == "remote" and settings)) and not (
+            args.endpoint and args.image and args.subscription_id and args.resource_group
+        ):
+            raise ValueError(
+                "再デプロイ / --apply には --endpoint --image --subscription-id --resource-group が必要です"
+            )
+    except ValueError as e:
+        print(f"✗ {e}", file=sys.stderr)
+        sys.exit(1)
+
+    credential = None
+    if args.command == "remote":
+        from azure.identity import AzureCliCredential
+
+        credential = AzureCliCredential()
+
+    results = []
+    if args.command == "local":
+        for cpu, memory in settings:
+            print(f"Measuring local container: cpu={cpu}, memory={memory}")
+            results.append(measure_local(args, cpu, memory))
+    elif settings:
+        # 計測中は本番の Deployment を 1 レプリカの計測用バージョンに差し替えるため、元の状態を記録して戻す
+        original = snapshot_deployment(args, credential)
+        print(f"⚠ Republishing '{args.name}' with 1 replica per setting; live traffic is affected during sizing")
+        measured = False
+        try:
+            for cpu, memory in settings:
+                print(f"Measuring remote agent: cpu={cpu}, memory={memory} (1 replica)")
+                results.append(measure_remote(args, credential, cpu, memory, redeploy=True))
+            measured = True
+        finally:
+            # --apply で推奨値を Publish する場合は戻さない（計測が途中で失敗したときは戻す）
+            if not (measured and args.apply):
+                restore_deployment(args, credential, original)
+    else:
+        # 現在のデプロイメントをそのまま計測（レプリカは 1 つで動いている前提）
+        print("Measuring current deployment")
+        results.append(measure_remote(args, credential, "current", "current", redeploy=False))
+
+    for result in results:
+        measure_capacity(result, args.target_p95)
+    best = None
+    if settings:
+        best = recommend(results, args.base_rps, args.peak_rps, args.headroom)
+        print_report(results, best, args)
+    elif results[0].capacity > 0:
+        # 現在の設定のまま、レプリカ数だけを見積もる
+        current = results[0]
+        current.min_replicas, current.max_replicas = replica_bounds(
+            current.capacity, args.base_rps, args.peak_rps, args.headroom
+        )
+        print()
+        print(f"✓ Current deployment: {current.capacity:.2f} rps/replica → "
+              f"--min-replicas {current.min_replicas} --max-replicas {current.max_replicas}")
+    else:
+        print()
+        print("✗ The current deployment did not meet the latency target")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "results": [asdict(r) for r in results],
+                    "recommended": asdict(best) if best else None,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"  Results written to {args.output}")
+
+    if args.apply:
+        if best is None:
+            print("✗ Nothing to apply", file=sys.stderr)
+            if args.command == "remote":
+                restore_deployment(args, credential, original)
+            sys.exit(1)
+        apply_recommendation(args, best)
+
+
+if __name__ == "__main__":
+    main()
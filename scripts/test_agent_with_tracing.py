@@ -7,23 +7,52 @@ Azure AI Foundry でトレースを確認するサンプルスクリプト
 
 使用方法:
     python scripts/test_agent_with_tracing.py
+    python scripts/test_agent_with_tracing.py --record-content --sampling-ratio 0.1
 
 環境変数:
     PROJECT_ENDPOINT: AI Foundry Project エンドポイント (任意)
+    AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED: true でプロンプト/コンプリーション内容を記録 (既定: false)
+    OTEL_BSP_MAX_QUEUE_SIZE / OTEL_BSP_MAX_EXPORT_BATCH_SIZE / OTEL_BSP_SCHEDULE_DELAY:
+        エクスポートキューの上限・バッチサイズ・送信間隔 (ms)
 """
 
+import argparse
 import os
-from azure.identity import AzureCliCredential
-from azure.ai.projects import AIProjectClient
-from azure.core.settings import settings
-from openai import AzureOpenAI
 
 # ========================================
 # 1. OpenTelemetry トレース設定
 # ========================================
 
-# コンテンツ記録を有効化（prompts/completions の内容を記録）
-os.environ["AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED"] = "true"
+# エクスポートはバックグラウンドのバッチ送信（有界キュー）で行い、
+# キューが溢れた場合はスパンを破棄してリクエスト経路をブロックしない
+os.environ.setdefault("OTEL_BSP_MAX_QUEUE_SIZE", "2048")
+os.environ.setdefault("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "512")
+os.environ.setdefault("OTEL_BSP_SCHEDULE_DELAY", "5000")
+
+parser = argparse.ArgumentParser(description="Azure AI Foundry トレース確認")
+parser.add_argument(
+    "--record-content",
+    action="store_true",
+    help="プロンプト/コンプリーション内容をスパンに記録（負荷試験では非推奨）"
+)
+parser.add_argument(
+    "--sampling-ratio",
+    type=float,
+    default=1.0,
+    help="トレースのサンプリング率 (0.0〜1.0, default: 1.0)"
+)
+args = parser.parse_args()
+
+# コンテンツ記録は既定で無効（prompts/completions 全文のシリアライズを避ける）
+if args.record_content:
+    os.environ["AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED"] = "true"
+else:
+    os.environ.setdefault("AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED", "false")
+
+from azure.identity import AzureCliCredential
+from azure.ai.projects import AIProjectClient
+from azure.core.settings import settings
+from openai import AzureOpenAI
 
 # azure-core のトレース実装を OpenTelemetry に設定
 settings.tracing_implementation = "opentelemetry"
@@ -46,9 +75,12 @@ from azure.monitor.opentelemetry import configure_azure_monitor
 connection_string = client.telemetry.get_application_insights_connection_string()
 print(f"✓ Application Insights connected")
 
-# Azure Monitor にトレースを送信
-configure_azure_monitor(connection_string=connection_string)
-print("✓ Tracing enabled")
+# Azure Monitor にトレースを送信（BatchSpanProcessor は OTEL_BSP_* の設定に従う）
+configure_azure_monitor(
+    connection_string=connection_string,
+    sampling_ratio=args.sampling_ratio
+)
+print(f"✓ Tracing enabled (sampling ratio: {args.sampling_ratio})")
 
 # ========================================
 # 3. Azure OpenAI Chat Completions
@@ -102,6 +134,6 @@ print("トレースに含まれる情報:")
 print("  - リクエスト/レスポンス時間")
 print("  - トークン使用量")
 print("  - モデル名")
-print("  - プロンプト/コンプリーション内容 (AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED=true時)")
+print("  - プロンプト/コンプリーション内容 (--record-content 指定時)")
 print()
 print("✓ スクリプト完了")
@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+Batch API 一括処理スクリプト
+
+大量のオフライン処理を Chat Completions の対話クォータを消費せずに実行するため、
+Azure OpenAI の Batch API（/files + /batches）を AI Gateway 経由で利用します。
+
+1. prepare  : プロンプトの JSONL を読み進めながら Batch API 形式のリクエストファイルに変換
+             （1 ファイルあたりのリクエスト数・サイズ上限で分割、全件をメモリに載せない）
+2. submit   : リクエストファイルをアップロードしてバッチジョブを作成
+3. status   : ジョブの状態を表示（--wait で完了まで待機）
+4. download : 結果ファイルをダウンロードし、custom_id で入力と結合して出力 JSONL に書き出し
+run で 1〜4 をまとめて実行します。進捗は作業ディレクトリの batch_state.json に保存されるため、
+途中で中断しても同じコマンドで再開できます。
+
+入力 JSONL の 1 行:
+    {"prompt": "...", "system": "..."}                       # prompt / system から messages を生成
+    {"custom_id": "q-1", "messages": [...], "max_tokens": 200}  # messages とパラメーターを直接指定
+
+使用方法:
+    python batch_jobs.py run prompts.jsonl --model gpt-4o-batch --output results.jsonl
+    python batch_jobs.py run prompts.jsonl --mock --output results.jsonl
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+import tokens
+from gateway_client import GatewayClient
+
+# Batch API の入力ファイル上限（Azure OpenAI グローバルバッチ）
+MAX_REQUESTS_PER_FILE = 100_000
+MAX_BYTES_PER_FILE = 200 * 1024 * 1024
+
+# ジョブの終了状態
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+STATE_FILE = "batch_state.json"
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def iter_jsonl(path: str) -> Iterator[tuple[int, int, dict]]:
+    """JSONL を 1 行ずつ読み、(行番号, バイトオフセット, オブジェクト) を返す（空行は無視）"""
+    with open(path, "rb") as f:
+        line_no = 0
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                return
+            line_no += 1
+            if line.strip():
+                yield line_no, offset, json.loads(line)
+
+
+def to_batch_request(item: dict, line_no: int, model: str, endpoint: str) -> dict:
+    """入力 1 行を Batch API のリクエスト行に変換"""
+    params = dict(item)
+    custom_id = str(params.pop("custom_id", None) or f"line-{line_no}")
+    if "messages" not in params:
+        if "prompt" not in params:
+            raise ValueError(f"{line_no} 行目: prompt または messages が必要です")
+        messages = []
+        system = params.pop("system", None)
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.append({"role": "user", "content": params.pop("prompt")})
+        params["messages"] = messages
+    params["model"] = model
+    return {"custom_id": custom_id, "method": "POST", "url": endpoint, "body": params}
+
+
+@dataclass
+class BatchChunk:
+    """分割したリクエストファイル 1 つと、そのジョブの状態"""
+
+    path: str
+    requests: int
+    bytes: int
+    file_id: Optional[str] = None
+    batch_id: Optional[str] = None
+    status: Optional[str] = None
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    downloaded: bool = False
+
+
+@dataclass
+class BatchState:
+    """作業ディレクトリに保存する一括処理の状態"""
+
+    input_path: str
+    model: str
+    endpoint: str
+    chunks: list[BatchChunk] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, work_dir: Path) -> "BatchState":
+        with open(work_dir / STATE_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        data["chunks"] = [BatchChunk(**c) for c in data["chunks"]]
+        return cls(**data)
+
+    def save(self, work_dir: Path) -> None:
+        path = work_dir / STATE_FILE
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+
+def prepare(
+    input_path: str,
+    work_dir: Path,
+    model: str,
+    endpoint: str = "/chat/completions",
+    max_requests: int = MAX_REQUESTS_PER_FILE,
+    max_bytes: int = MAX_BYTES_PER_FILE,
+) -> BatchState:
+    """入力 JSONL をストリーミングで読み、上限ごとに分割したリクエストファイルを作成"""
+    work_dir.mkdir(parents=True, exist_ok=True)
+    state = BatchState(input_path=input_path, model=model, endpoint=endpoint)
+    seen: set[str] = set()
+    out = None
+    chunk: Optional[BatchChunk] = None
+
+    try:
+        for line_no, _, item in iter_jsonl(input_path):
+            request = to_batch_request(item, line_no, model, endpoint)
+            if request["custom_id"] in seen:
+                raise ValueError(f"{line_no} 行目: custom_id が重複しています: {request['custom_id']}")
+            seen.add(request["custom_id"])
+
+            line = (_dumps(request) + "\n").encode("utf-8")
+            if len(line) > max_bytes:
+                raise ValueError(f"{line_no} 行目: 1 リクエストがファイルサイズ上限を超えています")
+            if chunk is None or chunk.requests >= max_requests or chunk.bytes + len(line) > max_bytes:
+                if out is not None:
+                    out.close()
+                path = work_dir / f"requests-{len(state.chunks):04d}.jsonl"
+                chunk = BatchChunk(path=str(path), requests=0, bytes=0)
+                state.chunks.append(chunk)
+                out = open(path, "wb")
+            out.write(line)
+            chunk.requests += 1
+            chunk.bytes += len(line)
+    finally:
+        if out is not None:
+            out.close()
+
+    state.save(work_dir)
+    return state
+
+
+class BatchClient(GatewayClient):
+    """Batch API（/files, /batches）クライアント"""
+
+    api_name = "batch"
+
+    def __init__(self, base_url: str, api_key: str, api_version: str = "2025-03-01-preview", **kwargs):
+        super().__init__(base_url, api_key, api_version, **kwargs)
+
+    def upload_file(self, path: str) -> dict:
+        """リクエストファイルをアップロード（purpose=batch）"""
+        with open(path, "rb") as f:
+            return self._request(
+                "POST",
+                "/files",
+                files={"file": (Path(path).name, f, "application/jsonl")},
+                data={"purpose": "batch"},
+            )
+
+    def create_batch(
+        self,
+        input_file_id: str,
+        endpoint: str = "/chat/completions",
+        completion_window: str = "24h",
+        metadata: Optional[dict] = None,
+    ) -> dict:
+        """バッチジョブを作成"""
+        body = {
+            "input_file_id": input_file_id,
+            "endpoint": endpoint,
+            "completion_window": completion_window,
+        }
+        if metadata:
+            body["metadata"] = metadata
+        return self._request("POST", "/batches", json=body)
+
+    def get_batch(self, batch_id: str) -> dict:
+        """バッチジョブの状態を取得"""
+        return self._request("GET", f"/batches/{batch_id}")
+
+    def cancel_batch(self, batch_id: str) -> dict:
+        """バッチジョブをキャンセル"""
+        return self._request("POST", f"/batches/{batch_id}/cancel")
+
+    def download_file(self, file_id: str, dest: str) -> None:
+        """ファイル内容をストリーミングで保存"""
+        response = self._request("GET", f"/files/{file_id}/content", stream=True)
+        try:
+            with open(dest, "wb") as f:
+                for block in response.iter_content(chunk_size=1 << 20):
+                    f.write(block)
+        finally:
+            response.close()
+
+
+def echo_responder(body: dict) -> dict:
+    """モック用: 最後の user メッセージを返す Chat Completion を生成"""
+    messages = body.get("messages", [])
+    last = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+    text = f"[mock] {last}"
+    prompt_tokens = tokens.estimate_chat_tokens(body.get("model", ""), messages)
+    completion_tokens = tokens.get_counter(body.get("model", "")).count_text(text)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class MockBatchClient:
+    """
+    BatchClient と同じインターフェースのローカル実装（テスト用）
+
+    ファイルとジョブの状態（{batch_id}.json）は root_dir に保存するため、run の後に
+    別プロセスで status / download を実行したり、中断した run を再開したりできます。
+    ジョブは get_batch のたびに validating → in_progress → completed と進み、
+    完了時に responder で結果を生成します。
+    """
+
+    def __init__(self, root_dir: str, responder: Callable[[dict], dict] = echo_responder):
+        self.root = Path(root_dir)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.responder = responder
+
+    def _file_path(self, file_id: str) -> Path:
+        return self.root / f"{file_id}.jsonl"
+
+    def _load_batch(self, batch_id: str) -> dict:
+        path = self.root / f"{batch_id}.json"
+        if not path.exists():
+            raise KeyError(f"モックのバッチ {batch_id} がありません（{self.root}）")
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_batch(self, batch: dict) -> None:
+        path = self.root / f"{batch['id']}.json"
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(batch, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+    def upload_file(self, path: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        shutil.copyfile(path, self._file_path(file_id))
+        return {"id": file_id, "object": "file", "purpose": "batch", "filename": Path(path).name}
+
+    def create_batch(
+        self,
+        input_file_id: str,
+        endpoint: str = "/chat/completions",
+        completion_window: str = "24h",
+        metadata: Optional[dict] = None,
+    ) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self._save_batch(batch)
+        return batch
+
+    def get_batch(self, batch_id: str) -> dict:
+        batch = self._load_batch(batch_id)
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+        elif batch["status"] == "in_progress":
+            self._complete(batch)
+        else:
+            return batch
+        self._save_batch(batch)
+        return batch
+
+    def cancel_batch(self, batch_id: str) -> dict:
+        batch = self._load_batch(batch_id)
+        if batch["status"] not in TERMINAL_STATUSES:
+            batch["status"] = "cancelled"
+            self._save_batch(batch)
+        return batch
+
+    def _complete(self, batch: dict) -> None:
+        output_id = f"file-{uuid.uuid4().hex[:24]}"
+        counts = batch["request_counts"]
+        with open(self._file_path(batch["input_file_id"]), encoding="utf-8") as src, open(
+            self._file_path(output_id), "w", encoding="utf-8"
+        ) as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                counts["total"] += 1
+                result = {
+                    "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "request_id": uuid.uuid4().hex,
+                        "body": self.responder(request["body"]),
+                    },
+                    "error": None,
+                }
+                counts["completed"] += 1
+                dst.write(_dumps(result) + "\n")
+        batch["output_file_id"] = output_id
+        batch["status"] = "completed"
+
+    def download_file(self, file_id: str, dest: str) -> None:
+        shutil.copyfile(self._file_path(file_id), dest)
+
+
+def submit(client, state: BatchState, work_dir: Path, completion_window: str = "24h") -> None:
+    """未送信のリクエストファイルをアップロードしてジョブを作成"""
+    for index, chunk in enumerate(state.chunks):
+        if chunk.batch_id:
+            continue
+        if not chunk.file_id:
+            chunk.file_id = client.upload_file(chunk.path)["id"]
+            state.save(work_dir)
+        batch = client.create_batch(
+            chunk.file_id,
+            endpoint=state.endpoint,
+            completion_window=completion_window,
+            metadata={"chunk": str(index)},
+        )
+        chunk.batch_id = batch["id"]
+        chunk.status = batch.get("status")
+        state.save(work_dir)
+        print(f"📤 Chunk {index}: {chunk.requests} requests → {chunk.batch_id}")
+
+
+def refresh(client, state: BatchState, work_dir: Path) -> bool:
+    """ジョブの状態を更新し、すべて終了していれば True を返す"""
+    for chunk in state.chunks:
+        if not chunk.batch_id or chunk.status in TERMINAL_STATUSES:
+            continue
+        batch = client.get_batch(chunk.batch_id)
+        chunk.status = batch.get("status")
+        chunk.output_file_id = batch.get("output_file_id")
+        chunk.error_file_id = batch.get("error_file_id")
+    state.save(work_dir)
+    return all(chunk.status in TERMINAL_STATUSES for chunk in state.chunks)
+
+
+def print_status(state: BatchState) -> None:
+    for index, chunk in enumerate(state.chunks):
+        print(f"  - Chunk {index}: {chunk.requests} requests, {chunk.batch_id or '-'}, {chunk.status or 'pending'}")
+
+
+def wait(client, state: BatchState, work_dir: Path, interval: float) -> None:
+    """すべてのジョブが終了するまで待機"""
+    while not refresh(client, state, work_dir):
+        running = sum(1 for c in state.chunks if c.status not in TERMINAL_STATUSES)
+        print(f"⏳ {running}/{len(state.chunks)} jobs running...")
+        time.sleep(interval)
+
+
+def _join_results(result_path: str, input_path: str, index: dict[str, int], out) -> dict:
+    """結果ファイルを 1 行ずつ読み、custom_id で入力行と結合して書き出す"""
+    summary = {"succeeded": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    with open(input_path, "rb") as inputs:
+        for _, _, result in iter_jsonl(result_path):
+            custom_id = result.get("custom_id")
+            offset = index.get(custom_id)
+            item = None
+            if offset is not None:
+                inputs.seek(offset)
+                item = json.loads(inputs.readline())
+            response = result.get("response") or {}
+            body = response.get("body")
+            error = result.get("error") or (body or {}).get("error")
+            if response.get("status_code") == 200 and not error:
+                summary["succeeded"] += 1
+                usage = (body or {}).get("usage") or {}
+                summary["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                summary["completion_tokens"] += usage.get("completion_tokens", 0)
+            else:
+                summary["failed"] += 1
+            out.write(_dumps({
+                "custom_id": custom_id,
+                "input": item,
+                "status_code": response.get("status_code"),
+                "response": body,
+                "error": error,
+            }) + "\n")
+    return summary
+
+
+def download(client, state: BatchState, work_dir: Path, output_path: str) -> dict:
+    """完了したジョブの結果をダウンロードして入力と結合（出力 JSONL に追記）"""
+    # 入力全体ではなく custom_id → バイトオフセットの索引だけを保持
+    index: dict[str, int] = {}
+    for line_no, offset, item in iter_jsonl(state.input_path):
+        index[str(item.get("custom_id") or f"line-{line_no}")] = offset
+
+    total = {"succeeded": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    with open(output_path, "a", encoding="utf-8") as out:
+        for number, chunk in enumerate(state.chunks):
+            if chunk.downloaded or chunk.status not in TERMINAL_STATUSES:
+                continue
+            for file_id in (chunk.output_file_id, chunk.error_file_id):
+                if not file_id:
+                    continue
+                result_path = str(work_dir / f"{file_id}.jsonl")
+                client.download_file(file_id, result_path)
+                for key, value in _join_results(result_path, state.input_path, index, out).items():
+                    total[key] += value
+            chunk.downloaded = True
+            state.save(work_dir)
+            print(f"📥 Chunk {number}: {chunk.status}")
+    return total
+
+
+def create_client(args):
+    """--mock 指定時はローカル実装、それ以外は AI Gateway 経由の BatchClient"""
+    if args.mock:
+        return MockBatchClient(os.path.join(args.work_dir, "mock"))
+
+    from config import get_config
+
+    config = get_config()
+    return BatchClient(
+        base_url=config.base_url_responses,
+        api_key=config.api_key,
+        api_version=config.api_version,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Batch API 一括処理",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python batch_jobs.py prepare prompts.jsonl --model gpt-4o-batch
+  python batch_jobs.py submit
+  python batch_jobs.py status --wait
+  python batch_jobs.py download --output results.jsonl
+  python batch_jobs.py run prompts.jsonl --model gpt-4o-batch --output results.jsonl
+  python batch_jobs.py run prompts.jsonl --mock --output results.jsonl
+        """
+    )
+    parser.add_argument("command", choices=["prepare", "submit", "status", "download", "run"])
+    parser.add_argument("input", nargs="?", help="プロンプトの JSONL（prepare / run）")
+    parser.add_argument("--model", "-m", help="グローバルバッチのデプロイメント名（デフォルト: 環境変数 DEFAULT_MODEL）")
+    parser.add_argument("--output", "-o", default="batch_results.jsonl", help="結果の JSONL (default: batch_results.jsonl)")
+    parser.add_argument("--work-dir", default="batch_work", help="作業ディレクトリ (default: batch_work)")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS_PER_FILE, help="1 ファイルあたりのリクエスト数上限")
+    parser.add_argument("--max-bytes", type=int, default=MAX_BYTES_PER_FILE, help="1 ファイルあたりのバイト数上限")
+    parser.add_argument("--completion-window", default="24h", help="完了期限 (default: 24h)")
+    parser.add_argument("--wait", action="store_true", help="status: すべてのジョブが終了するまで待機")
+    parser.add_argument("--interval", type=float, default=60.0, help="状態確認の間隔（秒） (default: 60)")
+    parser.add_argument("--mock", action="store_true", help="AI Gateway を使わずローカルのモックで実行")
+
+    args = parser.parse_args()
+    work_dir = Path(args.work_dir)
+    if args.mock:
+        args.interval = 0.0
+
+    try:
+        resume = (
+            args.command == "run"
+            and (work_dir / STATE_FILE).exists()
+            and BatchState.load(work_dir).input_path == args.input
+        )
+        if args.command in ("prepare", "run") and not resume:
+            if not args.input:
+                parser.error("入力 JSONL を指定してください")
+            model = args.model
+            if not model and not args.mock:
+                from config import get_config
+                model = get_config().default_model
+            state = prepare(args.input, work_dir, model or "gpt-4o", max_requests=args.max_requests, max_bytes=args.max_bytes)
+            total = sum(c.requests for c in state.chunks)
+            print(f"📝 {total} requests → {len(state.chunks)} files ({work_dir})")
+            if args.command == "prepare":
+                return
+        else:
+            state = BatchState.load(work_dir)
+            if resume:
+                print(f"🔁 {work_dir / STATE_FILE} から再開します")
+
+        client = create_client(args)
+        if args.command in ("submit", "run"):
+            submit(client, state, work_dir, args.completion_window)
+        if args.command in ("status", "download") and not args.wait:
+            refresh(client, state, work_dir)
+        elif args.command in ("status", "run") or args.wait:
+            wait(client, state, work_dir, args.interval)
+        if args.command == "status":
+            print_status(state)
+        if args.command in ("download", "run"):
+            summary = download(client, state, work_dir, args.output)
+            print(f"\n{'='*60}")
+            print(f"✅ {summary['succeeded']} succeeded, {summary['failed']} failed → {args.output}")
+            print(f"   Tokens: prompt={summary['prompt_tokens']}, completion={summary['completion_tokens']}")
+            print(f"{'='*60}")
+
+    except FileNotFoundError as e:
+        print(f"❌ エラー: {e}（先に prepare を実行してください）", file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+サーキットブレーカーモジュール
+
+APIM の背後のデプロイメントが劣化したときに、各呼び出しがタイムアウトまで待ち続けて
+スレッドが積み上がるのを防ぎます。ブレーカーは (エンドポイント, デプロイメント) ごとに持ち、
+エンドポイントはクライアントの api_name（chat / responses / assistants 等）です。
+
+- closed: 直近 window 秒の試行のうち、失敗（5xx・接続エラー・タイムアウト）の割合か
+  低速（slow_call_duration 秒超）の割合がしきい値を超えたら open に遷移します。
+  429 はクォータ超過でありデプロイメントの障害ではないため失敗に数えません（ルーターが扱います）。
+- open: open_duration 秒間は送信せずに CircuitOpenError で即座に失敗します。
+  ルーターが設定されていれば、回路が開いていないデプロイメントへ迂回します。
+- half_open: 最大 half_open_max_calls 件の試行だけを通し、すべて成功すれば closed、
+  1 件でも失敗すれば再び open に戻ります。送信に至らなかった試行の枠は release() で返します。
+
+状態と遷移は aigateway_circuit_* メトリクスとして出力します。
+
+使用方法:
+    python test_chat_completions.py --circuit-breaker
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# aigateway_circuit_state ゲージの値
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# model を伴わない呼び出し（ポーリング等）のデプロイメント名
+ANY_DEPLOYMENT = "*"
+
+
+class CircuitOpenError(Exception):
+    """回路が開いているため送信しなかった"""
+
+    def __init__(self, endpoint: str, deployment: str, retry_after: float):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.retry_after = retry_after
+        super().__init__(
+            f"{endpoint}/{deployment} の回路が開いています（{retry_after:.1f} 秒後に再試行）"
+        )
+
+
+@dataclass
+class BreakerPolicy:
+    """回路を開く条件と復帰の方針"""
+
+    # 判定に使う直近の期間（秒）と、判定に必要な最小試行数
+    window: float = 30.0
+    min_calls: int = 10
+    failure_rate: float = 0.5
+    # この秒数を超えた試行を低速とみなす
+    slow_call_duration: float = 30.0
+    slow_call_rate: float = 0.8
+    open_duration: float = 30.0
+    half_open_max_calls: int = 3
+
+
+class CircuitBreaker:
+    """1 つの (エンドポイント, デプロイメント) のブレーカー"""
+
+    def __init__(self, endpoint: str, deployment: str, policy: BreakerPolicy, on_transition=None):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.policy = policy
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # (時刻, 失敗, 低速)
+        self._calls: deque = deque()
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+        self._on_transition = on_transition
+
+    def _transition(self, state: str) -> None:
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if state != CLOSED:
+            self._calls.clear()
+        self._probes = 0
+        self._probe_successes = 0
+        if self._on_transition is not None:
+            self._on_transition(self, previous, state)
+
+    def allow(self) -> None:
+        """送信してよければ戻り、そうでなければ CircuitOpenError を送出"""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self.policy.open_duration - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    raise CircuitOpenError(self.endpoint, self.deployment, remaining)
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.policy.half_open_max_calls:
+                    raise CircuitOpenError(self.endpoint, self.deployment, 0.0)
+                self._probes += 1
+
+    def release(self) -> None:
+        """
+        allow() を通過したが送信せずに終わった試行の枠を返す
+
+        実行枠の待機のタイムアウト等で record() に至らなかった場合に呼び出します。
+        返さないと half_open の試行枠が埋まったままになり、回路が閉じも開きもしなくなります。
+        """
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > self._probe_successes:
+                self._probes -= 1
+
+    def record(self, failed: bool, duration: float) -> None:
+        """allow() を通過した試行の結果を記録"""
+        slow = duration > self.policy.slow_call_duration
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.policy.half_open_max_calls:
+                    self._transition(CLOSED)
+                return
+            if self.state == OPEN:
+                # 開く前に送信した試行の結果
+                return
+
+            now = time.monotonic()
+            calls = self._calls
+            calls.append((now, failed, slow))
+            while calls and calls[0][0] < now - self.policy.window:
+                calls.popleft()
+            if len(calls) < self.policy.min_calls:
+                return
+            failures = sum(1 for _, f, _ in calls if f)
+            slows = sum(1 for _, _, s in calls if s)
+            if (
+                failures / len(calls) >= self.policy.failure_rate
+                or slows / len(calls) >= self.policy.slow_call_rate
+            ):
+                self._transition(OPEN)
+
+    def is_open(self) -> bool:
+        """送信できない状態か（open で待機時間が残っている）"""
+        return (
+            self.state == OPEN
+            and time.monotonic() - self.opened_at < self.policy.open_duration
+        )
+
+    def error_rates(self) -> tuple[float, float]:
+        """直近 window の失敗率と低速率"""
+        with self._lock:
+            calls = list(self._calls)
+        if not calls:
+            return 0.0, 0.0
+        return (
+            sum(1 for _, f, _ in calls if f) / len(calls),
+            sum(1 for _, _, s in calls if s) / len(calls),
+        )
+
+
+class CircuitBreakers:
+    """(エンドポイント, デプロイメント) ごとのブレーカーの集合"""
+
+    def __init__(
+        self,
+        policy: Optional[BreakerPolicy] = None,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        self.policy = policy or BreakerPolicy()
+        self._breakers: dict[tuple[str, str], CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.transitions: deque = deque(maxlen=1000)
+
+        registry = registry or metrics.get_registry()
+        self._state_gauge = registry.gauge(
+            "aigateway_circuit_state",
+            "回路の状態（0=closed, 1=half_open, 2=open）",
+            ("endpoint", "deployment"),
+        )
+        self._transitions = registry.counter(
+            "aigateway_circuit_transitions_total",
+            "回路の状態遷移数",
+            ("endpoint", "deployment", "from_state", "to_state"),
+        )
+        self._rejected = registry.counter(
+            "aigateway_circuit_rejected_total",
+            "回路が開いていたため即座に失敗させた呼び出し数",
+            ("endpoint", "deployment"),
+        )
+        self._rerouted = registry.counter(
+            "aigateway_circuit_reroutes_total",
+            "回路が開いていたため別のデプロイメントへ迂回した呼び出し数",
+            ("endpoint", "deployment"),
+        )
+
+    def get(self, endpoint: str, deployment: Optional[str]) -> CircuitBreaker:
+        """ブレーカーを取得（なければ closed で作成）"""
+        key = (endpoint, deployment or ANY_DEPLOYMENT)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(key)
+                if breaker is None:
+                    breaker = self._breakers[key] = CircuitBreaker(*key, self.policy, self._on_transition)
+                    self._state_gauge.set(STATE_VALUES[CLOSED], endpoint=key[0], deployment=key[1])
+        return breaker
+
+    def _on_transition(self, breaker: CircuitBreaker, previous: str, state: str) -> None:
+        labels = {"endpoint": breaker.endpoint, "deployment": breaker.deployment}
+        self._state_gauge.set(STATE_VALUES[state], **labels)
+        self._transitions.inc(from_state=previous, to_state=state, **labels)
+        self.transitions.append((time.time(), breaker.endpoint, breaker.deployment, previous, state))
+
+    def allow(self, breaker: CircuitBreaker) -> None:
+        """breaker.allow()（拒否した場合は件数を記録）"""
+        try:
+            breaker.allow()
+        except CircuitOpenError:
+            self._rejected.inc(endpoint=breaker.endpoint, deployment=breaker.deployment)
+            raise
+
+    def open_deployments(self, endpoint: str) -> set[str]:
+        """回路が開いているデプロイメント"""
+        return {
+            deployment
+            for (name, deployment), breaker in list(self._breakers.items())
+            if name == endpoint and breaker.is_open()
+        }
+
+    def record_reroute(self, endpoint: str, deployment: str) -> None:
+        self._rerouted.inc(endpoint=endpoint, deployment=deployment)
+
+    def report(self) -> list[dict]:
+        """ブレーカーごとの状態と直近の失敗率"""
+        rows = []
+        for (endpoint, deployment), breaker in sorted(self._breakers.items()):
+            failure_rate, slow_rate = breaker.error_rates()
+            rows.append({
+                "endpoint": endpoint,
+                "deployment": deployment,
+                "state": breaker.state,
+                "failure_rate": failure_rate,
+                "slow_rate": slow_rate,
+                "rejected": self._rejected.value(endpoint=endpoint, deployment=deployment),
+            })
+        return rows
+
+    def print_report(self) -> None:
+        """レポートを表形式で出力"""
+        print("\nCircuit breakers:")
+        for row in self.report():
+            print(
+                f"  - {row['endpoint']}/{row['deployment']}: {row['state']}, "
+                f"failures={row['failure_rate']:.1%}, slow={row['slow_rate']:.1%}, "
+                f"rejected={row['rejected']:.0f}"
+            )
+        for timestamp, endpoint, deployment, previous, state in self.transitions:
+            moment = time.strftime("%H:%M:%S", time.localtime(timestamp))
+            print(f"    {moment} {endpoint}/{deployment}: {previous} → {state}")
+
+
+def add_breaker_arguments(parser: argparse.ArgumentParser) -> None:
+    """サーキットブレーカー用の CLI 引数を追加"""
+    group = parser.add_argument_group("circuit breaker")
+    group.add_argument(
+        "--circuit-breaker",
+        action="store_true",
+        default=os.getenv("AIGATEWAY_CIRCUIT_BREAKER", "false").lower() == "true",
+        help="デプロイメントごとのサーキットブレーカーを有効化（環境変数 AIGATEWAY_CIRCUIT_BREAKER）",
+    )
+    group.add_argument(
+        "--breaker-open-seconds",
+        type=float,
+        default=BreakerPolicy.open_duration,
+        help="回路を開いておく秒数 (default: 30)",
+    )
+    group.add_argument(
+        "--breaker-slow-seconds",
+        type=float,
+        default=BreakerPolicy.slow_call_duration,
+        help="低速とみなす応答時間（秒） (default: 30)",
+    )
+
+
+def create_breakers(args: argparse.Namespace) -> Optional[CircuitBreakers]:
+    """CLI 引数に応じてブレーカーを作成（無効なら None）"""
+    if not args.circuit_breaker:
+        return None
+    return CircuitBreakers(BreakerPolicy(
+        open_duration=args.breaker_open_seconds,
+        slow_call_duration=args.breaker_slow_seconds,
+    ))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+適応型同時実行数制限モジュール
+
+固定の同時実行数では、容量を使い切れないか 429 の嵐を招くため、応答時間と 429 を見ながら
+同時実行数の上限をデプロイメントごとに自動調整します。上限に達した呼び出しは
+クライアント側で待機し、AI Gateway には送りません。
+
+- aimd: 応答時間が平常（長期平均の latency_tolerance 倍以内）なら上限を 1 往復あたり +1、
+  429・5xx・接続エラー・応答時間の悪化では上限に backoff を掛けて減らします。
+- gradient: 短期平均と長期平均の応答時間の比（勾配）で上限を増減し、
+  待ち行列の余裕として √limit を加えます。429 等では aimd と同様に減らします。
+
+いずれも上限まで使われていない間は上限を増やしません。現在の上限・実行中・待機中の件数と
+待機時間をメトリクスとして出力します。
+
+使用方法:
+    python test_chat_completions.py --coalesce 50 --adaptive-concurrency aimd
+    python concurrency.py --capacity 10 --algorithm gradient   # 模擬サーバーで収束を確認
+"""
+
+import argparse
+import math
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+import metrics
+
+ALGORITHMS = ("aimd", "gradient")
+
+# 待機時間のバケット（待ちがない場合の 1ms 未満から区別する）
+QUEUE_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# model を伴わない呼び出し（ポーリング等）のデプロイメント名
+ANY_DEPLOYMENT = "*"
+
+
+class Slot:
+    """acquire() で確保した 1 件分の実行枠"""
+
+    __slots__ = ("started", "latency")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # 応答時間（ストリーミングで枠を保持し続ける場合に、応答ヘッダー到着時点で記録）
+        self.latency: Optional[float] = None
+
+
+class AdaptiveLimiter:
+    """1 つのデプロイメントの同時実行数を調整するリミッター"""
+
+    def __init__(
+        self,
+        name: str,
+        algorithm: str = "aimd",
+        initial_limit: float = 10,
+        min_limit: float = 1,
+        max_limit: float = 200,
+        backoff: float = 0.9,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.2,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm は {', '.join(ALGORITHMS)} のいずれかです: {algorithm}")
+        self.name = name
+        self.algorithm = algorithm
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.inflight = 0
+        self.queued = 0
+        self.throttled = 0
+        # 応答時間の長期平均（平常時の基準）と短期平均
+        self.long_latency: Optional[float] = None
+        self.short_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+        registry = registry or metrics.get_registry()
+        self._limit_gauge = registry.gauge(
+            "aigateway_concurrency_limit", "現在の同時実行数の上限", ("deployment",)
+        )
+        self._inflight_gauge = registry.gauge(
+            "aigateway_concurrency_inflight", "実行中の呼び出し数", ("deployment",)
+        )
+        self._queue_gauge = registry.gauge(
+            "aigateway_concurrency_queue", "上限に達して待機中の呼び出し数", ("deployment",)
+        )
+        self._wait = registry.histogram(
+            "aigateway_concurrency_wait_seconds",
+            "実行枠を確保するまでの待機時間",
+            ("deployment",),
+            buckets=QUEUE_TIME_BUCKETS,
+        )
+        self._limit_gauge.set(self.limit, deployment=name)
+
+    def acquire(self, timeout: Optional[float] = None) -> Slot:
+        """実行枠を確保（timeout 秒以内に確保できなければ TimeoutError）"""
+        start = time.perf_counter()
+        with self._cond:
+            if self.inflight >= int(self.limit):
+                self.queued += 1
+                self._queue_gauge.set(self.queued, deployment=self.name)
+                try:
+                    if not self._cond.wait_for(lambda: self.inflight < int(self.limit), timeout):
+                        raise TimeoutError(f"{self.name} の実行枠を {timeout} 秒以内に確保できませんでした")
+                finally:
+                    self.queued -= 1
+                    self._queue_gauge.set(self.queued, deployment=self.name)
+            self.inflight += 1
+            self._inflight_gauge.set(self.inflight, deployment=self.name)
+        self._wait.observe(time.perf_counter() - start, deployment=self.name)
+        return Slot()
+
+    def release(self, slot: Slot, throttled: bool = False, failed: bool = False) -> None:
+        """実行枠を返却し、結果（429 / 失敗 / 応答時間）を上限に反映"""
+        latency = slot.latency if slot.latency is not None else time.perf_counter() - slot.started
+        with self._cond:
+            # 上限まで使われていたか（使われていなければ上限は増やさない）
+            saturated = self.inflight >= int(self.limit) or self.queued > 0
+            self.inflight -= 1
+            if throttled:
+                self.throttled += 1
+            if throttled or failed:
+                self._decrease(latency)
+            else:
+                self._observe_latency(latency)
+                if self.algorithm == "aimd":
+                    self._update_aimd(latency, saturated)
+                else:
+                    self._update_gradient(saturated)
+            self._limit_gauge.set(self.limit, deployment=self.name)
+            self._inflight_gauge.set(self.inflight, deployment=self.name)
+            self._cond.notify_all()
+
+    def _observe_latency(self, latency: float) -> None:
+        if self.long_latency is None:
+            self.long_latency = self.short_latency = latency
+            return
+        self.short_latency += 0.3 * (latency - self.short_latency)
+        self.long_latency += 0.02 * (latency - self.long_latency)
+
+    def _decrease(self, latency: float) -> None:
+        # 同じ混雑で何度も減らさないよう、減少は 1 往復（直近の応答時間）に 1 回まで
+        now = time.monotonic()
+        if now - self._last_decrease < (self.short_latency or latency):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    def _update_aimd(self, latency: float, saturated: bool) -> None:
+        if latency > self.latency_tolerance * self.long_latency:
+            self._decrease(latency)
+        elif saturated:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def _update_gradient(self, saturated: bool) -> None:
+        gradient = max(0.5, min(1.0, self.latency_tolerance * self.long_latency / self.short_latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        if not saturated:
+            target = min(target, self.limit)
+        # 1 往復（limit 件の完了）で smoothing 分だけ目標に近づける
+        limit = self.limit + (target - self.limit) * self.smoothing / self.limit
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+
+class ConcurrencyLimits:
+    """デプロイメントごとのリミッターの集合（全クライアントで共有）"""
+
+    def __init__(
+        self,
+        algorithm: str = "aimd",
+        initial_limit: float = 10,
+        min_limit: float = 1,
+        max_limit: float = 200,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm は {', '.join(ALGORITHMS)} のいずれかです: {algorithm}")
+        self.algorithm = algorithm
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.registry = registry
+        self._limiters: dict[str, AdaptiveLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, deployment: Optional[str]) -> AdaptiveLimiter:
+        """リミッターを取得（なければ initial_limit で作成）"""
+        name = deployment or ANY_DEPLOYMENT
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(name)
+                if limiter is None:
+                    limiter = self._limiters[name] = AdaptiveLimiter(
+                        name,
+                        self.algorithm,
+                        self.initial_limit,
+                        self.min_limit,
+                        self.max_limit,
+                        registry=self.registry,
+                    )
+        return limiter
+
+    def report(self) -> list[dict]:
+        """デプロイメントごとの上限と応答時間"""
+        return [
+            {
+                "deployment": name,
+                "limit": limiter.limit,
+                "inflight": limiter.inflight,
+                "queued": limiter.queued,
+                "throttled": limiter.throttled,
+                "latency": limiter.long_latency,
+            }
+            for name, limiter in sorted(self._limiters.items())
+        ]
+
+    def print_report(self) -> None:
+        """レポートを表形式で出力"""
+        print(f"\nConcurrency ({self.algorithm}):")
+        for row in self.report():
+            latency = f"{row['latency']:.2f}s" if row["latency"] is not None else "-"
+            print(
+                f"  - {row['deployment']}: limit={row['limit']:.1f}, "
+                f"latency={latency}, 429={row['throttled']}"
+            )
+
+
+def add_concurrency_arguments(parser: argparse.ArgumentParser) -> None:
+    """適応型同時実行数制限用の CLI 引数を追加"""
+    group = parser.add_argument_group("concurrency")
+    group.add_argument(
+        "--adaptive-concurrency",
+        choices=ALGORITHMS,
+        default=os.getenv("AIGATEWAY_ADAPTIVE_CONCURRENCY") or None,
+        help="同時実行数の上限を自動調整（環境変数 AIGATEWAY_ADAPTIVE_CONCURRENCY）",
+    )
+    group.add_argument(
+        "--initial-concurrency",
+        type=float,
+        default=10,
+        help="同時実行数の上限の初期値 (default: 10)",
+    )
+    group.add_argument(
+        "--max-concurrency",
+        type=float,
+        default=200,
+        help="同時実行数の上限の最大値 (default: 200)",
+    )
+
+
+def create_limits(args: argparse.Namespace) -> Optional[ConcurrencyLimits]:
+    """CLI 引数に応じてリミッターを作成（無効なら None）"""
+    if not args.adaptive_concurrency:
+        return None
+    return ConcurrencyLimits(
+        args.adaptive_concurrency,
+        initial_limit=args.initial_concurrency,
+        max_limit=args.max_concurrency,
+    )
+
+
+class SimulatedDeployment:
+    """容量 capacity の模擬デプロイメント（超過分は待たされ、大きく超えると 429）"""
+
+    def __init__(self, capacity: int, service_time: float, throttle_factor: float = 1.5):
+        self.capacity = capacity
+        self.service_time = service_time
+        self.throttle_factor = throttle_factor
+        self.inflight = 0
+        self.peak = 0
+        self._slots = threading.Semaphore(capacity)
+        self._lock = threading.Lock()
+
+    def call(self) -> int:
+        with self._lock:
+            if self.inflight >= self.capacity * self.throttle_factor:
+                return 429
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+        try:
+            with self._slots:
+                time.sleep(self.service_time * random.uniform(0.8, 1.2))
+            return 200
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="適応型同時実行数制限の収束を模擬サーバーで確認",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python concurrency.py
+  python concurrency.py --capacity 10 --algorithm gradient
+  python concurrency.py --capacity 30 --clients 100 --duration 20
+        """
+    )
+    parser.add_argument("--algorithm", choices=ALGORITHMS, default="aimd", help="アルゴリズム (default: aimd)")
+    parser.add_argument("--capacity", type=int, default=10, help="模擬デプロイメントの同時処理数 (default: 10)")
+    parser.add_argument("--clients", type=int, default=64, help="呼び出し元のスレッド数 (default: 64)")
+    parser.add_argument("--duration", "-d", type=float, default=10.0, help="実行時間（秒） (default: 10)")
+    parser.add_argument("--service-time", type=float, default=0.05, help="1 件の処理時間（秒） (default: 0.05)")
+    parser.add_argument("--initial-limit", type=float, default=2, help="上限の初期値 (default: 2)")
+    args = parser.parse_args()
+
+    deployment = SimulatedDeployment(args.capacity, args.service_time)
+    limiter = AdaptiveLimiter("simulated", args.algorithm, initial_limit=args.initial_limit)
+    deadline = time.monotonic() + args.duration
+    counts = {200: 0, 429: 0}
+    counts_lock = threading.Lock()
+
+    def client() -> None:
+        while time.monotonic() < deadline:
+            slot = limiter.acquire()
+            status = deployment.call()
+            limiter.release(slot, throttled=status == 429)
+            with counts_lock:
+                counts[status] += 1
+            if status == 429:
+                # retry-after 相当の待機
+                time.sleep(args.service_time)
+
+    print(f"Algorithm: {args.algorithm}, capacity: {args.capacity}, clients: {args.clients}")
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    while time.monotonic() < deadline:
+        time.sleep(1.0)
+        print(
+            f"   limit={limiter.limit:6.1f}  inflight={limiter.inflight:3d}  "
+            f"queued={limiter.queued:3d}  ok={counts[200]}  429={counts[429]}",
+            flush=True,
+        )
+    for thread in threads:
+        thread.join()
+
+    print(f"\n{'='*60}")
+    print(f"Final limit: {limiter.limit:.1f} (capacity {args.capacity})")
+    print(f"Throughput:  {counts[200] / args.duration:.1f} req/s "
+          f"(ideal {args.capacity / args.service_time:.1f} req/s)")
+    print(f"429:         {counts[429]} ({counts[429] / max(1, sum(counts.values())):.1%})")
+
+
+if __name__ == "__main__":
+    main()
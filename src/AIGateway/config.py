@@ -5,8 +5,9 @@ AI Gateway 設定モジュール
 """
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Optional
 
 from dotenv import load_dotenv
 
@@ -23,6 +24,22 @@ class AIGatewayConfig:
     api_key: str
     default_model: str
     api_version: str
+    # ヘッジ / フォールバック先のデプロイメント（例: gpt-4o-mini）
+    fallback_model: Optional[str] = None
+    # ルーティング対象のデプロイメント一覧
+    deployments: list[str] = field(default_factory=list)
+    # モデル別コスト表（JSON ファイル、任意）
+    cost_table_path: Optional[str] = None
+    # 負荷分散するサブスクリプションキー一覧（先頭は api_key と同じ）
+    api_keys: list[str] = field(default_factory=list)
+    
+    def __post_init__(self):
+        if not self.api_keys:
+            self.api_keys = [self.api_key]
+        if not self.deployments:
+            self.deployments = [self.default_model]
+            if self.fallback_model and self.fallback_model != self.default_model:
+                self.deployments.append(self.fallback_model)
     
     @property
     def base_url_chat(self) -> str:
@@ -47,7 +64,11 @@ def load_config() -> AIGatewayConfig:
     """環境変数から設定を読み込み"""
     
     apim_endpoint = os.getenv("APIM_ENDPOINT")
-    api_key = os.getenv("APIM_API_KEY")
+    # 複数のサブスクリプションキー（カンマ区切り）を指定すると key_pool.py で負荷分散
+    api_keys = [k.strip() for k in os.getenv("APIM_API_KEYS", "").split(",") if k.strip()]
+    api_key = os.getenv("APIM_API_KEY") or (api_keys[0] if api_keys else None)
+    if api_keys and api_key not in api_keys:
+        api_keys.insert(0, api_key)
     
     if not apim_endpoint:
         raise ValueError(
@@ -58,7 +79,7 @@ def load_config() -> AIGatewayConfig:
     
     if not api_key:
         raise ValueError(
-            "APIM_API_KEY が設定されていません。\n"
+            "APIM_API_KEY（または APIM_API_KEYS）が設定されていません。\n"
             "Azure Portal → APIM → Subscriptions でキーを確認してください。"
         )
     
@@ -66,7 +87,11 @@ def load_config() -> AIGatewayConfig:
         apim_endpoint=apim_endpoint.rstrip("/"),
         api_key=api_key,
         default_model=os.getenv("DEFAULT_MODEL", "gpt-4o"),
-        api_version=os.getenv("API_VERSION", "2025-03-01-preview")
+        api_version=os.getenv("API_VERSION", "2025-03-01-preview"),
+        fallback_model=os.getenv("FALLBACK_MODEL") or None,
+        deployments=[d.strip() for d in os.getenv("DEPLOYMENTS", "").split(",") if d.strip()],
+        cost_table_path=os.getenv("MODEL_COST_TABLE") or None,
+        api_keys=api_keys
     )
 
 
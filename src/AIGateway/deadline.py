@@ -0,0 +1,145 @@
+"""
+デッドライン伝播モジュール
+
+1 つの時間予算（デッドライン）から、HTTP タイムアウト・リトライ・順番待ち・ポーリングの
+待ち時間をすべて導きます。
+
+- within(seconds): with ブロック内の呼び出しにデッドラインを設定します（contextvars で伝播）。
+  入れ子にした場合は早い方が有効で、外側の予算を延ばすことはできません。
+- クライアントの deadline（--deadline）を設定すると、各呼び出しにその秒数の予算を付けます。
+- 期限を過ぎると DeadlineExceeded（TimeoutError のサブクラス）を送出します。
+- wait_for_response / wait_for_run は期限切れや中断（Ctrl+C 等）で結果を待たなくなった時点で
+  cancel_response / cancel_run を呼び、サーバー側での生成を止めます。
+  キャンセルで節約できた出力トークン数（推定）をメトリクスに記録します。
+
+別スレッドで実行する処理に引き継ぐ場合は contextvars.copy_context().run を使用してください。
+"""
+
+import argparse
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+import metrics
+from tokens import DEFAULT_EXPECTED_OUTPUT_TOKENS
+
+# 期限切れ後のキャンセル等の後片付けに使う予算（秒）
+CLEANUP_BUDGET = 10.0
+
+
+class DeadlineExceeded(TimeoutError):
+    """デッドラインを過ぎた"""
+
+
+class Deadline:
+    """単調時計上の期限"""
+
+    __slots__ = ("expires_at", "budget")
+
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """残り秒数（期限切れなら 0）"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, message: Optional[str] = None) -> None:
+        """期限切れなら DeadlineExceeded を送出"""
+        if self.expired():
+            raise DeadlineExceeded(message or f"デッドライン（{self.budget:g} 秒）を過ぎました")
+
+    def allows(self, delay: float) -> bool:
+        """delay 秒待ってもまだ時間が残るか（リトライ可否の判定）"""
+        return self.expires_at - time.monotonic() > delay
+
+    def sleep(self, seconds: float) -> None:
+        """期限を超えない範囲で待機"""
+        time.sleep(min(seconds, self.remaining()))
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("aigateway_deadline", default=None)
+
+
+def current() -> Optional[Deadline]:
+    """現在のコンテキストのデッドライン（なければ None）"""
+    return _current.get()
+
+
+def start(seconds: Optional[float]) -> Optional[Deadline]:
+    """現在のデッドラインと seconds 秒後のうち早い方（どちらもなければ None）"""
+    parent = _current.get()
+    if seconds is None:
+        return parent
+    deadline = Deadline(seconds)
+    if parent is not None and parent.expires_at <= deadline.expires_at:
+        return parent
+    return deadline
+
+
+@contextmanager
+def within(seconds: Optional[float]) -> Iterator[Optional[Deadline]]:
+    """with ブロック内の呼び出しに seconds 秒のデッドラインを設定（None なら現在のまま）"""
+    deadline = start(seconds)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def shielded(seconds: float = CLEANUP_BUDGET) -> Iterator[Deadline]:
+    """外側のデッドラインを無視して新しい予算で実行（期限切れ後の後片付け用）"""
+    deadline = Deadline(seconds)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def record_exceeded(api: str, operation: str) -> None:
+    """デッドライン超過を記録"""
+    metrics.get_registry().counter(
+        "aigateway_deadline_exceeded_total",
+        "デッドラインを過ぎて失敗した呼び出し数",
+        ("api", "operation"),
+    ).inc(api=api, operation=operation)
+
+
+def record_cancellation(api: str, tokens_saved: int) -> None:
+    """期限切れ・中断によるキャンセルと、節約できた出力トークン数（推定）を記録"""
+    registry = metrics.get_registry()
+    registry.counter(
+        "aigateway_deadline_cancellations_total",
+        "期限切れ・中断で自動キャンセルしたバックグラウンド処理の数",
+        ("api",),
+    ).inc(api=api)
+    registry.counter(
+        "aigateway_deadline_tokens_saved_total",
+        "自動キャンセルで生成を止めた出力トークン数（推定）",
+        ("api",),
+    ).inc(tokens_saved, api=api)
+
+
+def estimate_tokens_saved(max_output_tokens: Optional[int], output_tokens: Optional[int]) -> int:
+    """キャンセル時点の出力トークン数から、生成されずに済んだ出力トークン数を推定"""
+    expected = max_output_tokens or DEFAULT_EXPECTED_OUTPUT_TOKENS
+    return max(0, expected - (output_tokens or 0))
+
+
+def add_deadline_arguments(parser: argparse.ArgumentParser) -> None:
+    """デッドライン用の CLI 引数を追加"""
+    value = os.getenv("AIGATEWAY_DEADLINE")
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=float(value) if value else None,
+        help="各呼び出しの時間予算（秒、タイムアウト・リトライ・待機を含む。環境変数 AIGATEWAY_DEADLINE）",
+    )
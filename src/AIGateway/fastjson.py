@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+高速 JSON モジュール
+
+raw HTTP クライアント（Responses / Assistants / Batch API）の JSON 処理を軽くします。
+
+- バックエンド: orjson がインストールされていれば使用し、なければ標準の json を使います
+  （AIGATEWAY_JSON_BACKEND=json で標準 json に固定）。
+- ResponseView: レスポンス本文（bytes）を保持する読み取り専用の Mapping です。
+  ステータスのポーリング等で先頭付近のスカラー値（"status" 等）だけを読む場合は、
+  output / usage 等の大きな値をデコードせずにその値だけを取り出します。
+- BodyTemplate: 毎回同じ部分（model / instructions / store 等）を事前にエンコードしておき、
+  可変部分だけをエンコードして連結します。
+
+使用方法:
+    python fastjson.py            # マイクロベンチマーク
+    python fastjson.py --iterations 20000
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+from collections.abc import Mapping
+from typing import Any, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+_BACKENDS = {"json": (json.loads, _stdlib_dumps)}
+if orjson is not None:
+    _BACKENDS["orjson"] = (orjson.loads, orjson.dumps)
+
+BACKEND = ""
+loads = json.loads
+dumps = _stdlib_dumps
+
+
+def set_backend(name: str) -> None:
+    """JSON バックエンドを切り替え（"orjson" / "json"）"""
+    global BACKEND, loads, dumps
+    if name not in _BACKENDS:
+        raise ValueError(f"JSON バックエンド {name} は利用できません（利用可能: {', '.join(_BACKENDS)}）")
+    BACKEND = name
+    loads, dumps = _BACKENDS[name]
+
+
+set_backend(os.getenv("AIGATEWAY_JSON_BACKEND") or ("orjson" if orjson is not None else "json"))
+
+
+# 文字列リテラル（開始の '"' 以降、エスケープを含む）
+_STRING_REST = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"')
+_WHITESPACE = b" \t\r\n"
+_MISSING = object()
+
+
+class ResponseView(Mapping):
+    """
+    JSON オブジェクトの遅延デコードビュー
+
+    トップレベルのスカラー値（id / status / model 等）は、そこまでにネストした値がなければ
+    本文全体をデコードせずにその値だけを取り出します。それ以外のアクセスでは 1 回だけ
+    全体をデコードしてキャッシュします。値は通常の dict / list / スカラーです。
+    """
+
+    __slots__ = ("raw", "_values", "_decoded")
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._values: dict[str, Any] = {}
+        self._decoded: Optional[dict] = None
+
+    def _lookup_flat(self, key: str) -> Any:
+        """先頭からネストなしで到達できるスカラー値を取得（取れなければ _MISSING）"""
+        raw = self.raw
+        needle = b'"' + key.encode("utf-8") + b'"'
+        pos = raw.find(needle)
+        if pos <= 0 or raw[pos - 1] == 0x5C:  # '\\'
+            return _MISSING
+        opening = raw.find(b"{")
+        if raw.find(b"{", opening + 1, pos) != -1 or raw.find(b"[", opening + 1, pos) != -1:
+            return _MISSING
+        end = len(raw)
+        pos += len(needle)
+        while pos < end and raw[pos] in _WHITESPACE:
+            pos += 1
+        if pos >= end or raw[pos] != 0x3A:  # ':'（キーではなく値として出現）
+            return _MISSING
+        pos += 1
+        while pos < end and raw[pos] in _WHITESPACE:
+            pos += 1
+        if pos >= end:
+            return _MISSING
+        first = raw[pos]
+        if first == 0x22:  # '"'
+            m = _STRING_REST.match(raw, pos + 1)
+            if m is None:
+                return _MISSING
+            stop = m.end()
+        elif first in (0x7B, 0x5B):  # '{' '['
+            return _MISSING
+        else:
+            stop = raw.find(b",", pos)
+            if stop == -1:
+                stop = raw.find(b"}", pos)
+        return loads(raw[pos:stop])
+
+    def _decode(self) -> dict:
+        if self._decoded is None:
+            self._decoded = loads(self.raw)
+        return self._decoded
+
+    def __getitem__(self, key: str) -> Any:
+        if self._decoded is not None:
+            return self._decoded[key]
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._lookup_flat(key)
+        if value is _MISSING:
+            return self._decode()[key]
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        if self._decoded is None and key in self._values:
+            return True
+        return key in self._decode()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._decode())
+
+    def __len__(self) -> int:
+        return len(self._decode())
+
+    def to_dict(self) -> dict:
+        """全体をデコードした dict"""
+        return self._decode()
+
+    def __repr__(self) -> str:
+        state = "decoded" if self._decoded is not None else f"fields={list(self._values)}"
+        return f"ResponseView({len(self.raw)} bytes, {state})"
+
+
+class Encoded:
+    """エンコード済みの JSON 本文と、その元の値"""
+
+    __slots__ = ("data", "source")
+
+    def __init__(self, data: bytes, source: Any):
+        self.data = data
+        self.source = source
+
+
+class BodyTemplate:
+    """
+    固定部分を事前にエンコードしたリクエスト本文テンプレート
+
+    render() は可変部分だけをエンコードして連結し、キー順は固定部分 → 可変部分です。
+    （固定部分を先頭に置くと、プロンプトキャッシュのプレフィックスも安定します）
+    """
+
+    def __init__(self, fixed: dict):
+        self.fixed = dict(fixed)
+        encoded = dumps(self.fixed)
+        # 末尾の "}" を除いたプレフィックス
+        self._prefix = encoded[:-1]
+        self._separator = b"," if self.fixed else b""
+        self._keys: dict[str, bytes] = {}
+
+    def _key(self, key: str) -> bytes:
+        encoded = self._keys.get(key)
+        if encoded is None:
+            encoded = self._keys[key] = dumps(key) + b":"
+        return encoded
+
+    def render(self, **values: Any) -> Encoded:
+        """可変部分（None は省略）を埋め込んだ本文"""
+        parts = [self._prefix]
+        separator = self._separator
+        for key, value in values.items():
+            if value is None:
+                continue
+            parts.append(separator)
+            parts.append(self._key(key))
+            parts.append(dumps(value))
+            separator = b","
+        parts.append(b"}")
+        source = {**self.fixed, **{k: v for k, v in values.items() if v is not None}}
+        return Encoded(b"".join(parts), source)
+
+
+def encode(obj: Any) -> Encoded:
+    """dict をエンコード（Encoded はそのまま返す）"""
+    if isinstance(obj, Encoded):
+        return obj
+    return Encoded(dumps(obj), obj)
+
+
+def _sample_response(output_chars: int) -> bytes:
+    """ベンチマーク用の Responses API レスポンス"""
+    text = "Azure AI Foundry は AI アプリケーションとエージェントを構築するためのプラットフォームです。"
+    body = {
+        "id": "resp_67ccd2bed1ec8190b14f964abc0542670bb6a6b452d3795b",
+        "object": "response",
+        "created_at": 1741476542,
+        "status": "completed",
+        "background": False,
+        "error": None,
+        "incomplete_details": None,
+        "instructions": "あなたは親切なアシスタントです。" * 40,
+        "max_output_tokens": None,
+        "model": "gpt-4o",
+        "output": [
+            {
+                "type": "reasoning",
+                "id": "rs_1",
+                "summary": [],
+            },
+            {
+                "type": "message",
+                "id": "msg_67ccd2bf17f0819081ff3bb2cf6508e60bb6a6b452d3795b",
+                "status": "completed",
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "output_text",
+                        "text": (text * (output_chars // len(text) + 1))[:output_chars],
+                        "annotations": [],
+                    }
+                ],
+            },
+        ],
+        "parallel_tool_calls": True,
+        "previous_response_id": None,
+        "store": True,
+        "temperature": 1.0,
+        "tools": [
+            {"type": "function", "name": f"tool_{i}", "parameters": {"type": "object", "properties": {}}}
+            for i in range(10)
+        ],
+        "usage": {
+            "input_tokens": 1200,
+            "input_tokens_details": {"cached_tokens": 1024},
+            "output_tokens": 300,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": 1500,
+        },
+        "metadata": {},
+    }
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def _bench(fn, iterations: int) -> float:
+    """1 回あたりの実行時間（µs）"""
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def _extract_text(response: Mapping) -> str:
+    texts = []
+    for output in response.get("output", []):
+        if output.get("type") == "message":
+            for content in output.get("content", []):
+                if content.get("type") == "output_text":
+                    texts.append(content.get("text", ""))
+    return "\n".join(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="JSON 処理のマイクロベンチマーク",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python fastjson.py
+  python fastjson.py --iterations 20000 --output-chars 8000
+        """
+    )
+    parser.add_argument("--iterations", "-n", type=int, default=5000, help="繰り返し回数 (default: 5000)")
+    parser.add_argument("--output-chars", type=int, default=2000, help="出力テキストの文字数 (default: 2000)")
+    args = parser.parse_args()
+
+    raw = _sample_response(args.output_chars)
+    n = args.iterations
+    backend = BACKEND
+
+    print(f"Backend: {backend}{'' if orjson else ' (pip install orjson で高速化)'}")
+    print(f"Payload: {len(raw):,} bytes, iterations: {n}")
+
+    print(f"\n{'='*60}")
+    print("ステータス確認（ポーリング）")
+    print(f"{'='*60}")
+    baseline = _bench(lambda: json.loads(raw)["status"], n)
+    full = _bench(lambda: loads(raw)["status"], n)
+    lazy = _bench(lambda: ResponseView(raw)["status"], n)
+    print(f"  json.loads (全体)      : {baseline:8.2f} µs")
+    if backend != "json":
+        print(f"  {backend}.loads (全体){' ' * (10 - len(backend))}: {full:8.2f} µs")
+    print(f"  ResponseView (status)  : {lazy:8.2f} µs  ({baseline / lazy:.1f}x)")
+
+    print(f"\n{'='*60}")
+    print("テキスト出力 + usage の取得")
+    print(f"{'='*60}")
+
+    def read_stdlib():
+        body = json.loads(raw)
+        return _extract_text(body), body["usage"]
+
+    def read_view():
+        view = ResponseView(raw)
+        return _extract_text(view), view["usage"]
+
+    assert read_stdlib() == read_view()
+    baseline = _bench(read_stdlib, n)
+    lazy = _bench(read_view, n)
+    print(f"  json.loads (全体)      : {baseline:8.2f} µs")
+    print(f"  ResponseView           : {lazy:8.2f} µs  ({baseline / lazy:.1f}x)")
+
+    print(f"\n{'='*60}")
+    print("リクエスト本文のエンコード")
+    print(f"{'='*60}")
+    instructions = "あなたは親切なアシスタントです。" * 40
+    template = BodyTemplate({"model": "gpt-4o", "instructions": instructions, "store": True})
+
+    def encode_stdlib():
+        return json.dumps(
+            {"model": "gpt-4o", "instructions": instructions, "store": True, "input": "こんにちは"}
+        ).encode("utf-8")
+
+    assert loads(template.render(input="こんにちは").data) == json.loads(encode_stdlib())
+    baseline = _bench(encode_stdlib, n)
+    rendered = _bench(lambda: template.render(input="こんにちは"), n)
+    print(f"  json.dumps (全体)      : {baseline:8.2f} µs")
+    print(f"  BodyTemplate.render    : {rendered:8.2f} µs  ({baseline / rendered:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,757 @@
+"""
+AI Gateway クライアント共通モジュール
+
+Responses API / Assistants API 用の raw HTTP クライアント基底クラスと、
+Chat Completions（OpenAI SDK）呼び出しのラッパーを提供します。
+HTTP 呼び出しはすべてここを通るため、テレメトリ・メトリクス・リトライ等の
+横断的な処理はここに集約します。
+"""
+
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional, Union
+
+import openai
+import requests
+from openai import AzureOpenAI
+from requests.adapters import HTTPAdapter
+
+import deadline
+import fastjson
+import profiling
+import telemetry
+import tokens
+from circuit_breaker import CircuitBreakers
+from concurrency import ConcurrencyLimits, Slot
+from config import AIGatewayConfig
+from key_pool import KeyLease, KeyPool
+from router import AUTO_MODEL, ModelRouter
+from scheduler import Scheduler
+from singleflight import SingleFlight, request_key
+
+# リトライ対象の HTTP ステータス
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# ホストあたりに保持する接続数の既定値（requests の既定と同じ）
+DEFAULT_POOL_SIZE = 10
+
+# パス中の ID（resp_xxx, thread_xxx, run_xxx, file-xxx 等）をルートテンプレートに置換
+_ID_SEGMENT = re.compile(r"/(?:[A-Za-z]+_|file-)[A-Za-z0-9\-]+")
+
+
+def route_of(method: str, path: str) -> str:
+    """メトリクス・スパン名用の低カーディナリティなルート（例: "GET /responses/{id}"）"""
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+
+@dataclass
+class RequestEvent:
+    """1 回のクライアント呼び出し（リトライ込み）の結果"""
+
+    api: str
+    operation: str
+    model: Optional[str]
+    status_code: Optional[int]
+    duration: float
+    ttft: Optional[float] = None
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    throttled: int = 0
+    retries: int = 0
+    error: Optional[str] = None
+    # 送信内容（トラフィックの記録・再生用）
+    started_at: Optional[float] = None
+    path: Optional[str] = None
+    body: Optional[dict] = None
+    # フェーズ別の所要時間（秒、--profile 時のみ。profiling.PHASES を参照）
+    phases: Optional[dict] = None
+
+
+_request_hooks: list[Callable[[RequestEvent], None]] = []
+
+
+def add_request_hook(hook: Callable[[RequestEvent], None]) -> None:
+    """呼び出し完了ごとに RequestEvent を受け取るフックを登録"""
+    _request_hooks.append(hook)
+
+
+def _emit(event: RequestEvent) -> None:
+    for hook in _request_hooks:
+        hook(event)
+
+
+def _usage_event_fields(body: Any) -> dict:
+    """レスポンスから usage 関連フィールドを抽出"""
+    usage = telemetry.get_field(body, "usage")
+    input_tokens, output_tokens = telemetry.usage_tokens(usage)
+    details = telemetry.get_field(usage, "input_tokens_details") or telemetry.get_field(
+        usage, "prompt_tokens_details"
+    )
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_tokens": telemetry.get_field(details, "cached_tokens"),
+    }
+
+
+def total_tokens(body: Any) -> Optional[int]:
+    """レスポンスの usage の入力 + 出力トークン数（なければ None）"""
+    input_tokens, output_tokens = telemetry.usage_tokens(telemetry.get_field(body, "usage"))
+    if input_tokens is None and output_tokens is None:
+        return None
+    return (input_tokens or 0) + (output_tokens or 0)
+
+
+def _sum_tokens(event: RequestEvent) -> Optional[int]:
+    if event.input_tokens is None and event.output_tokens is None:
+        return None
+    return (event.input_tokens or 0) + (event.output_tokens or 0)
+
+
+def create_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """接続を再利用する HTTP セッションを作成（リトライは GatewayClient 側で行う）"""
+    session = requests.Session()
+    # --profile 時は接続・送信・応答待ちを計測するアダプターを使う
+    adapter_class = profiling.ProfilingAdapter if profiling.active() else HTTPAdapter
+    adapter = adapter_class(pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def resolve_model(
+    endpoint: str,
+    model: str,
+    router: Optional[ModelRouter],
+    breakers: Optional[CircuitBreakers],
+    route: Callable[[set], str],
+) -> str:
+    """
+    送信先デプロイメントを決定
+
+    model="auto" の場合と、指定されたデプロイメントの回路が開いている場合は
+    route(回路が開いているデプロイメント) でルーターに選ばせます。
+    """
+    unavailable = breakers.open_deployments(endpoint) if breakers is not None else set()
+    if model == AUTO_MODEL:
+        if router is None:
+            raise ValueError('model="auto" を使うには router を設定してください')
+        return route(unavailable)
+    if model in unavailable and router is not None:
+        rerouted = route(unavailable)
+        if rerouted not in unavailable:
+            breakers.record_reroute(endpoint, model)
+            return rerouted
+    return model
+
+
+@dataclass
+class RetryPolicy:
+    """429 / 5xx に対するリトライ方針（retry-after ヘッダーを優先）"""
+
+    max_retries: int = 2
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+
+    def delay(self, attempt: int, headers: Optional[Any] = None) -> float:
+        """attempt 回目（0 始まり）のリトライまでの待機秒数"""
+        if headers is not None:
+            for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+                value = headers.get(name)
+                if value:
+                    try:
+                        return min(float(value) * scale, self.backoff_max)
+                    except ValueError:
+                        pass
+        backoff = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+        return backoff * (0.5 + random.random() / 2)
+
+
+class GatewayClient:
+    """AI Gateway 向け raw HTTP クライアントの基底クラス"""
+
+    # メトリクスの api ラベル
+    api_name = "gateway"
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        api_version: str,
+        retry_policy: Optional[RetryPolicy] = None,
+        single_flight: Optional[SingleFlight] = None,
+        router: Optional[ModelRouter] = None,
+        circuit_breakers: Optional[CircuitBreakers] = None,
+        concurrency_limits: Optional[ConcurrencyLimits] = None,
+        scheduler: Optional[Scheduler] = None,
+        deadline: Optional[float] = None,
+        key_pool: Optional[KeyPool] = None,
+    ):
+        self.base_url = base_url
+        self.api_version = api_version
+        self.headers = {
+            "api-key": api_key,
+            "Content-Type": "application/json"
+        }
+        self.retry_policy = retry_policy or RetryPolicy()
+        # 同一内容の同時リクエストを合流させる（None なら無効）
+        self.single_flight = single_flight
+        # model="auto" の送信先を選ぶルーター
+        self.router = router
+        # デプロイメントごとのサーキットブレーカー（None なら無効）
+        self.circuit_breakers = circuit_breakers
+        # デプロイメントごとの適応型同時実行数制限（None なら無効）
+        self.concurrency_limits = concurrency_limits
+        # 優先度クラス付きの送信順制御（None なら無効）
+        self.scheduler = scheduler
+        # 各呼び出しの時間予算（秒、None なら外側の deadline.within() のみ）
+        self.deadline = deadline
+        # 試行ごとに負荷の低いサブスクリプションキーを選ぶ（None なら api_key のみ）
+        self.key_pool = key_pool
+        # 呼び出し間で TCP / TLS 接続を再利用する（warmup.py で事前に開いておける）
+        self.session = create_session()
+
+    def _url(self, path: str) -> str:
+        """API URL を構築（api-version パラメータ付き）"""
+        return f"{self.base_url}{path}?api-version={self.api_version}"
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        json: Optional[Union[dict, fastjson.Encoded]] = None,
+        operation: Optional[str] = None,
+        model: Optional[str] = None,
+        files: Optional[dict] = None,
+        data: Optional[dict] = None,
+        stream: bool = False,
+    ) -> Any:
+        """
+        HTTP リクエストを送信して JSON を返す
+
+        本文は fastjson でエンコードし（BodyTemplate でエンコード済みの本文も可）、
+        レスポンスはアクセスしたフィールドだけをデコードする fastjson.ResponseView で返します。
+        operation を指定すると GenAI スパン（例: "chat gpt-4o"）、
+        省略時は HTTP スパン（例: "GET /responses/{id}"）として記録します。
+        429 / 5xx はリトライポリシーに従って再送します。
+        circuit_breakers が設定されていれば、回路が開いている間は送信せずに
+        CircuitOpenError を送出し、各試行の結果をブレーカーに記録します。
+        concurrency_limits が設定されていれば、各試行は実行枠を確保してから送信します。
+        デッドライン（self.deadline と外側の deadline.within() の早い方）があれば、
+        HTTP タイムアウト・実行枠の待機・リトライはその残り時間に収め、
+        期限を過ぎると DeadlineExceeded を送出します。
+        key_pool が設定されていれば、試行ごとに負荷の低いキーで送信し、429 を受けたキーは
+        クールダウンさせて（他のキーが使えれば待たずに）別のキーでリトライします。
+        files / data を指定すると multipart で送信し、stream=True の場合は
+        JSON ではなく本文未読の requests.Response を返します（呼び出し側で close）。
+        """
+        phases = profiling.start()
+        start = time.perf_counter()
+        with profiling.phase("serialize"):
+            payload = fastjson.encode(json) if json is not None else None
+        request_body = payload.source if payload is not None else None
+        url = self._url(path)
+        route = route_of(method, path)
+        if operation:
+            span = telemetry.gen_ai_span(operation, model, url)
+        else:
+            span = telemetry.start_span(route, telemetry.server_attributes(url))
+
+        event = RequestEvent(
+            api=self.api_name,
+            operation=operation or route,
+            model=model,
+            status_code=None,
+            duration=0.0,
+            started_at=time.time(),
+            path=path,
+            body=request_body,
+        )
+        budget = deadline.start(self.deadline)
+        lease = None
+        try:
+            with span:
+                span.set_attribute("http.request.method", method)
+                if operation and request_body:
+                    telemetry.record_content(span, "gen_ai.input.messages", request_body.get("input"))
+                headers = self.headers
+                if files is not None:
+                    # multipart の Content-Type（boundary 付き）は requests に任せる
+                    headers = {k: v for k, v in headers.items() if k != "Content-Type"}
+                breaker = None
+                if self.circuit_breakers is not None:
+                    breaker = self.circuit_breakers.get(self.api_name, model)
+                limiter = None
+                if self.concurrency_limits is not None:
+                    limiter = self.concurrency_limits.get(model)
+                attempt = 0
+                while True:
+                    if budget is not None:
+                        budget.check(f"{route} がデッドライン（{budget.budget:g} 秒）までに完了しませんでした")
+                    if breaker is not None:
+                        self.circuit_breakers.allow(breaker)
+                    try:
+                        if files is not None:
+                            # リトライ時はアップロードするファイルを先頭に戻す
+                            for value in files.values():
+                                fileobj = value[1] if isinstance(value, tuple) else value
+                                if hasattr(fileobj, "seek"):
+                                    fileobj.seek(0)
+                        timeout = budget.remaining() if budget is not None else None
+                        slot = limiter.acquire(timeout) if limiter is not None else None
+                    except BaseException:
+                        # 送信に至らなかった（実行枠の待機のタイムアウト等）: half_open の試行枠を返す
+                        if breaker is not None:
+                            breaker.release()
+                        raise
+                    lease = self.key_pool.acquire() if self.key_pool is not None else None
+                    attempt_start = time.perf_counter()
+                    try:
+                        response = self.session.request(
+                            method,
+                            url,
+                            headers={**headers, "api-key": lease.key} if lease is not None else headers,
+                            data=payload.data if payload is not None else data,
+                            files=files,
+                            stream=stream,
+                            timeout=budget.remaining() if budget is not None else None,
+                        )
+                    except requests.RequestException as e:
+                        if breaker is not None:
+                            breaker.record(True, time.perf_counter() - attempt_start)
+                        if slot is not None:
+                            limiter.release(slot, failed=True)
+                        if lease is not None:
+                            self.key_pool.release(lease)
+                        if isinstance(e, requests.Timeout) and budget is not None and budget.expired():
+                            raise deadline.DeadlineExceeded(
+                                f"{route} がデッドライン（{budget.budget:g} 秒）までに完了しませんでした"
+                            ) from e
+                        raise
+                    except BaseException:
+                        # 想定外の例外（中断等）でも試行枠・実行枠・キーを返す
+                        if breaker is not None:
+                            breaker.release()
+                        if slot is not None:
+                            limiter.release(slot)
+                        if lease is not None:
+                            self.key_pool.release(lease)
+                        raise
+                    if breaker is not None:
+                        breaker.record(
+                            response.status_code >= 500, time.perf_counter() - attempt_start
+                        )
+                    if slot is not None:
+                        limiter.release(
+                            slot,
+                            throttled=response.status_code == 429,
+                            failed=response.status_code >= 500,
+                        )
+                    if lease is not None and response.status_code >= 400:
+                        # 失敗した試行はここで記録（成功時は usage を読んでから記録）
+                        self.key_pool.release(lease, response.status_code, headers=response.headers)
+                    event.status_code = response.status_code
+                    if response.status_code == 429:
+                        event.throttled += 1
+                    if (
+                        response.status_code not in RETRYABLE_STATUS
+                        or attempt >= self.retry_policy.max_retries
+                    ):
+                        break
+                    delay = self.retry_policy.delay(attempt, response.headers)
+                    if response.status_code == 429 and lease is not None and self.key_pool.available():
+                        # クールダウン中でないキーが残っていれば待たずに切り替える
+                        delay = 0.0
+                    if budget is not None and not budget.allows(delay):
+                        # リトライを待つ時間が残っていない
+                        break
+                    response.close()
+                    time.sleep(delay)
+                    attempt += 1
+                    event.retries = attempt
+
+                span.set_attribute("http.response.status_code", response.status_code)
+                if event.retries:
+                    span.set_attribute("aigateway.retries", event.retries)
+                response.raise_for_status()
+                if stream:
+                    return response
+                with profiling.phase("parse"):
+                    body = fastjson.ResponseView(response.content)
+                    if operation:
+                        if span.is_recording():
+                            telemetry.set_response_attributes(span, body)
+                            telemetry.record_content(span, "gen_ai.output.messages", body.get("output"))
+                        event.model = model or body.get("model")
+                        for key, value in _usage_event_fields(body).items():
+                            setattr(event, key, value)
+                return body
+        except Exception as e:
+            event.error = type(e).__name__
+            if isinstance(e, TimeoutError) and budget is not None and budget.expired():
+                deadline.record_exceeded(self.api_name, event.operation)
+            raise
+        finally:
+            if lease is not None:
+                self.key_pool.release(lease, event.status_code, _sum_tokens(event))
+            event.duration = time.perf_counter() - start
+            event.phases = phases
+            profiling.stop()
+            _emit(event)
+
+
+class ChatClient:
+    """Chat Completions（OpenAI SDK）呼び出しラッパー"""
+
+    api_name = "chat"
+
+    def __init__(
+        self,
+        client: AzureOpenAI,
+        endpoint: str,
+        retry_policy: Optional[RetryPolicy] = None,
+        single_flight: Optional[SingleFlight] = None,
+        router: Optional[ModelRouter] = None,
+        circuit_breakers: Optional[CircuitBreakers] = None,
+        concurrency_limits: Optional[ConcurrencyLimits] = None,
+        scheduler: Optional[Scheduler] = None,
+        deadline: Optional[float] = None,
+        key_pool: Optional[KeyPool] = None,
+    ):
+        self.client = client
+        self.endpoint = endpoint
+        self.retry_policy = retry_policy or RetryPolicy()
+        # 同一内容の同時リクエストを合流させる（None なら無効）
+        self.single_flight = single_flight
+        # model="auto" の送信先を選ぶルーター
+        self.router = router
+        # デプロイメントごとのサーキットブレーカー（None なら無効）
+        self.circuit_breakers = circuit_breakers
+        # デプロイメントごとの適応型同時実行数制限（None なら無効）
+        self.concurrency_limits = concurrency_limits
+        # 優先度クラス付きの送信順制御（None なら無効）
+        self.scheduler = scheduler
+        # 各呼び出しの時間予算（秒、None なら外側の deadline.within() のみ）
+        self.deadline = deadline
+        # 試行ごとに負荷の低いサブスクリプションキーを選ぶ（None なら api_key のみ）
+        self.key_pool = key_pool
+
+    def create(self, model: str, messages: list, *, priority: Optional[str] = None, **params: Any):
+        """
+        Chat Completion を生成
+
+        stream=True の場合はチャンクのイテレーターを返します。スパンはストリームを
+        読み終えた時点で終了し、最初のチャンク到着時刻を TTFT として記録します。
+        single_flight が設定されていれば、同一内容の実行中リクエストに合流します。
+        model="auto" の場合と、指定したデプロイメントの回路が開いている場合は
+        router が送信先デプロイメントを選択します。
+        scheduler が設定されていれば、priority クラスの順番を待ってから送信します。
+        デッドラインがあれば、順番待ち・タイムアウト・リトライ・ストリームの読み取りを
+        その残り時間に収めます。
+        key_pool が設定されていれば、試行ごとに負荷の低いサブスクリプションキーで送信します。
+        """
+        model = resolve_model(
+            self.api_name,
+            model,
+            self.router,
+            self.circuit_breakers,
+            lambda unavailable: self.router.route_chat(
+                messages, params.get("max_tokens"), params.get("tools"), unavailable
+            ),
+        )
+
+        if self.single_flight is None:
+            return self._create(model, messages, params, priority)
+
+        key = request_key(model=model, messages=messages, **params)
+        if params.get("stream"):
+            return self.single_flight.do_stream(
+                key, lambda: self._create(model, messages, params, priority)
+            )
+        return self.single_flight.do(key, lambda: self._create(model, messages, params, priority))
+
+    def _schedule(
+        self,
+        model: str,
+        messages: list,
+        params: dict,
+        priority: Optional[str],
+        budget: Optional[deadline.Deadline],
+    ):
+        """スケジューラーの順番を待つ（無効なら None）"""
+        if self.scheduler is None:
+            return None
+        prompt_tokens = tokens.estimate_chat_tokens(model, messages, params.get("tools"))
+        return self.scheduler.acquire(
+            priority,
+            Scheduler.estimate_cost(prompt_tokens, params.get("max_tokens")),
+            timeout=budget.remaining() if budget is not None else None,
+        )
+
+    def _create(self, model: str, messages: list, params: dict, priority: Optional[str] = None):
+        span = telemetry.gen_ai_span(
+            "chat",
+            model,
+            self.endpoint,
+            {"gen_ai.request.max_tokens": params.get("max_tokens")},
+        )
+        event = RequestEvent(
+            api=self.api_name,
+            operation="chat",
+            model=model,
+            status_code=None,
+            duration=0.0,
+            started_at=time.time(),
+            path="/chat/completions",
+            body={"model": model, "messages": messages, **params},
+        )
+        if span.is_recording():
+            span.set_attribute(
+                "aigateway.request.estimated_input_tokens",
+                tokens.estimate_chat_tokens(model, messages, params.get("tools")),
+            )
+
+        budget = deadline.start(self.deadline)
+        if params.get("stream"):
+            # ストリーミングでも最終チャンクで usage を受け取る
+            params.setdefault("stream_options", {"include_usage": True})
+            telemetry.record_content(span, "gen_ai.input.messages", messages)
+            return self._stream(span, event, model, messages, params, priority, budget)
+
+        telemetry.record_content(span, "gen_ai.input.messages", messages)
+        ticket = self._schedule(model, messages, params, priority, budget)
+        phases = profiling.start()
+        start = time.perf_counter()
+        lease = None
+        try:
+            with span:
+                response, _, lease = self._create_with_retry(event, model, messages, params, budget)
+                telemetry.set_response_attributes(span, response)
+                if response.choices:
+                    telemetry.record_content(
+                        span, "gen_ai.output.messages", response.choices[0].message.content
+                    )
+                for key, value in _usage_event_fields(response).items():
+                    setattr(event, key, value)
+                return response
+        except Exception as e:
+            event.error = type(e).__name__
+            if isinstance(e, TimeoutError) and budget is not None and budget.expired():
+                deadline.record_exceeded(self.api_name, event.operation)
+            raise
+        finally:
+            if ticket is not None:
+                self.scheduler.release(ticket, _sum_tokens(event))
+            if lease is not None:
+                self.key_pool.release(lease, event.status_code, _sum_tokens(event))
+            event.duration = time.perf_counter() - start
+            event.phases = phases
+            profiling.stop()
+            _emit(event)
+
+    def _create_with_retry(
+        self,
+        event: RequestEvent,
+        model: str,
+        messages: list,
+        params: dict,
+        budget: Optional[deadline.Deadline] = None,
+    ) -> tuple[Any, Optional[Slot], Optional[KeyLease]]:
+        """
+        SDK 呼び出し（429 / 5xx / 接続エラーはリトライポリシーに従って再送）
+
+        concurrency_limits が設定されている場合、ストリーミングではデプロイメントが
+        生成を続けている間も実行枠を保持したまま返すため、呼び出し側が読み終えた時点で返却します。
+        key_pool が設定されている場合、成功した試行のキーは usage を記録できるよう
+        未返却のまま返します（失敗した試行のキーはここで返却）。
+        """
+        breaker = None
+        if self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.get(self.api_name, model)
+        limiter = None
+        if self.concurrency_limits is not None:
+            limiter = self.concurrency_limits.get(model)
+        cost = None
+        if self.key_pool is not None:
+            cost = Scheduler.estimate_cost(
+                tokens.estimate_chat_tokens(model, messages, params.get("tools")), params.get("max_tokens")
+            )
+        attempt = 0
+        while True:
+            options = {}
+            if budget is not None:
+                budget.check(f"chat がデッドライン（{budget.budget:g} 秒）までに完了しませんでした")
+                if "timeout" not in params:
+                    options["timeout"] = budget.remaining()
+            if breaker is not None:
+                self.circuit_breakers.allow(breaker)
+            try:
+                slot = limiter.acquire(options.get("timeout")) if limiter is not None else None
+            except BaseException:
+                # 送信に至らなかった（実行枠の待機のタイムアウト等）: half_open の試行枠を返す
+                if breaker is not None:
+                    breaker.release()
+                raise
+            lease = None
+            request_params = params
+            if self.key_pool is not None:
+                lease = self.key_pool.acquire(cost)
+                extra_headers = {**(params.get("extra_headers") or {}), "api-key": lease.key}
+                request_params = {**params, "extra_headers": extra_headers}
+            attempt_start = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(
+                    model=model, messages=messages, **options, **request_params
+                )
+                if breaker is not None:
+                    breaker.record(False, time.perf_counter() - attempt_start)
+                event.status_code = 200
+                if slot is not None:
+                    slot.latency = time.perf_counter() - attempt_start
+                    if not params.get("stream"):
+                        limiter.release(slot)
+                        slot = None
+                return response, slot, lease
+            except openai.APIStatusError as e:
+                if breaker is not None:
+                    breaker.record(e.status_code >= 500, time.perf_counter() - attempt_start)
+                if slot is not None:
+                    limiter.release(slot, throttled=e.status_code == 429, failed=e.status_code >= 500)
+                if lease is not None:
+                    self.key_pool.release(
+                        lease, e.status_code, headers=e.response.headers if e.response is not None else None
+                    )
+                event.status_code = e.status_code
+                if e.status_code == 429:
+                    event.throttled += 1
+                if e.status_code not in RETRYABLE_STATUS or attempt >= self.retry_policy.max_retries:
+                    raise
+                error = e
+                headers = e.response.headers if e.response is not None else None
+            except openai.APIConnectionError as e:
+                if breaker is not None:
+                    breaker.record(True, time.perf_counter() - attempt_start)
+                if slot is not None:
+                    limiter.release(slot, failed=True)
+                if lease is not None:
+                    self.key_pool.release(lease)
+                if budget is not None and budget.expired():
+                    # タイムアウト（APITimeoutError）はデッドライン超過として扱う
+                    raise deadline.DeadlineExceeded(
+                        f"chat がデッドライン（{budget.budget:g} 秒）までに完了しませんでした"
+                    ) from e
+                if attempt >= self.retry_policy.max_retries:
+                    raise
+                error = e
+                headers = None
+            except BaseException:
+                # 上記以外の例外（SDK の不具合・中断等）でも試行枠・実行枠・キーを返す
+                if breaker is not None:
+                    breaker.release()
+                if slot is not None:
+                    limiter.release(slot)
+                if lease is not None:
+                    self.key_pool.release(lease)
+                raise
+            delay = self.retry_policy.delay(attempt, headers)
+            throttled = isinstance(error, openai.APIStatusError) and error.status_code == 429
+            if throttled and lease is not None and self.key_pool.available():
+                # クールダウン中でないキーが残っていれば待たずに切り替える
+                delay = 0.0
+            if budget is not None and not budget.allows(delay):
+                # リトライを待つ時間が残っていない
+                raise error
+            time.sleep(delay)
+            attempt += 1
+            event.retries = attempt
+
+    def _stream(
+        self,
+        span,
+        event: RequestEvent,
+        model: str,
+        messages: list,
+        params: dict,
+        priority: Optional[str] = None,
+        budget: Optional[deadline.Deadline] = None,
+    ) -> Iterator:
+        start = time.perf_counter()
+        error = None
+        ticket = None
+        slot = None
+        lease = None
+        phases = None
+        stream = None
+        consumed = False
+        try:
+            # 順番待ちはストリームを読み始めた時点で行い、読み終えるまで保持
+            ticket = self._schedule(model, messages, params, priority, budget)
+            phases = profiling.start()
+            start = time.perf_counter()
+            stream, slot, lease = self._create_with_retry(event, model, messages, params, budget)
+            first = True
+            for chunk in stream:
+                if budget is not None and budget.expired():
+                    # 接続は finally で閉じ、サーバー側の生成を止める
+                    raise deadline.DeadlineExceeded(
+                        f"chat のストリームがデッドライン（{budget.budget:g} 秒）までに完了しませんでした"
+                    )
+                if first and chunk.choices and chunk.choices[0].delta.content:
+                    event.ttft = time.perf_counter() - start
+                    telemetry.record_first_token(span, event.ttft)
+                    first = False
+                usage = getattr(chunk, "usage", None)
+                if usage or (chunk.choices and chunk.choices[0].finish_reason):
+                    telemetry.set_response_attributes(span, chunk)
+                if usage:
+                    for key, value in _usage_event_fields(chunk).items():
+                        setattr(event, key, value)
+                yield chunk
+            consumed = True
+        except GeneratorExit:
+            # 呼び出し側がストリームを途中で破棄した（エラー扱いにしない）
+            raise
+        except BaseException as e:
+            error = e
+            event.error = type(e).__name__
+            if isinstance(e, deadline.DeadlineExceeded):
+                deadline.record_exceeded(self.api_name, event.operation)
+            raise
+        finally:
+            if stream is not None and not consumed:
+                # 途中で破棄・デッドライン超過・エラー: 接続を閉じてサーバー側の生成を止める
+                stream.close()
+            if slot is not None:
+                self.concurrency_limits.get(model).release(slot)
+            if ticket is not None:
+                self.scheduler.release(ticket, _sum_tokens(event))
+            if lease is not None:
+                self.key_pool.release(lease, event.status_code, _sum_tokens(event))
+            span.end(error=error)
+            event.duration = time.perf_counter() - start
+            event.phases = phases
+            profiling.stop()
+            _emit(event)
+
+
+def create_chat_client(config: AIGatewayConfig) -> ChatClient:
+    """設定から Chat Completions クライアントを作成（APIM 経由）"""
+    # AI Gateway のパスは /openai/deployments/{model}/... なので
+    # azure_endpoint に /openai を追加
+    endpoint = f"{config.apim_endpoint}/openai"
+    client = AzureOpenAI(
+        api_key=config.api_key,
+        api_version=config.api_version,
+        azure_endpoint=endpoint,
+        # リトライは ChatClient 側で行い、回数をメトリクスに記録する
+        max_retries=0,
+        # --profile 時は httpx の trace 拡張で接続・送信・応答待ちを計測する
+        http_client=(
+            openai.DefaultHttpxClient(event_hooks={"request": [profiling.attach_trace]})
+            if profiling.active() else None
+        ),
+    )
+    return ChatClient(client, endpoint)
@@ -0,0 +1,220 @@
+"""
+ヘッジリクエストモジュール
+
+プライマリのリクエストが学習済みのレイテンシ分位点（既定 p95）を超えても完了しない場合に、
+同じデプロイメント、またはフォールバックデプロイメント（例: gpt-4o → gpt-4o-mini）へ
+バックアップリクエストを送り、先に成功した結果を採用します。
+
+- 負けた側がまだ開始していなければキャンセルし、既に送信済みなら結果を破棄して
+  cancel コールバック（ストリームのクローズ、バックグラウンドレスポンスの cancel 等）を呼びます。
+  送信済みの同期 HTTP 呼び出しそのものは中断できないため、完了を待たずに結果だけ捨てます。
+- プライマリのレイテンシは負けた場合も完了時に記録し、ヘッジなしの場合の p99 と
+  実際に得られた p99 を比較してレポートします。
+"""
+
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """直近 N 件のレイテンシから分位点を求めるローリングウィンドウ"""
+
+    def __init__(self, window: int = 500):
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """分位点（0.0〜1.0）。サンプルがなければ None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(int(q * len(samples)), len(samples) - 1)
+        return samples[index]
+
+
+@dataclass
+class HedgePolicy:
+    """ヘッジ方針"""
+
+    # この分位点を超えたらバックアップを送る
+    percentile: float = 0.95
+    # 分位点を学習するまでに必要なサンプル数（それまでは initial_delay を使用）
+    min_samples: int = 20
+    initial_delay: float = 2.0
+    # ヘッジ遅延の下限（過剰なヘッジを防ぐ）
+    min_delay: float = 0.1
+    # バックアップ先（None ならプライマリと同じデプロイメント）
+    fallback_model: Optional[str] = None
+    window: int = 500
+
+
+class Hedger:
+    """ヘッジ付きで呼び出しを実行し、ヘッジ率と p99 改善を集計"""
+
+    def __init__(
+        self,
+        policy: Optional[HedgePolicy] = None,
+        max_workers: int = 16,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        self.policy = policy or HedgePolicy()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._primary: dict[str, LatencyTracker] = {}
+        self._effective: dict[str, LatencyTracker] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.backup_wins = 0
+
+        registry = registry or metrics.get_registry()
+        self._hedges = registry.counter(
+            "aigateway_hedge_requests_total",
+            "送信したバックアップリクエスト数",
+            ("model", "backup_model"),
+        )
+        self._wins = registry.counter(
+            "aigateway_hedge_backup_wins_total",
+            "バックアップが先に完了したリクエスト数",
+            ("model", "backup_model"),
+        )
+        self._delay_gauge = registry.gauge(
+            "aigateway_hedge_delay_seconds",
+            "現在のヘッジ遅延（学習済みの分位点）",
+            ("model",),
+        )
+
+    def _tracker(self, table: dict, model: str) -> LatencyTracker:
+        with self._lock:
+            tracker = table.get(model)
+            if tracker is None:
+                tracker = table[model] = LatencyTracker(self.policy.window)
+            return tracker
+
+    def hedge_delay(self, model: str) -> float:
+        """バックアップを送るまでの待機時間"""
+        tracker = self._tracker(self._primary, model)
+        if len(tracker) < self.policy.min_samples:
+            delay = self.policy.initial_delay
+        else:
+            delay = max(tracker.percentile(self.policy.percentile), self.policy.min_delay)
+        self._delay_gauge.set(delay, model=model)
+        return delay
+
+    def call(
+        self,
+        fn: Callable[[str], T],
+        model: str,
+        cancel: Optional[Callable[[T], None]] = None,
+    ) -> T:
+        """
+        fn(model) をヘッジ付きで実行
+
+        Args:
+            fn: デプロイメント名を受け取ってリクエストを実行する関数
+            model: プライマリのデプロイメント名
+            cancel: 採用されなかった結果の後始末（省略可）
+        """
+        start = time.perf_counter()
+        primary_tracker = self._tracker(self._primary, model)
+        delay = self.hedge_delay(model)
+
+        def record_primary(f: Future) -> None:
+            # 負けた場合も完了時刻を記録（ヘッジなしの場合のレイテンシとして比較に使う）
+            if not f.cancelled() and f.exception() is None:
+                primary_tracker.record(time.perf_counter() - start)
+
+        # デッドライン等のコンテキストをワーカースレッドに引き継ぐ
+        primary = self._pool.submit(contextvars.copy_context().run, fn, model)
+        primary.add_done_callback(record_primary)
+        with self._lock:
+            self.calls += 1
+
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return self._finish(model, start, primary.result())
+
+        backup_model = self.policy.fallback_model or model
+        backup = self._pool.submit(contextvars.copy_context().run, fn, backup_model)
+        with self._lock:
+            self.hedged += 1
+        self._hedges.inc(model=model, backup_model=backup_model)
+
+        pending = {primary, backup}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                loser = backup if future is primary else primary
+                self._discard(loser, cancel)
+                if future is backup:
+                    with self._lock:
+                        self.backup_wins += 1
+                    self._wins.inc(model=model, backup_model=backup_model)
+                return self._finish(model, start, future.result())
+        raise error
+
+    def _discard(self, loser: Future, cancel: Optional[Callable]) -> None:
+        """負けた側を取り消す（未開始ならキャンセル、送信済みなら完了後に後始末）"""
+        if loser.cancel() or cancel is None:
+            return
+
+        def cleanup(f: Future) -> None:
+            if not f.cancelled() and f.exception() is None:
+                try:
+                    cancel(f.result())
+                except Exception:
+                    pass
+
+        loser.add_done_callback(cleanup)
+
+    def _finish(self, model: str, start: float, result: T) -> T:
+        self._tracker(self._effective, model).record(time.perf_counter() - start)
+        return result
+
+    def report(self) -> dict:
+        """ヘッジ率とプライマリ単独時に対する p99 の改善"""
+        with self._lock:
+            models = list(self._effective)
+        per_model = {}
+        for model in models:
+            primary_p99 = self._tracker(self._primary, model).percentile(0.99)
+            effective_p99 = self._tracker(self._effective, model).percentile(0.99)
+            per_model[model] = {
+                "primary_p99": primary_p99,
+                "effective_p99": effective_p99,
+                "p99_improvement": (
+                    primary_p99 - effective_p99
+                    if primary_p99 is not None and effective_p99 is not None
+                    else None
+                ),
+            }
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_rate": self.hedged / self.calls if self.calls else 0.0,
+            "backup_wins": self.backup_wins,
+            "models": per_model,
+        }
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
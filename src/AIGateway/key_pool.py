@@ -0,0 +1,272 @@
+"""
+サブスクリプションキーのプールモジュール
+
+APIM のレート制限（llm-token-limit / rate-limit-by-key 等）はサブスクリプションキーごとに
+かかるため、1 つのキーではスループットがその上限で頭打ちになります。
+複数のキー（環境変数 APIM_API_KEYS）をプールし、呼び出しごとに最も負荷の低いキーを選ぶことで、
+複数のサブスクリプションの枠を合算して使います。
+
+- 負荷: 直近 window 秒に消費したトークン数 + 実行中の呼び出しの見込みトークン数
+  （見込みを指定しない呼び出しはキーごとの平均トークン数で見積もる）
+- 429 を受けたキーは retry-after（なければ --key-cooldown 秒）の間、選択対象から外します。
+  他に使えるキーがあれば、待たずに別のキーでリトライします。
+- キーごとのリクエスト数・トークン数・429 回数をメトリクスと終了時のレポートに出力します
+  （キーはラベル key1, key2, ... と末尾 4 文字でのみ表示）。
+
+使用方法:
+    APIM_API_KEYS=key-a,key-b,key-c python test_chat_completions.py --coalesce 20
+    APIM_API_KEYS=key-a,key-b python test_responses_api.py --all --key-cooldown 20
+"""
+
+import argparse
+import threading
+import time
+from collections import deque
+from typing import Any, Optional
+
+import metrics
+
+DEFAULT_COOLDOWN = 10.0
+DEFAULT_WINDOW = 60.0
+
+
+class KeyLease:
+    """acquire() で選んだキー（release() で結果を記録）"""
+
+    __slots__ = ("state", "cost", "released")
+
+    def __init__(self, state: "_KeyState", cost: float):
+        self.state = state
+        self.cost = cost
+        self.released = False
+
+    @property
+    def key(self) -> str:
+        return self.state.key
+
+    @property
+    def label(self) -> str:
+        return self.state.label
+
+
+class _KeyState:
+    """1 つのキーの利用状況"""
+
+    def __init__(self, key: str, label: str):
+        self.key = key
+        self.label = label
+        self.in_flight = 0
+        # 実行中の呼び出しの見込みトークン数の合計
+        self.pending = 0.0
+        self.requests = 0
+        self.tokens = 0
+        self.throttled = 0
+        self.errors = 0
+        self.cooldown_until = 0.0
+        # 直近 window 秒の (完了時刻, トークン数)
+        self.recent: deque = deque()
+        self.recent_tokens = 0
+
+    @property
+    def masked(self) -> str:
+        return f"…{self.key[-4:]}"
+
+    @property
+    def average_tokens(self) -> float:
+        return self.tokens / self.requests if self.requests else 0.0
+
+    def prune(self, now: float, window: float) -> None:
+        while self.recent and self.recent[0][0] <= now - window:
+            self.recent_tokens -= self.recent.popleft()[1]
+
+    def load(self) -> float:
+        return self.recent_tokens + self.pending
+
+
+def parse_retry_after(headers: Optional[Any]) -> Optional[float]:
+    """retry-after-ms / retry-after ヘッダーの秒数（なければ None）"""
+    if headers is None:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    return None
+
+
+class KeyPool:
+    """複数のサブスクリプションキーから最も負荷の低いキーを選ぶ（全クライアントで共有）"""
+
+    def __init__(
+        self,
+        keys: list[str],
+        cooldown: float = DEFAULT_COOLDOWN,
+        window: float = DEFAULT_WINDOW,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        if not keys:
+            raise ValueError("キーを 1 つ以上指定してください")
+        self.cooldown = cooldown
+        self.window = window
+        self._keys = [_KeyState(key, f"key{i + 1}") for i, key in enumerate(keys)]
+        self._lock = threading.Lock()
+
+        registry = registry or metrics.get_registry()
+        self._requests = registry.counter(
+            "aigateway_key_requests_total",
+            "サブスクリプションキーごとの送信数",
+            ("key", "status"),
+        )
+        self._tokens = registry.counter(
+            "aigateway_key_tokens_total",
+            "サブスクリプションキーごとの消費トークン数（入力 + 出力）",
+            ("key",),
+        )
+        self._cooldowns = registry.counter(
+            "aigateway_key_cooldowns_total",
+            "429 によりキーを一時的に選択対象から外した回数",
+            ("key",),
+        )
+        self._in_flight = registry.gauge(
+            "aigateway_key_in_flight",
+            "サブスクリプションキーごとの実行中の呼び出し数",
+            ("key",),
+        )
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def available(self) -> int:
+        """クールダウン中でないキーの数"""
+        now = time.monotonic()
+        return sum(1 for state in self._keys if state.cooldown_until <= now)
+
+    def acquire(self, cost: Optional[float] = None) -> KeyLease:
+        """
+        最も負荷の低いキーを選んで実行中として数える
+
+        cost は呼び出しの見込みトークン数（省略時はキーごとの平均）。
+        すべてのキーがクールダウン中なら、最も早く明けるキーを返します。
+        """
+        now = time.monotonic()
+        with self._lock:
+            for state in self._keys:
+                state.prune(now, self.window)
+            ready = [state for state in self._keys if state.cooldown_until <= now]
+            if ready:
+                state = min(ready, key=lambda s: (s.load(), s.in_flight))
+            else:
+                state = min(self._keys, key=lambda s: s.cooldown_until)
+            estimate = cost if cost is not None else state.average_tokens
+            state.in_flight += 1
+            state.pending += estimate
+            in_flight = state.in_flight
+        self._in_flight.set(in_flight, key=state.label)
+        return KeyLease(state, estimate)
+
+    def release(
+        self,
+        lease: KeyLease,
+        status_code: Optional[int] = None,
+        tokens: Optional[int] = None,
+        headers: Optional[Any] = None,
+    ) -> None:
+        """
+        呼び出し結果を記録
+
+        status_code が None の場合は接続エラー等として扱います。
+        429 の場合は retry-after の間（なければ cooldown 秒）キーを選択対象から外します。
+        """
+        if lease.released:
+            return
+        lease.released = True
+        state = lease.state
+        now = time.monotonic()
+        cooled = False
+        with self._lock:
+            state.in_flight -= 1
+            state.pending = max(0.0, state.pending - lease.cost)
+            state.requests += 1
+            if tokens:
+                state.tokens += tokens
+                state.recent.append((now, tokens))
+                state.recent_tokens += tokens
+            if status_code == 429:
+                state.throttled += 1
+                wait = parse_retry_after(headers)
+                state.cooldown_until = max(state.cooldown_until, now + (wait if wait is not None else self.cooldown))
+                cooled = True
+            elif status_code is None or status_code >= 500:
+                state.errors += 1
+            in_flight = state.in_flight
+
+        self._in_flight.set(in_flight, key=state.label)
+        self._requests.inc(key=state.label, status=str(status_code or "error"))
+        if tokens:
+            self._tokens.inc(tokens, key=state.label)
+        if cooled:
+            self._cooldowns.inc(key=state.label)
+
+    def report(self) -> list[dict]:
+        """キーごとの利用状況"""
+        now = time.monotonic()
+        with self._lock:
+            total_tokens = sum(state.tokens for state in self._keys)
+            rows = []
+            for state in self._keys:
+                state.prune(now, self.window)
+                rows.append({
+                    "key": state.label,
+                    "masked": state.masked,
+                    "requests": state.requests,
+                    "tokens": state.tokens,
+                    "share": state.tokens / total_tokens if total_tokens else 0.0,
+                    "recent_tokens": state.recent_tokens,
+                    "throttled": state.throttled,
+                    "errors": state.errors,
+                    "cooldown": max(0.0, state.cooldown_until - now),
+                })
+        return rows
+
+    def print_report(self) -> None:
+        """キーごとと合計の利用状況を出力"""
+        rows = self.report()
+        print(f"\nSubscription keys ({len(rows)}):")
+        for row in rows:
+            cooldown = f", cooldown={row['cooldown']:.0f}s" if row["cooldown"] else ""
+            print(
+                f"  - {row['key']} ({row['masked']}): requests={row['requests']}, "
+                f"tokens={row['tokens']:,} ({row['share']:.0%}), "
+                f"last {self.window:.0f}s={row['recent_tokens']:,}, 429={row['throttled']}{cooldown}"
+            )
+        print(
+            f"  合計: requests={sum(r['requests'] for r in rows)}, "
+            f"tokens={sum(r['tokens'] for r in rows):,}, 429={sum(r['throttled'] for r in rows)}"
+        )
+
+
+def add_key_pool_arguments(parser: argparse.ArgumentParser) -> None:
+    """キープール用の CLI 引数を追加（キーは環境変数 APIM_API_KEYS）"""
+    group = parser.add_argument_group("key pool")
+    group.add_argument(
+        "--key-cooldown",
+        type=float,
+        default=DEFAULT_COOLDOWN,
+        help=f"429 を受けたキーを外す秒数（retry-after がない場合、default: {DEFAULT_COOLDOWN:.0f}）",
+    )
+    group.add_argument(
+        "--key-window",
+        type=float,
+        default=DEFAULT_WINDOW,
+        help=f"キーの負荷として数えるトークン消費の期間（秒、default: {DEFAULT_WINDOW:.0f}）",
+    )
+
+
+def create_key_pool(args: argparse.Namespace, keys: list[str]) -> Optional[KeyPool]:
+    """キーが 2 つ以上あればプールを作成（1 つなら None）"""
+    if len(keys) < 2:
+        return None
+    return KeyPool(keys, cooldown=args.key_cooldown, window=args.key_window)
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+マルチプロセス負荷生成スクリプト
+
+1 つの Python プロセスでは JSON 処理や TLS で CPU が先に飽和するため、
+CPU コアごとにワーカープロセス（それぞれ 1 つの asyncio イベントループ）を起動して
+AI Gateway に負荷をかけます。
+
+- 目標 RPS は全体で指定し、ワーカーに均等に割り振ります（オープンループ: 応答を待たずに送信）。
+- レイテンシは予定送信時刻から計測し（クライアント側の詰まりも含む）、マージ可能な
+  対数バケットのヒストグラムとしてワーカーから集約します。トークン数・ステータス別件数も集計します。
+- --warmup N を指定すると、各ワーカーは開始時刻の前に N 本の接続を開いておきます
+  （DNS 解決・TLS ハンドシェイクを計測に含めない）。
+- --mock を指定すると AI Gateway に送信せず、模擬レイテンシで動作確認できます。
+- --profile を指定すると、レイテンシをフェーズ（順番待ち・接続・TLS・送信・応答待ち・受信・デコード）に
+  分解して集計し、--profile-stacks PATH で各ワーカーのスタックのサンプルを folded 形式で書き出します。
+
+使用方法:
+    python loadgen.py --rps 50 --duration 60
+    python loadgen.py --target responses --rps 20 --processes 4
+    python loadgen.py --mock --rps 2000 --duration 10
+    python loadgen.py --rps 50 --profile --profile-stacks load.folded
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+import fastjson
+import profiling
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# ヒストグラムのバケット（下限 100µs、1 バケットあたり約 2% 幅）
+_HIST_MIN = 1e-4
+_HIST_GROWTH = 1.02
+_LOG_GROWTH = math.log(_HIST_GROWTH)
+
+# --warmup 指定時に開始時刻を遅らせる秒数（接続を開き終えてから全ワーカーを同時に開始する）
+WARMUP_LEAD = 3.0
+
+
+class LatencyHistogram:
+    """マージ可能な対数バケットのレイテンシヒストグラム（分位点の相対誤差 約 2%）"""
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(value: float) -> int:
+        if value <= _HIST_MIN:
+            return 0
+        return int(math.log(value / _HIST_MIN) / _LOG_GROWTH) + 1
+
+    def record(self, value: float) -> None:
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """分位点（バケットの上限値、ただし最大値を超えない）"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(_HIST_MIN * _HIST_GROWTH ** index, self.max)
+        return self.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def to_dict(self) -> dict:
+        return {"counts": {str(k): v for k, v in self.counts.items()}, "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        hist = cls()
+        hist.counts = {int(k): v for k, v in data["counts"].items()}
+        hist.count = sum(hist.counts.values())
+        hist.total = data["total"]
+        hist.max = data["max"]
+        return hist
+
+
+@dataclass
+class LoadSummary:
+    """ワーカー・全体で共通のマージ可能な集計結果"""
+
+    requests: int = 0
+    errors: int = 0
+    # 送信時刻に同時実行数の上限で待たされたリクエスト数
+    queued: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    elapsed: float = 0.0
+    status: dict[str, int] = field(default_factory=dict)
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # --profile: フェーズ別の所要時間と、スタックごとのサンプル数（folded 形式）
+    phases: dict[str, LatencyHistogram] = field(default_factory=dict)
+    stacks: dict[str, int] = field(default_factory=dict)
+
+    def merge(self, other: "LoadSummary") -> None:
+        self.requests += other.requests
+        self.errors += other.errors
+        self.queued += other.queued
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.elapsed = max(self.elapsed, other.elapsed)
+        for status, count in other.status.items():
+            self.status[status] = self.status.get(status, 0) + count
+        self.latency.merge(other.latency)
+        for name, hist in other.phases.items():
+            self.phases.setdefault(name, LatencyHistogram()).merge(hist)
+        for stack, count in other.stacks.items():
+            self.stacks[stack] = self.stacks.get(stack, 0) + count
+
+    def record_phases(self, phases: dict, latency: float) -> None:
+        """1 リクエストのフェーズ別所要時間を記録（残りは other）"""
+        for name, seconds in phases.items():
+            self.phases.setdefault(name, LatencyHistogram()).record(seconds)
+        other = max(0.0, latency - sum(phases.values()))
+        self.phases.setdefault("other", LatencyHistogram()).record(other)
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["latency"] = self.latency.to_dict()
+        data["phases"] = {name: hist.to_dict() for name, hist in self.phases.items()}
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LoadSummary":
+        data = dict(data)
+        data["latency"] = LatencyHistogram.from_dict(data["latency"])
+        data["phases"] = {name: LatencyHistogram.from_dict(hist) for name, hist in data.get("phases", {}).items()}
+        return cls(**data)
+
+    def report(self) -> dict:
+        """表示・JSON 出力用の要約"""
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "queued": self.queued,
+            "rps": self.requests / self.elapsed if self.elapsed else 0.0,
+            "status": dict(sorted(self.status.items())),
+            "latency": {
+                "mean": self.latency.mean,
+                "p50": self.latency.quantile(0.5),
+                "p90": self.latency.quantile(0.9),
+                "p99": self.latency.quantile(0.99),
+                "max": self.latency.max if self.latency.count else None,
+            },
+            "tokens": {"input": self.input_tokens, "output": self.output_tokens},
+            "phases": {
+                name: {"mean": hist.mean, "p50": hist.quantile(0.5), "p95": hist.quantile(0.95)}
+                for name, hist in self.phases.items()
+            },
+        }
+
+
+@dataclass
+class LoadSpec:
+    """負荷の内容（全ワーカー共通）"""
+
+    target: str = "chat"
+    model: str = "gpt-4o"
+    message: str = "Hello! What is Azure AI Foundry?"
+    max_tokens: int = 100
+    duration: float = 30.0
+    # ワーカーあたりの同時実行数の上限
+    concurrency: int = 64
+    arrival: str = "poisson"
+    url: Optional[str] = None
+    api_key: Optional[str] = None
+    mock: bool = False
+    # モック: 応答時間の中央値と 429 の割合
+    mock_latency: float = 0.5
+    mock_error_rate: float = 0.0
+    timeout: float = 120.0
+    # ワーカーあたり開始前に開いておく接続数（0 で無効）
+    warmup: int = 0
+    # フェーズ別の所要時間を記録する / スタックの採取間隔（秒、0 で採取しない）
+    profile: bool = False
+    profile_interval: float = 0.0
+
+
+def build_request(spec: LoadSpec) -> bytes:
+    """送信する本文（ワーカーごとに 1 回だけエンコード）"""
+    if spec.target == "responses":
+        body = {"model": spec.model, "input": spec.message, "max_output_tokens": spec.max_tokens}
+    else:
+        body = {"messages": [{"role": "user", "content": spec.message}], "max_tokens": spec.max_tokens}
+    return fastjson.dumps(body)
+
+
+class _MockResponse:
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+
+class MockTarget:
+    """AI Gateway の代わりに模擬レイテンシで応答する送信先"""
+
+    def __init__(self, spec: LoadSpec):
+        self.spec = spec
+        self._ok = fastjson.dumps({"usage": {"prompt_tokens": 20, "completion_tokens": spec.max_tokens}})
+        self._throttled = fastjson.dumps({"error": {"code": "429", "message": "Rate limit is exceeded."}})
+
+    async def post(self, url: str, content: bytes, extensions: Optional[dict] = None) -> _MockResponse:
+        # 対数正規分布（裾の長い応答時間）
+        await asyncio.sleep(random.lognormvariate(math.log(self.spec.mock_latency), 0.4))
+        if random.random() < self.spec.mock_error_rate:
+            return _MockResponse(429, self._throttled)
+        return _MockResponse(200, self._ok)
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def _warm_up(client, spec: LoadSpec) -> None:
+    """開始前に接続を開いておく（応答のステータスは問わず、集計にも含めない）"""
+
+    async def probe() -> None:
+        try:
+            await client.get(spec.url)
+        except Exception:
+            pass
+
+    await asyncio.gather(*(probe() for _ in range(min(spec.warmup, spec.concurrency))))
+
+
+async def _drive(spec: LoadSpec, rps: float, start_at: float, summary: LoadSummary, progress) -> None:
+    """1 ワーカー分の負荷（オープンループ）"""
+    body = build_request(spec)
+    if spec.mock:
+        client = MockTarget(spec)
+    else:
+        limits = httpx.Limits(max_connections=spec.concurrency, max_keepalive_connections=spec.concurrency)
+        client = httpx.AsyncClient(
+            headers={"api-key": spec.api_key, "Content-Type": "application/json"},
+            limits=limits,
+            timeout=spec.timeout,
+        )
+        if spec.warmup:
+            await _warm_up(client, spec)
+    semaphore = asyncio.Semaphore(spec.concurrency)
+    loop = asyncio.get_running_loop()
+    tasks: set = set()
+
+    async def one(scheduled: float) -> None:
+        if semaphore.locked():
+            summary.queued += 1
+        async with semaphore:
+            status = "error"
+            phases = None
+            extensions = None
+            if spec.profile:
+                phases = {"queue": loop.time() - scheduled}
+                # httpcore の trace 拡張で接続・送信・応答待ち・受信を計測（connect は DNS を含む）
+                extensions = {"trace": profiling.TraceRecorder(phases).atrace}
+            try:
+                response = await client.post(spec.url, content=body, extensions=extensions)
+                status = str(response.status_code)
+                if response.status_code == 200:
+                    parse_start = time.perf_counter()
+                    usage = fastjson.loads(response.content).get("usage") or {}
+                    if phases is not None:
+                        profiling.record("parse", time.perf_counter() - parse_start, phases)
+                    summary.input_tokens += usage.get("prompt_tokens") or usage.get("input_tokens") or 0
+                    summary.output_tokens += usage.get("completion_tokens") or usage.get("output_tokens") or 0
+                else:
+                    summary.errors += 1
+            except Exception as e:
+                status = type(e).__name__
+                summary.errors += 1
+            summary.requests += 1
+            summary.status[status] = summary.status.get(status, 0) + 1
+            latency = loop.time() - scheduled
+            summary.latency.record(latency)
+            if phases is not None:
+                summary.record_phases(phases, latency)
+
+    # 開始時刻（壁時計）までイベントループの時計で待機
+    origin = loop.time() + max(0.0, start_at - time.time())
+    end = origin + spec.duration
+    next_at = origin
+    next_progress = origin + 1.0
+    try:
+        while next_at < end:
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.ensure_future(one(next_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if spec.arrival == "poisson":
+                next_at += random.expovariate(rps)
+            else:
+                next_at += 1.0 / rps
+            if progress is not None and loop.time() >= next_progress:
+                summary.elapsed = loop.time() - origin
+                progress(summary)
+                next_progress += 1.0
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        summary.elapsed = loop.time() - origin
+        await client.aclose()
+
+
+def run_worker(spec: LoadSpec, rps: float, start_at: float, progress=None) -> LoadSummary:
+    """ワーカー 1 つ分の負荷を現在のプロセスで実行"""
+    summary = LoadSummary()
+    if rps > 0:
+        sampler = profiling.SamplingProfiler(spec.profile_interval) if spec.profile_interval else None
+        if sampler:
+            sampler.start()
+        try:
+            asyncio.run(_drive(spec, rps, start_at, summary, progress))
+        finally:
+            if sampler:
+                sampler.stop()
+                summary.stacks = dict(sampler.stacks)
+    return summary
+
+
+def _worker_main(worker_id: int, spec: LoadSpec, rps: float, start_at: float, results) -> None:
+    """子プロセスのエントリーポイント（1 秒ごとに途中経過、最後に最終結果を送る）"""
+
+    def progress(summary: LoadSummary) -> None:
+        results.put((worker_id, False, summary.to_dict()))
+
+    try:
+        summary = run_worker(spec, rps, start_at, progress)
+    except BaseException as e:
+        results.put((worker_id, True, {"error": f"{type(e).__name__}: {e}"}))
+        return
+    results.put((worker_id, True, summary.to_dict()))
+
+
+def run_local(
+    spec: LoadSpec, rps: float, processes: int, start_at: Optional[float] = None, on_progress=None
+) -> LoadSummary:
+    """
+    processes 個のワーカープロセスで rps を分担して実行し、結果をマージ
+
+    on_progress を指定すると、約 1 秒ごとにその時点のマージ結果を渡します。
+    """
+    processes = max(1, processes)
+    # 全ワーカーが起動してから同時に開始する
+    start_at = start_at or time.time() + 1.0 + 0.1 * processes + (WARMUP_LEAD if spec.warmup else 0.0)
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_worker_main,
+            args=(i, spec, rps / processes, start_at, results),
+            name=f"loadgen-{i}",
+            daemon=True,
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    latest: dict[int, LoadSummary] = {}
+    finished: set[int] = set()
+    failures: list[str] = []
+    deadline = start_at + spec.duration + spec.timeout + 10.0
+    last_progress = 0.0
+    while len(finished) < processes:
+        try:
+            worker_id, done, data = results.get(timeout=1.0)
+        except queue.Empty:
+            if time.time() > deadline or not any(w.is_alive() for w in workers):
+                break
+            continue
+        if "error" in data:
+            failures.append(f"worker {worker_id}: {data['error']}")
+        else:
+            latest[worker_id] = LoadSummary.from_dict(data)
+        if done:
+            finished.add(worker_id)
+        elif on_progress is not None and time.time() - last_progress >= 1.0:
+            last_progress = time.time()
+            on_progress(merge_summaries(latest.values()))
+
+    for worker in workers:
+        worker.join(timeout=5.0)
+    if failures:
+        raise RuntimeError("; ".join(failures))
+    return merge_summaries(latest.values())
+
+
+def merge_summaries(summaries) -> LoadSummary:
+    """複数の LoadSummary を 1 つにマージ"""
+    merged = LoadSummary()
+    for summary in summaries:
+        merged.merge(summary)
+    return merged
+
+
+def print_report(summary: LoadSummary, target_rps: float) -> None:
+    """結果を表形式で出力"""
+    report = summary.report()
+    latency = report["latency"]
+
+    def ms(value: Optional[float]) -> str:
+        return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+    print(f"\n{'='*60}")
+    print("負荷テスト結果")
+    print(f"{'='*60}")
+    print(
+        f"Requests: {report['requests']} in {summary.elapsed:.1f}s "
+        f"({report['rps']:.1f} completed/s, target {target_rps:.1f} rps)"
+    )
+    print(f"Errors:   {report['errors']}  Queued: {report['queued']}")
+    print(f"Status:   {', '.join(f'{k}={v}' for k, v in report['status'].items())}")
+    print(
+        f"Latency:  mean={ms(latency['mean'])}, p50={ms(latency['p50'])}, "
+        f"p90={ms(latency['p90'])}, p99={ms(latency['p99'])}, max={ms(latency['max'])}"
+    )
+    print(f"Tokens:   input={report['tokens']['input']}, output={report['tokens']['output']}")
+    if summary.phases and summary.requests:
+        rows = []
+        for name in profiling.PHASES:
+            hist = summary.phases.get(name)
+            if hist is not None:
+                rows.append((name, hist.count, hist.total, hist.quantile(0.5), hist.quantile(0.95)))
+        profiling.print_breakdown("Phases", summary.requests, summary.latency.total, rows)
+
+
+def add_load_arguments(parser: argparse.ArgumentParser) -> None:
+    """負荷の内容を指定する CLI 引数を追加"""
+    parser.add_argument("--target", choices=["chat", "responses"], default="chat", help="送信先 API (default: chat)")
+    parser.add_argument("--model", "-m", help="使用するモデル名（デフォルト: 環境変数 DEFAULT_MODEL）")
+    parser.add_argument("--message", default=LoadSpec.message, help="送信するメッセージ")
+    parser.add_argument("--max-tokens", type=int, default=LoadSpec.max_tokens, help="最大出力トークン数 (default: 100)")
+    parser.add_argument("--rps", type=float, default=10.0, help="全体の目標 RPS (default: 10)")
+    parser.add_argument("--duration", "-d", type=float, default=LoadSpec.duration, help="実行時間（秒） (default: 30)")
+    parser.add_argument("--concurrency", type=int, default=LoadSpec.concurrency, help="プロセスあたりの同時実行数上限 (default: 64)")
+    parser.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson", help="到着間隔 (default: poisson)")
+    parser.add_argument("--warmup", type=int, default=0, metavar="N", help="開始前にワーカーあたり N 本の接続を開いておく (default: 0)")
+    parser.add_argument("--mock", action="store_true", help="AI Gateway に送信せず模擬レイテンシで実行")
+    parser.add_argument("--mock-latency", type=float, default=LoadSpec.mock_latency, help="モックの応答時間の中央値（秒）")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0, help="モックが 429 を返す割合")
+
+
+def spec_from_args(args: argparse.Namespace) -> LoadSpec:
+    """CLI 引数から LoadSpec を作成（--mock 以外は AI Gateway の設定を読み込む）"""
+    spec = LoadSpec(
+        target=args.target,
+        message=args.message,
+        max_tokens=args.max_tokens,
+        duration=args.duration,
+        concurrency=args.concurrency,
+        arrival=args.arrival,
+        mock=args.mock,
+        mock_latency=args.mock_latency,
+        mock_error_rate=args.mock_error_rate,
+        warmup=args.warmup,
+    )
+    if args.mock:
+        spec.model = args.model or spec.model
+        spec.url = "mock://"
+        return spec
+
+    if httpx is None:
+        raise ValueError("httpx が必要です（pip install httpx）")
+    from config import get_config
+
+    config = get_config()
+    spec.model = args.model or config.default_model
+    spec.api_key = config.api_key
+    if spec.target == "responses":
+        spec.url = f"{config.base_url_responses}/responses?api-version={config.api_version}"
+    else:
+        spec.url = (
+            f"{config.base_url_chat}/deployments/{spec.model}/chat/completions"
+            f"?api-version={config.api_version}"
+        )
+    return spec
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="マルチプロセス負荷生成",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python loadgen.py --rps 50 --duration 60
+  python loadgen.py --target responses --rps 20 --processes 4
+  python loadgen.py --mock --rps 2000 --duration 10
+  python loadgen.py --rps 100 --output result.json
+  python loadgen.py --rps 50 --profile --profile-stacks load.folded
+        """
+    )
+    add_load_arguments(parser)
+    parser.add_argument("--processes", "-p", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数 (default: CPU コア数)")
+    parser.add_argument("--output", "-o", help="結果を書き出す JSON ファイル")
+    profiling.add_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    try:
+        spec = spec_from_args(args)
+    except ValueError as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+    spec.profile = args.profile or bool(args.profile_stacks)
+    if args.profile_stacks:
+        spec.profile_interval = args.profile_interval / 1000
+
+    print(f"Target: {'mock' if spec.mock else spec.url}")
+    print(f"Model: {spec.model}")
+    print(f"Load: {args.rps} rps × {spec.duration}s, {args.processes} processes × {spec.concurrency} concurrency")
+
+    def progress(summary: LoadSummary) -> None:
+        p99 = summary.latency.quantile(0.99)
+        print(
+            f"   {summary.elapsed:5.1f}s  requests={summary.requests}  errors={summary.errors}  "
+            f"p99={p99 * 1000 if p99 else 0:.0f}ms",
+            flush=True,
+        )
+
+    try:
+        summary = run_local(spec, args.rps, args.processes, on_progress=progress)
+    except RuntimeError as e:
+        print(f"\n❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print_report(summary, args.rps)
+    if args.profile_stacks:
+        profiling.write_folded(summary.stacks, args.profile_stacks)
+        print(f"\n🔥 Stack samples: {sum(summary.stacks.values())} → {args.profile_stacks}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary.report(), f, ensure_ascii=False, indent=2)
+        print(f"\nResult: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
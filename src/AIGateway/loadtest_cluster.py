@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+分散負荷テストスクリプト（コーディネーター / ワーカー）
+
+1 台のマシンでは再現できない負荷を、複数ノードの loadgen.py ワーカーで分担して生成します。
+
+- coordinator: ワーカーの接続を待ち、シナリオ（config.get_config() から組み立てた LoadSpec）と
+  各ワーカーの RPS 配分（プロセス数に比例）を配布します。時計のずれを ping で測定して
+  開始時刻をワーカーの時計に換算し、全ノードを同時に開始させます。
+- worker: コーディネーターに接続し、loadgen のマルチプロセス実行結果（マージ可能な
+  ヒストグラム）を 1 秒ごとに送り返します。API キーは各ワーカーが自分の設定から読み込みます。
+- local: 同じマシン上でコーディネーターと N 個のワーカーを起動します（動作確認用）。
+
+通信は TCP 上の「4 バイト長 + JSON」のメッセージです。--token で共有トークンを検証します。
+
+使用方法:
+    python loadtest_cluster.py coordinator --workers 3 --rps 300 --duration 60
+    python loadtest_cluster.py worker --connect 10.0.0.4:7070
+    python loadtest_cluster.py local --workers 3 --mock --rps 3000 --duration 10
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict
+from typing import Optional
+
+import fastjson
+import loadgen
+
+DEFAULT_PORT = 7070
+PROTOCOL_VERSION = 1
+
+# 開始時刻までの猶予（全ワーカーがプロセスを起動できるだけの時間）
+START_LEAD = 3.0
+
+_HEADER = struct.Struct("!I")
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+
+def send_message(sock: socket.socket, message: dict) -> None:
+    """メッセージを 1 つ送信（4 バイトのビッグエンディアン長 + JSON）"""
+    data = fastjson.dumps(message)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("接続が閉じられました")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def recv_message(sock: socket.socket) -> dict:
+    """メッセージを 1 つ受信"""
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > MAX_MESSAGE_BYTES:
+        raise ConnectionError(f"メッセージが大きすぎます: {size} bytes")
+    return fastjson.loads(_recv_exactly(sock, size))
+
+
+def _parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class WorkerConnection:
+    """コーディネーター側から見たワーカー 1 台"""
+
+    def __init__(self, sock: socket.socket, hello: dict):
+        self.sock = sock
+        self.name = hello["name"]
+        self.processes = hello["processes"]
+        self.clock_offset = 0.0
+        self.rps = 0.0
+        self.summary = loadgen.LoadSummary()
+        self.done = False
+        self.error: Optional[str] = None
+
+    def measure_clock_offset(self, samples: int = 5) -> float:
+        """ワーカーの時計 − コーディネーターの時計（往復時間が最小のサンプルを採用）"""
+        best_rtt = None
+        for _ in range(samples):
+            sent = time.time()
+            send_message(self.sock, {"type": "ping", "t": sent})
+            reply = recv_message(self.sock)
+            received = time.time()
+            rtt = received - sent
+            if best_rtt is None or rtt < best_rtt:
+                best_rtt = rtt
+                self.clock_offset = reply["t"] - (sent + received) / 2
+        return self.clock_offset
+
+
+class Coordinator:
+    """ワーカーを集めてシナリオを配布し、結果をマージ"""
+
+    def __init__(self, host: str, port: int, expected_workers: int, token: Optional[str] = None):
+        self.expected_workers = expected_workers
+        self.token = token
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self.workers: list[WorkerConnection] = []
+        self._messages: queue.Queue = queue.Queue()
+
+    def accept_workers(self, timeout: float = 300.0) -> None:
+        """expected_workers 台のワーカーが接続するまで待機"""
+        self.server.settimeout(timeout)
+        while len(self.workers) < self.expected_workers:
+            sock, peer = self.server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                hello = recv_message(sock)
+                if hello.get("type") != "hello" or hello.get("version") != PROTOCOL_VERSION:
+                    raise ConnectionError("プロトコルが一致しません")
+                if self.token and hello.get("token") != self.token:
+                    raise ConnectionError("トークンが一致しません")
+            except (ConnectionError, OSError, ValueError) as e:
+                print(f"⚠️  {peer[0]}:{peer[1]} を拒否しました: {e}")
+                sock.close()
+                continue
+            worker = WorkerConnection(sock, hello)
+            self.workers.append(worker)
+            print(f"🔗 Worker {worker.name} ({worker.processes} processes) connected "
+                  f"[{len(self.workers)}/{self.expected_workers}]")
+
+    def _reader(self, worker: WorkerConnection) -> None:
+        try:
+            while True:
+                self._messages.put((worker, recv_message(worker.sock)))
+        except (ConnectionError, OSError) as e:
+            self._messages.put((worker, {"type": "disconnected", "error": str(e)}))
+
+    def run(self, spec: loadgen.LoadSpec, rps: float, on_progress=None) -> loadgen.LoadSummary:
+        """シナリオを配布して同時に開始し、全ワーカーの最終結果をマージして返す"""
+        total_processes = sum(w.processes for w in self.workers)
+        start_at = time.time() + START_LEAD + (loadgen.WARMUP_LEAD if spec.warmup else 0.0)
+        scenario = asdict(spec)
+        # API キーは配布しない（各ワーカーが自分の設定から読み込む）
+        scenario["api_key"] = None
+
+        for worker in self.workers:
+            worker.measure_clock_offset()
+            worker.rps = rps * worker.processes / total_processes
+        for worker in self.workers:
+            send_message(worker.sock, {
+                "type": "start",
+                "spec": scenario,
+                "rps": worker.rps,
+                "start_at": start_at + worker.clock_offset,
+            })
+            threading.Thread(target=self._reader, args=(worker,), daemon=True).start()
+
+        deadline = start_at + spec.duration + spec.timeout + 30.0
+        last_progress = 0.0
+        while not all(w.done for w in self.workers):
+            try:
+                worker, message = self._messages.get(timeout=1.0)
+            except queue.Empty:
+                if time.time() > deadline:
+                    raise TimeoutError("ワーカーの結果が期限内に揃いませんでした")
+                continue
+            kind = message.get("type")
+            if kind in ("progress", "result"):
+                worker.summary = loadgen.LoadSummary.from_dict(message["summary"])
+            if kind in ("result", "error", "disconnected") and not worker.done:
+                worker.done = True
+                worker.error = message.get("error")
+            if on_progress is not None and time.time() - last_progress >= 1.0:
+                last_progress = time.time()
+                on_progress(self.merged())
+        return self.merged()
+
+    def merged(self) -> loadgen.LoadSummary:
+        return loadgen.merge_summaries(w.summary for w in self.workers)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.sock.close()
+        self.server.close()
+
+
+def run_worker(address: str, processes: int, name: str, token: Optional[str] = None) -> None:
+    """コーディネーターに接続し、受け取ったシナリオを loadgen で実行"""
+    host, port = _parse_address(address)
+    sock = None
+    for _ in range(30):
+        try:
+            sock = socket.create_connection((host, port), timeout=10.0)
+            break
+        except OSError:
+            time.sleep(1.0)
+    if sock is None:
+        raise ConnectionError(f"{address} に接続できません")
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_message(sock, {
+        "type": "hello",
+        "version": PROTOCOL_VERSION,
+        "name": name,
+        "processes": processes,
+        "token": token,
+    })
+    print(f"🔗 Connected to {host}:{port} as {name}")
+
+    try:
+        while True:
+            message = recv_message(sock)
+            if message["type"] == "ping":
+                send_message(sock, {"type": "pong", "t": time.time()})
+                continue
+            if message["type"] == "start":
+                break
+
+        spec = loadgen.LoadSpec(**message["spec"])
+        if not spec.mock:
+            from config import get_config
+
+            spec.api_key = get_config().api_key
+        print(f"▶️  {message['rps']:.1f} rps × {spec.duration}s on {processes} processes")
+
+        def progress(summary: loadgen.LoadSummary) -> None:
+            send_message(sock, {"type": "progress", "summary": summary.to_dict()})
+
+        try:
+            summary = loadgen.run_local(
+                spec, message["rps"], processes, start_at=message["start_at"], on_progress=progress
+            )
+        except Exception as e:
+            send_message(sock, {"type": "error", "error": f"{type(e).__name__}: {e}"})
+            raise
+        send_message(sock, {"type": "result", "summary": summary.to_dict()})
+        print(f"✅ Done: {summary.requests} requests")
+    finally:
+        sock.close()
+
+
+def print_workers(coordinator: Coordinator) -> None:
+    """ワーカー別の結果"""
+    print("\nWorkers:")
+    for worker in coordinator.workers:
+        report = worker.summary.report()
+        p99 = report["latency"]["p99"]
+        status = f"❌ {worker.error}" if worker.error else "ok"
+        print(
+            f"  - {worker.name}: rps={worker.rps:.1f}, requests={report['requests']}, "
+            f"errors={report['errors']}, p99={p99 * 1000 if p99 else 0:.0f}ms, "
+            f"clock_offset={worker.clock_offset * 1000:+.1f}ms, {status}"
+        )
+
+
+def coordinate(args: argparse.Namespace, spawn_local: bool = False) -> None:
+    """コーディネーターとして実行（spawn_local なら同じマシンにワーカーを起動）"""
+    spec = loadgen.spec_from_args(args)
+    host = "127.0.0.1" if spawn_local else args.host
+    coordinator = Coordinator(host, 0 if spawn_local else args.port, args.workers, args.token)
+    address = f"{coordinator.address[0]}:{coordinator.address[1]}"
+    print(f"Coordinator: {address} (waiting for {args.workers} workers)")
+    print(f"Target: {'mock' if spec.mock else spec.url}")
+
+    children = []
+    if spawn_local:
+        env = dict(os.environ)
+        if args.token:
+            env["AIGATEWAY_LOADTEST_TOKEN"] = args.token
+        for i in range(args.workers):
+            children.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "worker",
+                 "--connect", address, "--processes", str(args.processes), "--name", f"local-{i}"],
+                env=env,
+                stdout=subprocess.DEVNULL,
+            ))
+
+    def progress(summary: loadgen.LoadSummary) -> None:
+        p99 = summary.latency.quantile(0.99)
+        print(
+            f"   {summary.elapsed:5.1f}s  requests={summary.requests}  errors={summary.errors}  "
+            f"p99={p99 * 1000 if p99 else 0:.0f}ms",
+            flush=True,
+        )
+
+    try:
+        coordinator.accept_workers()
+        summary = coordinator.run(spec, args.rps, on_progress=progress)
+        loadgen.print_report(summary, args.rps)
+        print_workers(coordinator)
+        if args.output:
+            result = {
+                "total": summary.report(),
+                "workers": {w.name: w.summary.report() for w in coordinator.workers},
+            }
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            print(f"\nResult: {args.output}")
+    finally:
+        coordinator.close()
+        for child in children:
+            child.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="分散負荷テスト（コーディネーター / ワーカー）",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python loadtest_cluster.py coordinator --workers 3 --rps 300 --duration 60
+  python loadtest_cluster.py worker --connect 10.0.0.4:7070
+  python loadtest_cluster.py local --workers 3 --mock --rps 3000 --duration 10
+        """
+    )
+    parser.add_argument("mode", choices=["coordinator", "worker", "local"])
+    parser.add_argument("--workers", "-w", type=int, default=2, help="待機するワーカー数 (default: 2)")
+    parser.add_argument("--host", default="0.0.0.0", help="coordinator: 待ち受けアドレス (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"coordinator: 待ち受けポート (default: {DEFAULT_PORT})")
+    parser.add_argument("--connect", help="worker: コーディネーターのアドレス（host:port）")
+    parser.add_argument("--name", default=socket.gethostname(), help="worker: ワーカー名 (default: ホスト名)")
+    parser.add_argument("--processes", "-p", type=int, default=os.cpu_count() or 1, help="ワーカーあたりのプロセス数 (default: CPU コア数)")
+    parser.add_argument("--token", default=os.getenv("AIGATEWAY_LOADTEST_TOKEN"), help="共有トークン（環境変数 AIGATEWAY_LOADTEST_TOKEN）")
+    parser.add_argument("--output", "-o", help="結果を書き出す JSON ファイル")
+    loadgen.add_load_arguments(parser)
+
+    args = parser.parse_args()
+
+    try:
+        if args.mode == "worker":
+            if not args.connect:
+                parser.error("--connect を指定してください")
+            run_worker(args.connect, args.processes, args.name, args.token)
+        else:
+            coordinate(args, spawn_local=args.mode == "local")
+    except (ValueError, RuntimeError, ConnectionError, TimeoutError, OSError) as e:
+        print(f"\n❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+"""
+AI Gateway メトリクスモジュール
+
+クラウドに依存しないプロセス内メトリクスレジストリを提供します。
+
+- Counter / Gauge / Histogram（ラベル付き、スレッドセーフ）
+- Prometheus テキスト形式の HTTP エンドポイント（/metrics, /metrics.json）
+- 定期的な JSON ファイル出力
+
+負荷試験中に `curl localhost:9464/metrics` や JSON ファイルで
+レイテンシ・トークン数・429 発生状況をリアルタイムに確認できます。
+"""
+
+import argparse
+import atexit
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterable, Optional
+
+# レイテンシ用の既定バケット（秒）
+DEFAULT_LATENCY_BUCKETS = (
+    0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0
+)
+
+
+class _Metric:
+    """メトリクス基底クラス"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name}: ラベルが一致しません (expected={self.labelnames}, got={tuple(labels)})"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: Optional[dict] = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.extend(extra.items())
+        if not pairs:
+            return ""
+        body = ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs)
+        return "{" + body + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter(_Metric):
+    """単調増加カウンター"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        """全ラベルの合計"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{self._format_labels(k)} {_format_value(v)}" for k, v in items]
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            items = list(self._values.items())
+        return [{"labels": dict(zip(self.labelnames, k)), "value": v} for k, v in items]
+
+
+class Gauge(Counter):
+    """任意に増減するゲージ"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, value: float = 1.0, **labels: Any) -> None:
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    """累積バケット方式のヒストグラム"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに [バケット別件数..., +Inf 件数], 合計値
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels: Any) -> int:
+        with self._lock:
+            return sum(self._counts.get(self._key(labels), ()))
+
+    def quantile(self, q: float, **labels: Any) -> Optional[float]:
+        """バケット内の線形補間で分位点を推定"""
+        with self._lock:
+            counts = list(self._counts.get(self._key(labels), ()))
+        return _bucket_quantile(self.buckets, counts, q)
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            items = [(k, list(c), self._sums[k]) for k, c in self._counts.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = {"le": _format_value(bound)}
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            items = [(k, list(c), self._sums[k]) for k, c in self._counts.items()]
+        result = []
+        for key, counts, total in items:
+            n = sum(counts)
+            result.append({
+                "labels": dict(zip(self.labelnames, key)),
+                "count": n,
+                "sum": total,
+                "mean": total / n if n else None,
+                "p50": _bucket_quantile(self.buckets, counts, 0.50),
+                "p95": _bucket_quantile(self.buckets, counts, 0.95),
+                "p99": _bucket_quantile(self.buckets, counts, 0.99),
+            })
+        return result
+
+
+def _bucket_quantile(buckets: tuple, counts: list[int], q: float) -> Optional[float]:
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for i, count in enumerate(counts):
+        upper = buckets[i] if i < len(buckets) else buckets[-1]
+        if cumulative + count >= rank and count > 0:
+            if i == len(buckets):
+                # +Inf バケットは上限が不明なため最大境界値を返す
+                return upper
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = upper
+    return buckets[-1]
+
+
+class MetricsRegistry:
+    """メトリクスレジストリ"""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} は別の種類のメトリクスとして登録済みです")
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets)
+
+    def get(self, name: str) -> Optional[_Metric]:
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render_prometheus(self) -> str:
+        """Prometheus テキスト形式（0.0.4）で出力"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """JSON 化可能なスナップショットを取得"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            "timestamp": time.time(),
+            "metrics": {
+                m.name: {"type": m.kind, "help": m.help, "series": m.snapshot()}
+                for m in metrics
+            },
+        }
+
+
+_default_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    """プロセス共通のレジストリを取得"""
+    return _default_registry
+
+
+# ========================================
+# エクスポーター
+# ========================================
+
+def serve_prometheus(
+    port: int,
+    registry: Optional[MetricsRegistry] = None,
+    host: str = "127.0.0.1",
+) -> ThreadingHTTPServer:
+    """
+    Prometheus 形式のメトリクスエンドポイントをバックグラウンドで起動
+
+    GET /metrics      → Prometheus テキスト形式
+    GET /metrics.json → JSON スナップショット
+    """
+    registry = registry or get_registry()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = registry.render_prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(registry.snapshot(), ensure_ascii=False).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
+
+
+class JsonFileExporter:
+    """レジストリのスナップショットを定期的に JSON ファイルへ書き出す"""
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = 5.0,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.path = path
+        self.interval = interval
+        self.registry = registry or get_registry()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "JsonFileExporter":
+        self._thread = threading.Thread(target=self._run, name="metrics-json", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        """スナップショットをアトミックに書き出す"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.registry.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def stop(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+        self.write()
+
+
+# ========================================
+# AI Gateway クライアント用メトリクス
+# ========================================
+
+class GatewayMetrics:
+    """AI Gateway クライアント呼び出しのメトリクス"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry or get_registry()
+        r = self.registry
+        self.request_duration = r.histogram(
+            "aigateway_request_duration_seconds",
+            "AI Gateway へのリクエストのレイテンシ（リトライ込み）",
+            ("api", "operation", "model", "status"),
+        )
+        self.ttft = r.histogram(
+            "aigateway_time_to_first_token_seconds",
+            "ストリーミング応答の最初のトークンまでの時間",
+            ("api", "model"),
+        )
+        self.tokens = r.counter(
+            "aigateway_tokens_total",
+            "usage から集計したトークン数",
+            ("api", "model", "direction"),
+        )
+        self.throttled = r.counter(
+            "aigateway_http_429_total",
+            "429 Too Many Requests の受信数",
+            ("api", "model"),
+        )
+        self.retries = r.counter(
+            "aigateway_retries_total",
+            "リトライ回数",
+            ("api", "model"),
+        )
+        self.cache_hits = r.counter(
+            "aigateway_prompt_cache_hits_total",
+            "cached_tokens > 0 だったリクエスト数",
+            ("api", "model"),
+        )
+
+    def observe(self, event) -> None:
+        """gateway_client.RequestEvent を記録（add_request_hook に登録して使用）"""
+        model = event.model or "unknown"
+        status = str(event.status_code) if event.status_code is not None else "error"
+        self.request_duration.observe(
+            event.duration, api=event.api, operation=event.operation, model=model, status=status
+        )
+        if event.ttft is not None:
+            self.ttft.observe(event.ttft, api=event.api, model=model)
+        if event.input_tokens:
+            self.tokens.inc(event.input_tokens, api=event.api, model=model, direction="input")
+        if event.output_tokens:
+            self.tokens.inc(event.output_tokens, api=event.api, model=model, direction="output")
+        if event.throttled:
+            self.throttled.inc(event.throttled, api=event.api, model=model)
+        if event.retries:
+            self.retries.inc(event.retries, api=event.api, model=model)
+        if event.cached_tokens:
+            self.cache_hits.inc(api=event.api, model=model)
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    """メトリクス出力用の CLI 引数を追加"""
+    group = parser.add_argument_group("metrics")
+    group.add_argument(
+        "--metrics-port",
+        type=int,
+        default=int(os.getenv("AIGATEWAY_METRICS_PORT", "0")) or None,
+        help="Prometheus 形式のメトリクスを公開するポート（例: 9464）",
+    )
+    group.add_argument(
+        "--metrics-json",
+        default=os.getenv("AIGATEWAY_METRICS_JSON"),
+        help="メトリクスを定期的に書き出す JSON ファイルパス",
+    )
+    group.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=5.0,
+        help="JSON ファイルの書き出し間隔（秒、デフォルト: 5）",
+    )
+
+
+def start_metrics(args: argparse.Namespace) -> Optional[GatewayMetrics]:
+    """CLI 引数に応じてエクスポーターを起動（指定がなければ None）"""
+    if not args.metrics_port and not args.metrics_json:
+        return None
+
+    gateway_metrics = GatewayMetrics()
+    if args.metrics_port:
+        serve_prometheus(args.metrics_port)
+        print(f"Metrics: http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.metrics_json:
+        JsonFileExporter(args.metrics_json, args.metrics_interval).start()
+        print(f"Metrics: {args.metrics_json} (every {args.metrics_interval}s)")
+    return gateway_metrics
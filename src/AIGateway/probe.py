@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""
+合成レイテンシプローブ（常駐）
+
+test_*.py を手で実行する代わりに、AI Gateway の各 API をデプロイメントごとに定期的に呼び出し、
+直近のレイテンシ・TTFT・エラー率を監視します。
+
+- プローブ: chat（同期）/ chat_stream（ストリーミング、TTFT を計測）/ responses（同期）/
+  responses_background（完了までの時間）/ assistants（Run の完了までの時間）
+- 計測値は (プローブ, デプロイメント) ごとの固定長リングバッファ（array）に保持し、
+  --window の各期間（既定 60 秒と 300 秒）で分位点・エラー率を集計します。
+- 集計結果は aigateway_probe_* メトリクスとしてメトリクスエンドポイント
+  （既定 http://127.0.0.1:9465/metrics）に公開します。各呼び出しの aigateway_request_* も同じ場所に出ます。
+- 最も長い期間の集計がしきい値（--alert-error-rate / --alert-p95 / --alert-ttft）を超えるとアラートを発火し、
+  解消したら復旧を通知します（標準出力、aigateway_probe_alert、--alert-webhook への POST）。
+
+プローブはリトライせず（失敗をそのまま計測）、1 回あたり --timeout 秒のデッドラインで打ち切ります。
+バックグラウンドレスポンスと Run はタイムアウト時にキャンセルします。
+
+使用方法:
+    python probe.py
+    python probe.py --interval 30 --probes chat,chat_stream --deployments gpt-4o,gpt-4o-mini
+    python probe.py --once
+"""
+
+import argparse
+import math
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+import requests
+
+import deadline
+import metrics
+from config import get_config
+from gateway_client import RetryPolicy, add_request_hook, create_chat_client
+from test_assistants_api import AssistantsAPIClient
+from test_responses_api import ResponsesAPIClient
+
+PROBES = ("chat", "chat_stream", "responses", "responses_background", "assistants")
+
+# メトリクスエンドポイントの既定ポート（test_*.py の 9464 と重ならないようにする）
+DEFAULT_METRICS_PORT = 9465
+
+# リングバッファの容量（(プローブ, デプロイメント) あたりの計測数）
+DEFAULT_CAPACITY = 4096
+
+PROBE_MESSAGE = "Reply with the single word: pong"
+PROBE_MAX_TOKENS = 16
+
+
+class RingBuffer:
+    """
+    直近 capacity 件の計測値を固定長の配列に保持（古いものから上書き）
+
+    1 件あたり 25 バイト（時刻・レイテンシ・TTFT の double と、エラーの byte）で、
+    TTFT がない計測は NaN として保持します。
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array("d", [0.0]) * capacity
+        self.latency = array("d", [0.0]) * capacity
+        self.ttft = array("d", [math.nan]) * capacity
+        self.errors = array("b", [0]) * capacity
+        self.size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: float, latency: float, ttft: Optional[float], error: bool) -> None:
+        with self._lock:
+            i = self._next
+            self.timestamps[i] = timestamp
+            self.latency[i] = latency
+            self.ttft[i] = math.nan if ttft is None else ttft
+            self.errors[i] = 1 if error else 0
+            self._next = (i + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    def window(self, seconds: float, now: Optional[float] = None) -> "WindowStats":
+        """直近 seconds 秒の計測を集計"""
+        since = (now if now is not None else time.time()) - seconds
+        latencies: list[float] = []
+        ttfts: list[float] = []
+        samples = errors = 0
+        with self._lock:
+            for k in range(self.size):
+                i = (self._next - 1 - k) % self.capacity
+                if self.timestamps[i] < since:
+                    # 新しい順に見ているので、これより前はすべて期間外
+                    break
+                samples += 1
+                if self.errors[i]:
+                    errors += 1
+                    continue
+                latencies.append(self.latency[i])
+                if not math.isnan(self.ttft[i]):
+                    ttfts.append(self.ttft[i])
+        latencies.sort()
+        ttfts.sort()
+        return WindowStats(
+            samples=samples,
+            errors=errors,
+            error_rate=errors / samples if samples else 0.0,
+            p50=_quantile(latencies, 0.5),
+            p95=_quantile(latencies, 0.95),
+            p99=_quantile(latencies, 0.99),
+            ttft_p50=_quantile(ttfts, 0.5),
+            ttft_p95=_quantile(ttfts, 0.95),
+        )
+
+
+def _quantile(values: list[float], q: float) -> Optional[float]:
+    """ソート済みの値の分位点（最近傍順位）"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+@dataclass
+class WindowStats:
+    """1 つの期間の集計（レイテンシ・TTFT は成功した計測のみ）"""
+
+    samples: int
+    errors: int
+    error_rate: float
+    p50: Optional[float]
+    p95: Optional[float]
+    p99: Optional[float]
+    ttft_p50: Optional[float]
+    ttft_p95: Optional[float]
+
+
+@dataclass
+class AlertRule:
+    """集計値がしきい値を超えたら発火するルール"""
+
+    name: str
+    threshold: float
+    # WindowStats から値を取り出す（値がなければ None）
+    value: Callable[[WindowStats], Optional[float]]
+    unit: str = "s"
+
+    def format(self, value: float) -> str:
+        return f"{value:.1%}" if self.unit == "%" else f"{value:.2f}s"
+
+
+@dataclass
+class ProbeResult:
+    latency: float
+    ttft: Optional[float] = None
+    error: Optional[str] = None
+
+
+class Prober:
+    """各プローブの実行と、結果の集計・公開・アラート判定"""
+
+    def __init__(
+        self,
+        config,
+        probes: list[str],
+        deployments: list[str],
+        windows: list[float],
+        rules: list[AlertRule],
+        timeout: float = 60.0,
+        min_samples: int = 3,
+        capacity: int = DEFAULT_CAPACITY,
+        webhook: Optional[str] = None,
+    ):
+        self.probes = probes
+        self.deployments = deployments
+        self.windows = sorted(windows)
+        self.rules = rules
+        self.timeout = timeout
+        self.min_samples = min_samples
+        self.webhook = webhook
+        self.buffers = {
+            (probe, deployment): RingBuffer(capacity) for probe in probes for deployment in deployments
+        }
+        # 発火中のアラート（(プローブ, デプロイメント, ルール名)）
+        self.firing: set[tuple[str, str, str]] = set()
+
+        # 失敗をそのまま計測するためリトライしない
+        no_retry = RetryPolicy(max_retries=0)
+        self.chat = create_chat_client(config)
+        self.chat.retry_policy = no_retry
+        self.responses = ResponsesAPIClient(
+            config.base_url_responses, config.api_key, config.api_version, retry_policy=no_retry
+        )
+        self.assistants = AssistantsAPIClient(
+            config.base_url_chat, config.api_key, config.api_version, retry_policy=no_retry
+        )
+        # デプロイメントごとに 1 つだけ作成して使い回す Assistant
+        self._assistant_ids: dict[str, str] = {}
+        self._assistant_lock = threading.Lock()
+
+        r = metrics.get_registry()
+        self._latency = r.gauge(
+            "aigateway_probe_latency_seconds",
+            "プローブのレイテンシの分位点（成功した計測のみ）",
+            ("probe", "deployment", "window", "quantile"),
+        )
+        self._ttft = r.gauge(
+            "aigateway_probe_ttft_seconds",
+            "プローブの TTFT の分位点（chat_stream のみ）",
+            ("probe", "deployment", "window", "quantile"),
+        )
+        self._error_rate = r.gauge(
+            "aigateway_probe_error_rate",
+            "プローブのエラー率",
+            ("probe", "deployment", "window"),
+        )
+        self._samples = r.gauge(
+            "aigateway_probe_samples",
+            "期間内のプローブ数",
+            ("probe", "deployment", "window"),
+        )
+        self._alert = r.gauge(
+            "aigateway_probe_alert",
+            "アラートの状態（1=発火中）",
+            ("probe", "deployment", "rule"),
+        )
+        self._alerts_total = r.counter(
+            "aigateway_probe_alerts_total",
+            "アラートの発火回数",
+            ("probe", "deployment", "rule"),
+        )
+
+    # ----------------------------------------
+    # プローブ
+    # ----------------------------------------
+
+    def _probe_chat(self, deployment: str) -> ProbeResult:
+        start = time.perf_counter()
+        self.chat.create(
+            deployment, [{"role": "user", "content": PROBE_MESSAGE}], max_tokens=PROBE_MAX_TOKENS
+        )
+        return ProbeResult(time.perf_counter() - start)
+
+    def _probe_chat_stream(self, deployment: str) -> ProbeResult:
+        start = time.perf_counter()
+        ttft = None
+        stream = self.chat.create(
+            deployment,
+            [{"role": "user", "content": PROBE_MESSAGE}],
+            max_tokens=PROBE_MAX_TOKENS,
+            stream=True,
+        )
+        for chunk in stream:
+            if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+                ttft = time.perf_counter() - start
+        return ProbeResult(time.perf_counter() - start, ttft)
+
+    def _probe_responses(self, deployment: str) -> ProbeResult:
+        start = time.perf_counter()
+        self.responses.create_response(deployment, PROBE_MESSAGE, store=False)
+        return ProbeResult(time.perf_counter() - start)
+
+    def _probe_responses_background(self, deployment: str) -> ProbeResult:
+        start = time.perf_counter()
+        response = self.responses.create_response(deployment, PROBE_MESSAGE, background=True)
+        response_id = response["id"]
+        budget = deadline.current()
+        try:
+            while response.get("status") not in ("completed", "failed", "cancelled", "incomplete"):
+                budget.sleep(1.0)
+                budget.check(f"{response_id} が {budget.budget:g} 秒以内に完了しませんでした")
+                response = self.responses.get_response(response_id)
+        except BaseException:
+            self.responses._abandon(response_id)
+            raise
+        latency = time.perf_counter() - start
+        if response["status"] != "completed":
+            return ProbeResult(latency, error=f"status={response['status']}")
+        return ProbeResult(latency)
+
+    def _assistant_id(self, deployment: str) -> str:
+        with self._assistant_lock:
+            if deployment not in self._assistant_ids:
+                assistant = self.assistants.create_assistant(
+                    name=f"aigateway-probe-{deployment}",
+                    model=deployment,
+                    instructions="Answer as briefly as possible.",
+                )
+                self._assistant_ids[deployment] = assistant["id"]
+            return self._assistant_ids[deployment]
+
+    def _probe_assistants(self, deployment: str) -> ProbeResult:
+        assistant_id = self._assistant_id(deployment)
+        start = time.perf_counter()
+        thread_id = self.assistants.create_thread()["id"]
+        try:
+            self.assistants.add_message(thread_id, PROBE_MESSAGE)
+            run = self.assistants.create_run(thread_id, assistant_id)
+            run = self.assistants.wait_for_run(thread_id, run["id"], timeout=self.timeout)
+            latency = time.perf_counter() - start
+        finally:
+            try:
+                with deadline.shielded():
+                    self.assistants.delete_thread(thread_id)
+            except Exception as e:
+                print(f"⚠️  {thread_id} を削除できませんでした: {e}", file=sys.stderr)
+        if run["status"] != "completed":
+            return ProbeResult(latency, error=f"status={run['status']}")
+        return ProbeResult(latency)
+
+    def run_probe(self, probe: str, deployment: str) -> ProbeResult:
+        """1 回のプローブを実行して結果をリングバッファに記録"""
+        timestamp = time.time()
+        start = time.perf_counter()
+        try:
+            with deadline.within(self.timeout):
+                result = getattr(self, f"_probe_{probe}")(deployment)
+        except Exception as e:
+            result = ProbeResult(time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+        self.buffers[(probe, deployment)].append(
+            timestamp, result.latency, result.ttft, result.error is not None
+        )
+        return result
+
+    def run_cycle(self, pool: ThreadPoolExecutor) -> dict[tuple[str, str], ProbeResult]:
+        """全プローブを 1 回ずつ実行し、集計とアラート判定を行う"""
+        targets = list(self.buffers)
+        futures = {target: pool.submit(self.run_probe, *target) for target in targets}
+        results = {target: future.result() for target, future in futures.items()}
+        self.evaluate()
+        return results
+
+    def cleanup(self) -> None:
+        """プローブ用に作成した Assistant を削除"""
+        for assistant_id in self._assistant_ids.values():
+            try:
+                with deadline.shielded():
+                    self.assistants.delete_assistant(assistant_id)
+            except Exception as e:
+                print(f"⚠️  {assistant_id} を削除できませんでした: {e}", file=sys.stderr)
+
+    # ----------------------------------------
+    # 集計・アラート
+    # ----------------------------------------
+
+    def stats(self, probe: str, deployment: str) -> dict[float, WindowStats]:
+        now = time.time()
+        return {window: self.buffers[(probe, deployment)].window(window, now) for window in self.windows}
+
+    def evaluate(self) -> None:
+        """各期間の集計をメトリクスに反映し、最も長い期間でアラートを判定"""
+        for probe, deployment in self.buffers:
+            stats = self.stats(probe, deployment)
+            for window, s in stats.items():
+                labels = {"probe": probe, "deployment": deployment, "window": f"{window:g}s"}
+                self._samples.set(s.samples, **labels)
+                self._error_rate.set(s.error_rate, **labels)
+                for quantile, value in (("0.5", s.p50), ("0.95", s.p95), ("0.99", s.p99)):
+                    if value is not None:
+                        self._latency.set(value, quantile=quantile, **labels)
+                for quantile, value in (("0.5", s.ttft_p50), ("0.95", s.ttft_p95)):
+                    if value is not None:
+                        self._ttft.set(value, quantile=quantile, **labels)
+
+            longest = stats[self.windows[-1]]
+            if longest.samples < self.min_samples:
+                continue
+            for rule in self.rules:
+                value = rule.value(longest)
+                key = (probe, deployment, rule.name)
+                firing = value is not None and value > rule.threshold
+                if firing and key not in self.firing:
+                    self.firing.add(key)
+                    self._alerts_total.inc(probe=probe, deployment=deployment, rule=rule.name)
+                    self._notify("firing", probe, deployment, rule, value, longest)
+                elif not firing and key in self.firing:
+                    self.firing.discard(key)
+                    self._notify("resolved", probe, deployment, rule, value, longest)
+                self._alert.set(1 if firing else 0, probe=probe, deployment=deployment, rule=rule.name)
+
+    def _notify(
+        self, state: str, probe: str, deployment: str, rule: AlertRule, value: Optional[float], stats: WindowStats
+    ) -> None:
+        moment = time.strftime("%H:%M:%S")
+        current = rule.format(value) if value is not None else "-"
+        if state == "firing":
+            print(
+                f"🚨 {moment} {probe}/{deployment}: {rule.name}={current} > {rule.format(rule.threshold)}",
+                flush=True,
+            )
+        else:
+            print(f"✅ {moment} {probe}/{deployment}: {rule.name} が復旧しました ({current})", flush=True)
+        if not self.webhook:
+            return
+        payload = {
+            "state": state,
+            "probe": probe,
+            "deployment": deployment,
+            "rule": rule.name,
+            "value": value,
+            "threshold": rule.threshold,
+            "window": self.windows[-1],
+            "stats": asdict(stats),
+            "timestamp": time.time(),
+        }
+        try:
+            requests.post(self.webhook, json=payload, timeout=10).raise_for_status()
+        except requests.RequestException as e:
+            print(f"⚠️  アラートを送信できませんでした: {e}", file=sys.stderr)
+
+    def print_report(self) -> None:
+        """(プローブ, デプロイメント) ごとの集計を表形式で出力"""
+
+        def ms(value: Optional[float]) -> str:
+            return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+        print(f"\n{'='*60}")
+        print(f"プローブ集計（直近 {self.windows[-1]:g} 秒）")
+        print(f"{'='*60}")
+        for probe, deployment in self.buffers:
+            s = self.stats(probe, deployment)[self.windows[-1]]
+            line = (
+                f"  {probe}/{deployment}: n={s.samples}, errors={s.error_rate:.0%}, "
+                f"p50={ms(s.p50)}, p95={ms(s.p95)}, p99={ms(s.p99)}"
+            )
+            if s.ttft_p50 is not None:
+                line += f", ttft p50={ms(s.ttft_p50)}, p95={ms(s.ttft_p95)}"
+            alerts = [rule for p, d, rule in sorted(self.firing) if (p, d) == (probe, deployment)]
+            if alerts:
+                line += f"  🚨 {', '.join(alerts)}"
+            print(line)
+
+
+def build_rules(args: argparse.Namespace) -> list[AlertRule]:
+    """CLI 引数からアラートルールを作成（0 以下のしきい値は無効）"""
+    rules = []
+    if args.alert_error_rate > 0:
+        rules.append(AlertRule("error_rate", args.alert_error_rate, lambda s: s.error_rate, unit="%"))
+    if args.alert_p95 > 0:
+        rules.append(AlertRule("latency_p95", args.alert_p95, lambda s: s.p95))
+    if args.alert_ttft > 0:
+        rules.append(AlertRule("ttft_p95", args.alert_ttft, lambda s: s.ttft_p95))
+    return rules
+
+
+def _split(value: str) -> list[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="AI Gateway 合成レイテンシプローブ",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python probe.py
+  python probe.py --interval 30 --probes chat,chat_stream --deployments gpt-4o,gpt-4o-mini
+  python probe.py --alert-p95 10 --alert-ttft 3 --alert-webhook https://example.com/hooks/aigateway
+  python probe.py --once
+        """
+    )
+    parser.add_argument(
+        "--probes",
+        default=",".join(PROBES),
+        help=f"実行するプローブ（カンマ区切り、default: {','.join(PROBES)}）",
+    )
+    parser.add_argument("--deployments", help="対象デプロイメント（カンマ区切り、デフォルト: 環境変数 DEPLOYMENTS）")
+    parser.add_argument("--interval", type=float, default=60.0, help="プローブの実行間隔（秒） (default: 60)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="プローブ 1 回あたりのデッドライン（秒） (default: 60)")
+    parser.add_argument("--window", default="60,300", help="集計期間（秒、カンマ区切り、最長の期間でアラートを判定） (default: 60,300)")
+    parser.add_argument("--parallel", type=int, default=4, help="同時に実行するプローブ数 (default: 4)")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY, help="プローブごとに保持する計測数 (default: 4096)")
+    parser.add_argument("--once", action="store_true", help="1 回だけ実行して集計を表示")
+
+    alerts = parser.add_argument_group("alerts")
+    alerts.add_argument("--alert-error-rate", type=float, default=0.2, help="エラー率のしきい値（0 で無効） (default: 0.2)")
+    alerts.add_argument("--alert-p95", type=float, default=30.0, help="レイテンシ p95 のしきい値（秒、0 で無効） (default: 30)")
+    alerts.add_argument("--alert-ttft", type=float, default=5.0, help="TTFT p95 のしきい値（秒、0 で無効） (default: 5)")
+    alerts.add_argument("--alert-min-samples", type=int, default=3, help="アラートを判定する最小プローブ数 (default: 3)")
+    alerts.add_argument("--alert-webhook", help="アラートの発火・復旧を JSON で POST する URL")
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+
+    probes = _split(args.probes)
+    unknown = sorted(set(probes) - set(PROBES))
+    try:
+        if unknown:
+            raise ValueError(f"不明なプローブ: {', '.join(unknown)}")
+        windows = [float(w) for w in _split(args.window)]
+        if not windows or min(windows) <= 0:
+            raise ValueError("--window には正の秒数を指定してください")
+        config = get_config()
+    except ValueError as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    deployments = _split(args.deployments) if args.deployments else config.deployments
+
+    # メトリクスエンドポイント（--metrics-json だけを指定した場合はファイル出力のみ）
+    if not args.metrics_port and not args.metrics_json:
+        args.metrics_port = DEFAULT_METRICS_PORT
+    gateway_metrics = metrics.start_metrics(args)
+    add_request_hook(gateway_metrics.observe)
+
+    prober = Prober(
+        config,
+        probes,
+        deployments,
+        windows,
+        build_rules(args),
+        timeout=args.timeout,
+        min_samples=args.alert_min_samples,
+        capacity=args.capacity,
+        webhook=args.alert_webhook,
+    )
+
+    print(f"AI Gateway Endpoint: {config.apim_endpoint}")
+    print(f"Probes: {', '.join(probes)}")
+    print(f"Deployments: {', '.join(deployments)}")
+    print(f"Interval: {args.interval:g}s, windows: {', '.join(f'{w:g}s' for w in prober.windows)}")
+
+    cycle = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.parallel, thread_name_prefix="probe") as pool:
+            while True:
+                cycle_start = time.monotonic()
+                cycle += 1
+                results = prober.run_cycle(pool)
+                failures = [(target, r) for target, r in results.items() if r.error]
+                print(
+                    f"{time.strftime('%H:%M:%S')} cycle {cycle}: {len(results)} probes, "
+                    f"{len(failures)} errors",
+                    flush=True,
+                )
+                for (probe, deployment), result in failures:
+                    print(f"   ❌ {probe}/{deployment}: {result.error}", flush=True)
+                if args.once:
+                    break
+                time.sleep(max(0.0, args.interval - (time.monotonic() - cycle_start)))
+    except KeyboardInterrupt:
+        print("\n停止しました")
+    finally:
+        prober.cleanup()
+        prober.print_report()
+
+
+if __name__ == "__main__":
+    main()
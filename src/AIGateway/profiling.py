@@ -0,0 +1,412 @@
+"""
+プロファイリングモジュール
+
+負荷試験やスクリプトが遅いときに、時間がどこで使われているか（DNS・TCP / TLS 接続・
+本文のエンコード・送信・Gateway の応答待ち・本文の受信・デコード・SDK 等の処理）を切り分けます。
+
+- --profile: 呼び出しごとにフェーズ別の所要時間を記録し、終了時に API・操作ごとの内訳を表示します。
+  raw HTTP クライアント（requests）は計測用の接続クラスを持つアダプターを使い、
+  Chat Completions（OpenAI SDK / httpx）と loadgen.py は httpcore の trace 拡張でフェーズを取得します。
+- --profile-stacks PATH: サンプリングプロファイラーで全スレッドのスタックを一定間隔で採取し、
+  flamegraph.pl / speedscope 等で読める folded 形式（"frame;frame;... 件数"）で書き出します。
+  壁時計ベースのため、ソケットの待ち時間も（recv 等のフレームとして）現れます。
+
+フェーズ（PHASES）:
+    queue      送信予定時刻から送信開始まで（loadgen.py のみ、同時実行数の上限やイベントループの遅れ）
+    dns        ホスト名の解決（warmup.py の DNS キャッシュにヒットした場合は 0）
+    connect    TCP 接続（DNS を除く）
+    tls        TLS ハンドシェイク
+    serialize  リクエスト本文のエンコード（raw HTTP クライアントのみ）
+    send       リクエストヘッダー・本文の送信
+    wait       送信完了から応答ヘッダー受信まで（Gateway / モデルの処理時間 ≒ TTFB）
+    body       応答本文の受信
+    parse      応答本文のデコードと usage 等の抽出（raw HTTP クライアントのみ）
+    other      上記以外（SDK の処理・リトライの待機等、全体から差し引いた残り）
+
+無効時は各計測点がコンテキスト変数を 1 回参照するだけで、通常の動作に影響しません。
+
+使用方法:
+    python test_responses_api.py --all --profile
+    python test_chat_completions.py --coalesce 20 --profile --profile-stacks chat.folded
+    python loadgen.py --rps 50 --profile --profile-stacks load.folded
+"""
+
+import argparse
+import atexit
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+PHASES = ("queue", "dns", "connect", "tls", "serialize", "send", "wait", "body", "parse", "other")
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# サンプリングで辿るスタックの最大深さ
+MAX_STACK_DEPTH = 128
+
+# httpcore の trace イベント名（末尾の操作名）→ フェーズ
+_TRACE_PHASES = {
+    "connect_tcp": "connect",
+    "start_tls": "tls",
+    "send_request_headers": "send",
+    "send_request_body": "send",
+    "receive_response_headers": "wait",
+    "receive_response_body": "body",
+}
+
+# 実行中の呼び出しのフェーズ別所要時間（start() から stop() まで）
+_phases: ContextVar[Optional[dict]] = ContextVar("aigateway_profile_phases", default=None)
+_enabled = False
+
+
+def active() -> bool:
+    """プロファイリングが有効か（クライアント作成時に計測用の HTTP 層を選ぶために参照）"""
+    return _enabled
+
+
+def start() -> Optional[dict]:
+    """プロファイル有効時、この呼び出しのフェーズ計測を開始（無効なら None）"""
+    if not _enabled:
+        return None
+    phases: dict = {}
+    _phases.set(phases)
+    return phases
+
+
+def stop() -> None:
+    """フェーズ計測を終了"""
+    if _enabled:
+        _phases.set(None)
+
+
+def record(name: str, seconds: float, phases: Optional[dict] = None) -> None:
+    """フェーズの所要時間を加算（計測中でなければ何もしない）"""
+    if phases is None:
+        phases = _phases.get()
+        if phases is None:
+            return
+    phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """with ブロックの所要時間をフェーズとして記録"""
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start_time
+
+
+# =============================================================================
+# requests / urllib3（raw HTTP クライアント）
+# =============================================================================
+
+class _TimedConnectionMixin:
+    """接続・送信・応答ヘッダー待ちを計測する urllib3 接続"""
+
+    def _new_conn(self):
+        # TCP 接続（名前解決を含むため、その間に記録された dns を差し引く）
+        phases = _phases.get()
+        dns_before = phases.get("dns", 0.0) if phases is not None else 0.0
+        start_time = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            if phases is not None:
+                elapsed = time.perf_counter() - start_time
+                record("connect", elapsed - (phases.get("dns", 0.0) - dns_before), phases)
+                self._profile_tcp = elapsed
+
+    def connect(self):
+        self._profile_tcp = 0.0
+        start_time = time.perf_counter()
+        super().connect()
+        if isinstance(self, HTTPSConnection):
+            record("tls", time.perf_counter() - start_time - self._profile_tcp)
+
+    def request(self, *args, **kwargs):
+        with phase("send"):
+            return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        with phase("wait"):
+            return super().getresponse(*args, **kwargs)
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class ProfilingAdapter(HTTPAdapter):
+    """フェーズを計測する接続クラスを使う HTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+    def send(self, request, stream=False, **kwargs):
+        response = super().send(request, stream=stream, **kwargs)
+        if not stream:
+            # requests が後で読む本文をここで読み、受信時間を記録
+            with phase("body"):
+                response.content
+        return response
+
+
+# =============================================================================
+# httpx（OpenAI SDK / loadgen.py）
+# =============================================================================
+
+class TraceRecorder:
+    """httpcore の trace 拡張のコールバック（request.extensions["trace"] に設定）"""
+
+    def __init__(self, phases: dict):
+        self.phases = phases
+        self._started: dict[str, tuple[float, float]] = {}
+
+    def _handle(self, event_name: str, info: dict) -> None:
+        prefix, _, state = event_name.rpartition(".")
+        name = _TRACE_PHASES.get(prefix.rpartition(".")[2])
+        if name is None:
+            return
+        now = time.perf_counter()
+        dns = self.phases.get("dns", 0.0)
+        if state == "started":
+            self._started[prefix] = (now, dns)
+        elif state in ("complete", "failed") and prefix in self._started:
+            started, dns_before = self._started.pop(prefix)
+            # connect_tcp は名前解決を含むため、その間に記録された dns を差し引く
+            record(name, now - started - (dns - dns_before), self.phases)
+
+    def __call__(self, event_name: str, info: dict) -> None:
+        self._handle(event_name, info)
+
+    async def atrace(self, event_name: str, info: dict) -> None:
+        """非同期クライアント（httpx.AsyncClient）用"""
+        self._handle(event_name, info)
+
+
+def attach_trace(request) -> None:
+    """httpx の request イベントフック: 計測中の呼び出しに trace 拡張を付ける"""
+    phases = _phases.get()
+    if phases is not None:
+        request.extensions["trace"] = TraceRecorder(phases)
+
+
+# =============================================================================
+# サンプリングプロファイラー
+# =============================================================================
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """全スレッドのスタックを一定間隔で採取し、folded 形式で集計する"""
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path: str) -> None:
+        write_folded(self.stacks, path)
+
+
+def write_folded(stacks: dict[str, int], path: str) -> None:
+    """スタックごとのサンプル数を folded 形式で書き出す（flamegraph.pl / speedscope で表示）"""
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {count}\n")
+
+
+# =============================================================================
+# 集計・表示
+# =============================================================================
+
+def _quantile(sorted_values: list[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def print_breakdown(title: str, requests: int, total: float, rows: list[tuple]) -> None:
+    """
+    フェーズ別の内訳を表形式で出力
+
+    rows は (フェーズ, 発生回数, 合計秒数, p50, p95)。割合は全呼び出しの所要時間の合計に対する比率です。
+    """
+    print(f"\n  {title}: {requests} calls, mean {total / requests * 1000:.1f}ms")
+    print(f"    {'phase':<10} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'share':>7}")
+    for name, count, seconds, p50, p95 in rows:
+        if not count:
+            continue
+        print(
+            f"    {name:<10} {count:>7} {seconds / count * 1000:>7.1f}ms "
+            f"{(p50 or 0) * 1000:>7.1f}ms {(p95 or 0) * 1000:>7.1f}ms {seconds / total if total else 0:>7.1%}"
+        )
+
+
+class Profiler:
+    """呼び出しごとのフェーズ別所要時間の集計と、サンプリングプロファイラーの管理"""
+
+    def __init__(self, stacks_path: Optional[str] = None, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.stacks_path = stacks_path
+        self.sampler = SamplingProfiler(interval) if stacks_path else None
+        # (api, operation) → {"calls": 件数, "total": 合計秒数, フェーズ: [秒数, ...]}
+        self._groups: dict[tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+        self._resolve = None
+        self._closed = False
+
+    def _getaddrinfo(self, *args, **kwargs):
+        with phase("dns"):
+            return self._resolve(*args, **kwargs)
+
+    def start(self) -> None:
+        """フェーズ計測（と指定時はサンプリング）を開始"""
+        global _enabled
+        _enabled = True
+        self._resolve = socket.getaddrinfo
+        socket.getaddrinfo = self._getaddrinfo
+        if self.sampler:
+            self.sampler.start()
+
+    def observe(self, event) -> None:
+        """gateway_client.add_request_hook に登録して使用"""
+        phases = getattr(event, "phases", None)
+        if phases is None:
+            return
+        with self._lock:
+            group = self._groups.setdefault((event.api, event.operation), {"calls": 0, "total": 0.0})
+            group["calls"] += 1
+            group["total"] += event.duration
+            for name, seconds in phases.items():
+                group.setdefault(name, []).append(seconds)
+            group.setdefault("other", []).append(max(0.0, event.duration - sum(phases.values())))
+
+    def close(self) -> None:
+        """計測を終了し、サンプリング結果を書き出す"""
+        global _enabled
+        if self._closed:
+            return
+        self._closed = True
+        _enabled = False
+        if self._resolve is not None and socket.getaddrinfo == self._getaddrinfo:
+            socket.getaddrinfo = self._resolve
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler.write(self.stacks_path)
+
+    def print_report(self) -> None:
+        """API・操作ごとのフェーズ別内訳を表示"""
+        self.close()
+        print(f"\n{'='*60}")
+        print("Profile（フェーズ別の所要時間）")
+        print(f"{'='*60}")
+        with self._lock:
+            groups = sorted(self._groups.items())
+        for (api, operation), group in groups:
+            rows = []
+            for name in PHASES:
+                values = sorted(group.get(name, ()))
+                rows.append((name, len(values), sum(values), _quantile(values, 0.5), _quantile(values, 0.95)))
+            print_breakdown(f"{api} {operation}", group["calls"], group["total"], rows)
+        if self.sampler:
+            print(f"\n🔥 Stack samples: {self.sampler.samples} → {self.stacks_path}")
+            print("   flamegraph.pl / https://www.speedscope.app で表示できます")
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    """プロファイリング用の CLI 引数を追加"""
+    group = parser.add_argument_group("profiling")
+    group.add_argument(
+        "--profile",
+        action="store_true",
+        default=os.getenv("AIGATEWAY_PROFILE", "").lower() in ("1", "true", "yes"),
+        help="呼び出しごとのフェーズ別所要時間を記録して内訳を表示（環境変数 AIGATEWAY_PROFILE）",
+    )
+    group.add_argument(
+        "--profile-stacks",
+        metavar="PATH",
+        help="サンプリングプロファイラーのスタックを folded 形式で書き出す（--profile を含む）",
+    )
+    group.add_argument(
+        "--profile-interval",
+        type=float,
+        default=DEFAULT_SAMPLE_INTERVAL * 1000,
+        metavar="MS",
+        help=f"スタックの採取間隔（ミリ秒、default: {DEFAULT_SAMPLE_INTERVAL * 1000:g}）",
+    )
+
+
+def start_profiling(args: argparse.Namespace) -> Optional[Profiler]:
+    """
+    CLI 引数に応じてプロファイリングを開始（無効なら None）
+
+    計測用の HTTP 層はクライアント作成時に選ばれるため、クライアントを作る前に呼び出してください。
+    """
+    if not args.profile and not args.profile_stacks:
+        return None
+    profiler = Profiler(args.profile_stacks, args.profile_interval / 1000)
+    profiler.start()
+    atexit.register(profiler.close)
+    print(f"Profiling: phases{' + stacks → ' + args.profile_stacks if args.profile_stacks else ''}")
+    return profiler
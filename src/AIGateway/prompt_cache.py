@@ -0,0 +1,208 @@
+"""
+プロンプトキャッシュ最適化モジュール
+
+Azure OpenAI のプロンプトキャッシュは、リクエスト先頭 1,024 トークン以上が
+前回とバイト単位で一致した場合に適用されます（キャッシュ分は割引・高速化）。
+このモジュールは Chat Completions / Responses API のリクエストを正規化し、
+安定したプレフィックス（system プロンプト・tools 定義）が毎回同一のバイト列で
+先頭に並ぶようにします。また usage の cached_tokens をテンプレート別に集計し、
+キャッシュヒット率をレポートします。
+"""
+
+import hashlib
+import json
+import threading
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import metrics
+import telemetry
+import tokens
+
+# プロンプトキャッシュが有効になる最小プロンプト長
+MIN_CACHEABLE_TOKENS = 1024
+
+# メッセージのキー順序（シリアライズ結果を安定させる）
+_MESSAGE_KEY_ORDER = ("role", "name", "content", "tool_calls", "tool_call_id")
+
+# 先頭（安定プレフィックス側）に置くロール
+_PREFIX_ROLES = {"system", "developer"}
+
+
+def canonical_json(obj: Any) -> str:
+    """キー順・区切り文字を固定した JSON 文字列"""
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def _canonical_message(message: dict) -> dict:
+    """メッセージのキー順を固定（未知のキーは名前順で末尾）"""
+    ordered = {key: message[key] for key in _MESSAGE_KEY_ORDER if key in message}
+    for key in sorted(message.keys() - ordered.keys()):
+        ordered[key] = message[key]
+    if isinstance(ordered.get("content"), str):
+        # 末尾の空白・改行の揺れでプレフィックスが変わらないようにする
+        ordered["content"] = ordered["content"].rstrip()
+    return ordered
+
+
+def _canonical_tools(tools: Optional[list]) -> Optional[list]:
+    """tools 定義を名前順に並べ、内部のキー順も固定"""
+    if not tools:
+        return None
+
+    def tool_name(tool: dict) -> str:
+        return tool.get("function", {}).get("name") or tool.get("name") or ""
+    return [json.loads(canonical_json(t)) for t in sorted(tools, key=tool_name)]
+
+
+@dataclass
+class PromptTemplate:
+    """繰り返し送信する安定したプレフィックス（system プロンプト + tools）"""
+
+    name: str
+    system: str
+    tools: Optional[list] = None
+
+    def __post_init__(self):
+        self.system = self.system.rstrip()
+        self.tools = _canonical_tools(self.tools)
+
+    @property
+    def prefix_hash(self) -> str:
+        """プレフィックスのハッシュ（同一テンプレートなら常に同じ値）"""
+        payload = canonical_json({"system": self.system, "tools": self.tools})
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def prefix_tokens(self, model: str) -> int:
+        """プレフィックスの推定トークン数"""
+        counter = tokens.get_counter(model)
+        system_tokens = counter.count_message({"role": "system", "content": self.system})
+        return system_tokens + counter.count_tools(self.tools)
+
+    def cacheable(self, model: str) -> bool:
+        """プレフィックス単体でキャッシュ対象の長さ（1,024 トークン以上）に達しているか"""
+        return self.prefix_tokens(model) >= MIN_CACHEABLE_TOKENS
+
+
+@dataclass
+class TemplateCacheStats:
+    """テンプレート別のキャッシュ集計"""
+
+    requests: int = 0
+    hits: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """cached_tokens > 0 だったリクエストの割合"""
+        return self.hits / self.requests if self.requests else 0.0
+
+    @property
+    def cached_ratio(self) -> float:
+        """プロンプトトークンのうちキャッシュされた割合"""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+
+class PromptCacheBuilder:
+    """プレフィックスを安定させたリクエストを組み立て、キャッシュヒット率を集計"""
+
+    def __init__(self, registry: Optional[metrics.MetricsRegistry] = None):
+        self._stats: dict[str, TemplateCacheStats] = {}
+        self._lock = threading.Lock()
+        registry = registry or metrics.get_registry()
+        self._token_counter = registry.counter(
+            "aigateway_prompt_template_tokens_total",
+            "テンプレート別のプロンプトトークン数（kind=prompt / cached）",
+            ("template", "kind"),
+        )
+
+    def chat_messages(self, template: PromptTemplate, messages: list) -> list:
+        """
+        Chat Completions 用メッセージを正規化
+
+        テンプレートの system プロンプトを先頭に置き、呼び出し側の system / developer
+        メッセージはその直後、会話メッセージはその後ろに元の順序で並べます。
+        """
+        prefix = [{"role": "system", "content": template.system}]
+        conversation = []
+        for message in messages:
+            if message.get("role") in _PREFIX_ROLES:
+                content = message.get("content")
+                if isinstance(content, str) and content.rstrip() == template.system:
+                    continue
+                prefix.append(_canonical_message(message))
+            else:
+                conversation.append(_canonical_message(message))
+        return prefix + conversation
+
+    def chat_request(self, template: PromptTemplate, messages: list, **params: Any) -> dict:
+        """ChatClient.create(**kwargs) にそのまま渡せる引数を組み立て"""
+        request = {"messages": self.chat_messages(template, messages)}
+        if template.tools:
+            request["tools"] = template.tools
+        request.update(params)
+        return request
+
+    def responses_request(self, template: PromptTemplate, input: Any) -> dict:
+        """
+        ResponsesAPIClient.create_response(**kwargs) 用の引数を組み立て
+
+        system プロンプトは instructions として先頭に固定し、input は正規化します。
+        """
+        if not isinstance(input, str):
+            input = [_canonical_message(item) if "role" in item else item for item in input]
+        return {"instructions": template.system, "input_text": input}
+
+    def record(self, template: PromptTemplate, response: Any) -> Optional[int]:
+        """レスポンスの usage からキャッシュ状況を記録し、cached_tokens を返す"""
+        usage = telemetry.get_field(response, "usage")
+        if usage is None:
+            return None
+        prompt_tokens, _ = telemetry.usage_tokens(usage)
+        details = telemetry.get_field(usage, "prompt_tokens_details") or telemetry.get_field(
+            usage, "input_tokens_details"
+        )
+        cached = telemetry.get_field(details, "cached_tokens") or 0
+
+        with self._lock:
+            stats = self._stats.setdefault(template.name, TemplateCacheStats())
+            stats.requests += 1
+            stats.prompt_tokens += prompt_tokens or 0
+            stats.cached_tokens += cached
+            if cached:
+                stats.hits += 1
+        self._token_counter.inc(prompt_tokens or 0, template=template.name, kind="prompt")
+        self._token_counter.inc(cached, template=template.name, kind="cached")
+        return cached
+
+    def stats(self, template_name: str) -> TemplateCacheStats:
+        with self._lock:
+            return self._stats.get(template_name, TemplateCacheStats())
+
+    def report(self) -> list[dict]:
+        """テンプレート別のキャッシュヒット率レポート"""
+        with self._lock:
+            items = list(self._stats.items())
+        return [
+            {
+                "template": name,
+                "requests": s.requests,
+                "hit_rate": round(s.hit_rate, 3),
+                "prompt_tokens": s.prompt_tokens,
+                "cached_tokens": s.cached_tokens,
+                "cached_ratio": round(s.cached_ratio, 3),
+            }
+            for name, s in items
+        ]
+
+    def print_report(self) -> None:
+        """レポートを表形式で出力"""
+        print("\nPrompt cache:")
+        for row in self.report():
+            print(
+                f"  - {row['template']}: requests={row['requests']}, "
+                f"hit_rate={row['hit_rate']:.1%}, "
+                f"cached={row['cached_tokens']}/{row['prompt_tokens']} tokens "
+                f"({row['cached_ratio']:.1%})"
+            )
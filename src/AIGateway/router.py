@@ -0,0 +1,401 @@
+"""
+モデルルーターモジュール
+
+リクエストごとに、設定されたデプロイメント（AIGatewayConfig.deployments）の中から
+送信先を選択します。判断材料は次のとおりです。
+
+- 推定プロンプトトークン数（tokens.py）と要求 max_tokens
+- デプロイメント別のライブ統計（レイテンシ・出力トークンあたりの時間・429 率）
+- コスト表（100 万トークンあたりの USD 単価）
+
+選択ロジックはポリシーとして差し替え可能で、判断内容は決定ログに残ります。
+既定のポリシーでは、小さなリクエストは安価で高速なモデル、大きなリクエストは
+既定モデルへ送ります。
+
+使用方法:
+    python test_chat_completions.py --model auto
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Collection, Optional, Protocol
+
+import metrics
+import tokens
+
+# ChatClient / ResponsesAPIClient でルーターに委ねるモデル名
+AUTO_MODEL = "auto"
+
+# 組み込みのコスト表（USD / 100 万トークン）と出力速度の事前値（トークン / 秒）
+DEFAULT_COST_TABLE = {
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00, "tokens_per_second": 60},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60, "tokens_per_second": 90},
+}
+
+
+@dataclass
+class DeploymentCost:
+    """デプロイメントの単価（USD / 100 万トークン）"""
+
+    input: float
+    output: float
+    cached_input: Optional[float] = None
+    tokens_per_second: float = 50.0
+
+    def estimate(self, input_tokens: int, output_tokens: int) -> float:
+        """リクエスト 1 件の推定コスト（USD）"""
+        return (input_tokens * self.input + output_tokens * self.output) / 1_000_000
+
+    def actual(self, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
+        """usage からの実コスト（USD、キャッシュ済み入力は cached_input の単価）"""
+        cached_rate = self.cached_input if self.cached_input is not None else self.input
+        cached_tokens = min(cached_tokens, input_tokens)
+        return (
+            (input_tokens - cached_tokens) * self.input
+            + cached_tokens * cached_rate
+            + output_tokens * self.output
+        ) / 1_000_000
+
+
+def load_cost_table(path: Optional[str] = None) -> dict[str, DeploymentCost]:
+    """コスト表を読み込み（JSON ファイル指定時は組み込みの表を上書き）"""
+    table = dict(DEFAULT_COST_TABLE)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            table.update(json.load(f))
+    return {name: DeploymentCost(**values) for name, values in table.items()}
+
+
+def find_cost(costs: dict[str, DeploymentCost], deployment: str) -> Optional[DeploymentCost]:
+    """デプロイメントの単価（表にない場合はモデル名のプレフィックスで探す、なければ None）"""
+    if deployment in costs:
+        return costs[deployment]
+    for name in sorted(costs, key=len, reverse=True):
+        if deployment.startswith(name):
+            return costs[name]
+    return None
+
+
+class DeploymentStats:
+    """デプロイメント別のライブ統計（指数移動平均）"""
+
+    def __init__(self, prior_seconds_per_token: float, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.seconds_per_token = prior_seconds_per_token
+        self.throttle_rate = 0.0
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def observe(self, duration: float, output_tokens: Optional[int], throttled: bool) -> None:
+        a = self.alpha
+        with self._lock:
+            self.samples += 1
+            self.latency = duration if self.latency is None else (1 - a) * self.latency + a * duration
+            if output_tokens:
+                spt = duration / output_tokens
+                self.seconds_per_token = (1 - a) * self.seconds_per_token + a * spt
+            self.throttle_rate = (1 - a) * self.throttle_rate + a * (1.0 if throttled else 0.0)
+
+    def predict_latency(self, output_tokens: int) -> float:
+        """出力トークン数から推定レイテンシを算出"""
+        with self._lock:
+            return self.seconds_per_token * output_tokens
+
+
+@dataclass
+class RoutingRequest:
+    """ルーティング対象のリクエスト概要"""
+
+    prompt_tokens: int
+    max_tokens: Optional[int] = None
+
+    @property
+    def expected_output_tokens(self) -> int:
+        return self.max_tokens or tokens.DEFAULT_EXPECTED_OUTPUT_TOKENS
+
+
+@dataclass
+class Candidate:
+    """ポリシーに渡す候補デプロイメント"""
+
+    deployment: str
+    estimated_cost: float
+    predicted_latency: float
+    throttle_rate: float
+    samples: int
+
+
+class RoutingPolicy(Protocol):
+    """ルーティングポリシー"""
+
+    name: str
+
+    def choose(self, request: RoutingRequest, candidates: list[Candidate]) -> tuple[Candidate, str]:
+        """候補から送信先を選び、(候補, 理由) を返す"""
+        ...
+
+
+class CheapestPolicy:
+    """推定コストが最小のデプロイメントを選択"""
+
+    name = "cheapest"
+
+    def choose(self, request: RoutingRequest, candidates: list[Candidate]) -> tuple[Candidate, str]:
+        best = min(candidates, key=lambda c: c.estimated_cost)
+        return best, f"lowest estimated cost ${best.estimated_cost:.6f}"
+
+
+class FastestPolicy:
+    """推定レイテンシが最小のデプロイメントを選択"""
+
+    name = "fastest"
+
+    def choose(self, request: RoutingRequest, candidates: list[Candidate]) -> tuple[Candidate, str]:
+        best = min(candidates, key=lambda c: c.predicted_latency)
+        return best, f"lowest predicted latency {best.predicted_latency:.2f}s"
+
+
+class WeightedPolicy:
+    """コストとレイテンシを正規化して重み付けしたスコアで選択"""
+
+    name = "weighted"
+
+    def __init__(self, cost_weight: float = 0.5, latency_weight: float = 0.5):
+        self.cost_weight = cost_weight
+        self.latency_weight = latency_weight
+
+    def choose(self, request: RoutingRequest, candidates: list[Candidate]) -> tuple[Candidate, str]:
+        max_cost = max(c.estimated_cost for c in candidates) or 1.0
+        max_latency = max(c.predicted_latency for c in candidates) or 1.0
+
+        def score(c: Candidate) -> float:
+            return (
+                self.cost_weight * c.estimated_cost / max_cost
+                + self.latency_weight * c.predicted_latency / max_latency
+            )
+
+        best = min(candidates, key=score)
+        return best, f"lowest weighted score {score(best):.3f}"
+
+
+class SizeTieredPolicy:
+    """
+    小さなリクエストは安価・高速なモデル、大きなリクエストは既定モデルへ送る
+
+    既定モデルが候補から外れている（429 多発など）場合は小さなリクエストと同じ扱いにします。
+    """
+
+    name = "size-tiered"
+
+    def __init__(
+        self,
+        default_model: str,
+        max_small_prompt_tokens: int = 2000,
+        max_small_output_tokens: int = 400,
+    ):
+        self.default_model = default_model
+        self.max_small_prompt_tokens = max_small_prompt_tokens
+        self.max_small_output_tokens = max_small_output_tokens
+        self._small = WeightedPolicy()
+
+    def choose(self, request: RoutingRequest, candidates: list[Candidate]) -> tuple[Candidate, str]:
+        small = (
+            request.prompt_tokens <= self.max_small_prompt_tokens
+            and request.expected_output_tokens <= self.max_small_output_tokens
+        )
+        if not small:
+            for candidate in candidates:
+                if candidate.deployment == self.default_model:
+                    return candidate, "large request → default model"
+        best, reason = self._small.choose(request, candidates)
+        return best, f"small request → {reason}" if small else f"default unavailable → {reason}"
+
+
+@dataclass
+class RoutingDecision:
+    """決定ログの 1 エントリ"""
+
+    timestamp: float
+    policy: str
+    deployment: str
+    reason: str
+    prompt_tokens: int
+    max_tokens: Optional[int]
+    candidates: list[dict] = field(default_factory=list)
+    excluded: list[str] = field(default_factory=list)
+
+
+class ModelRouter:
+    """デプロイメントを選択するルーター"""
+
+    def __init__(
+        self,
+        deployments: list[str],
+        costs: Optional[dict[str, DeploymentCost]] = None,
+        policy: Optional[RoutingPolicy] = None,
+        max_throttle_rate: float = 0.5,
+        decision_log_path: Optional[str] = None,
+        decision_log_size: int = 1000,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        if not deployments:
+            raise ValueError("ルーティング対象のデプロイメントがありません")
+        self.deployments = list(deployments)
+        self.costs = costs or load_cost_table()
+        self.policy = policy or SizeTieredPolicy(self.deployments[0])
+        self.max_throttle_rate = max_throttle_rate
+        self.decision_log_path = decision_log_path
+        self.decisions: deque = deque(maxlen=decision_log_size)
+        self._lock = threading.Lock()
+        self.stats = {
+            name: DeploymentStats(1.0 / self._cost(name).tokens_per_second)
+            for name in self.deployments
+        }
+
+        registry = registry or metrics.get_registry()
+        self._routed = registry.counter(
+            "aigateway_router_decisions_total",
+            "ルーターが選択したデプロイメント別の件数",
+            ("policy", "deployment"),
+        )
+
+    @classmethod
+    def from_config(
+        cls,
+        config,
+        policy: Optional[RoutingPolicy] = None,
+        skip_unknown: bool = False,
+        **kwargs,
+    ) -> "ModelRouter":
+        """
+        AIGatewayConfig からルーターを作成
+
+        skip_unknown=True の場合、コスト表にないデプロイメントは候補から外します
+        （サーキットブレーカーの迂回先の選択だけに使う場合。すべてなければ ValueError）。
+        """
+        costs = load_cost_table(config.cost_table_path)
+        deployments = config.deployments
+        if skip_unknown:
+            deployments = [name for name in deployments if find_cost(costs, name) is not None]
+        return cls(
+            deployments,
+            costs=costs,
+            policy=policy or SizeTieredPolicy(config.default_model),
+            **kwargs,
+        )
+
+    def _cost(self, deployment: str) -> DeploymentCost:
+        cost = find_cost(self.costs, deployment)
+        if cost is not None:
+            return cost
+        raise ValueError(f"コスト表に {deployment} がありません（MODEL_COST_TABLE で指定してください）")
+
+    def observe(self, event) -> None:
+        """gateway_client.RequestEvent を統計に反映（add_request_hook に登録して使用）"""
+        stats = self.stats.get(event.model)
+        if stats is None or (event.status_code is None and not event.throttled):
+            return
+        stats.observe(event.duration, event.output_tokens, event.throttled > 0)
+
+    def candidates(
+        self, request: RoutingRequest, unavailable: Collection[str] = ()
+    ) -> tuple[list[Candidate], list[str]]:
+        """候補デプロイメントと、429 率が高いか unavailable（回路が開いている等）で除外したデプロイメント"""
+        output_tokens = request.expected_output_tokens
+        everything = [
+            Candidate(
+                deployment=name,
+                estimated_cost=self._cost(name).estimate(request.prompt_tokens, output_tokens),
+                predicted_latency=self.stats[name].predict_latency(output_tokens),
+                throttle_rate=self.stats[name].throttle_rate,
+                samples=self.stats[name].samples,
+            )
+            for name in self.deployments
+        ]
+        available = [c for c in everything if c.deployment not in unavailable] or everything
+        candidates = [c for c in available if c.throttle_rate <= self.max_throttle_rate]
+        excluded = [c.deployment for c in everything if c not in candidates]
+        if not candidates:
+            # すべて 429 多発中なら、最も 429 率の低いものを残す
+            candidates = [min(available, key=lambda c: c.throttle_rate)]
+        return candidates, excluded
+
+    def route(self, request: RoutingRequest, unavailable: Collection[str] = ()) -> str:
+        """送信先デプロイメントを選択（unavailable はできる限り避ける）"""
+        candidates, excluded = self.candidates(request, unavailable)
+        chosen, reason = self.policy.choose(request, candidates)
+        decision = RoutingDecision(
+            timestamp=time.time(),
+            policy=self.policy.name,
+            deployment=chosen.deployment,
+            reason=reason,
+            prompt_tokens=request.prompt_tokens,
+            max_tokens=request.max_tokens,
+            candidates=[asdict(c) for c in candidates],
+            excluded=excluded,
+        )
+        self._log(decision)
+        self._routed.inc(policy=self.policy.name, deployment=chosen.deployment)
+        return chosen.deployment
+
+    def route_chat(
+        self,
+        messages: list,
+        max_tokens: Optional[int] = None,
+        tools: Any = None,
+        unavailable: Collection[str] = (),
+    ) -> str:
+        """Chat Completions リクエストの送信先を選択"""
+        prompt_tokens = tokens.estimate_chat_tokens(self.deployments[0], messages, tools)
+        return self.route(RoutingRequest(prompt_tokens, max_tokens), unavailable)
+
+    def route_responses(
+        self,
+        input: Any,
+        instructions: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        unavailable: Collection[str] = (),
+    ) -> str:
+        """Responses API リクエストの送信先を選択"""
+        prompt_tokens = tokens.estimate_responses_tokens(self.deployments[0], input, instructions)
+        return self.route(RoutingRequest(prompt_tokens, max_tokens), unavailable)
+
+    def _log(self, decision: RoutingDecision) -> None:
+        with self._lock:
+            self.decisions.append(decision)
+            if self.decision_log_path:
+                with open(self.decision_log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(asdict(decision), ensure_ascii=False) + "\n")
+
+    def report(self) -> list[dict]:
+        """デプロイメント別の選択回数とライブ統計"""
+        with self._lock:
+            decisions = list(self.decisions)
+        rows = []
+        for name in self.deployments:
+            stats = self.stats[name]
+            rows.append({
+                "deployment": name,
+                "routed": sum(1 for d in decisions if d.deployment == name),
+                "samples": stats.samples,
+                "latency": stats.latency,
+                "seconds_per_token": stats.seconds_per_token,
+                "throttle_rate": stats.throttle_rate,
+            })
+        return rows
+
+    def print_report(self) -> None:
+        """レポートを表形式で出力"""
+        print(f"\nRouting ({self.policy.name}):")
+        for row in self.report():
+            latency = f"{row['latency']:.2f}s" if row["latency"] is not None else "-"
+            print(
+                f"  - {row['deployment']}: routed={row['routed']}, "
+                f"latency={latency}, "
+                f"{row['seconds_per_token'] * 1000:.1f} ms/token, "
+                f"429={row['throttle_rate']:.1%}"
+            )
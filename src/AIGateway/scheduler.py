@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+優先度スケジューラーモジュール
+
+対話的な Chat Completions と、バックグラウンドの Responses API ジョブ（background=True）が
+同じ APIM サブスクリプションのクォータを奪い合わないよう、クライアント側で送信順を制御します。
+
+- 優先度クラス: 既定は interactive（重み 9）と batch（重み 1、同時実行は容量の半分まで）。
+  background=True の create_response は batch、それ以外は既定クラスで送信します。
+- 重み付き公平キューイング（WFQ）: 推定トークン数 / 重み で仮想終了時刻を付け、
+  空きが出たら最も早いものから送信します。混雑時の配分は重みの比になります。
+  batch は長時間実行枠を保持するため、interactive が待っていなくても容量の半分（max_share）までに
+  制限し、interactive の到着に備えて常に空きを残します。
+- クラスごとのトークン予算（トークン / 分）: 予算を使い切ったクラスは補充されるまで待機します。
+  推定値で先に差し引き、応答の usage で実績に補正します。
+
+バックグラウンドレスポンスはサーバー側で生成が続くため、完了（get_response で終了状態を
+確認）するまで実行枠を保持します。クラスごとの待機時間・待機数・実行数・トークン数を
+メトリクスとして出力します。
+
+使用方法:
+    python test_responses_api.py --all --scheduler-capacity 8
+    python scheduler.py                 # 模擬負荷で interactive の待機時間を確認
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+from concurrency import QUEUE_TIME_BUCKETS
+from tokens import DEFAULT_EXPECTED_OUTPUT_TOKENS
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+
+@dataclass
+class PriorityClass:
+    """優先度クラス"""
+
+    name: str
+    weight: float = 1.0
+    # 同時実行数の上限（容量に対する割合）。interactive の到着に備えて空きを残す
+    max_share: float = 1.0
+    # トークン / 分（None なら無制限）
+    tokens_per_minute: Optional[float] = None
+
+
+DEFAULT_CLASSES = (
+    PriorityClass(INTERACTIVE, weight=9.0),
+    PriorityClass(BATCH, weight=1.0, max_share=0.5),
+)
+
+
+class TokenBudget:
+    """トークン / 分のトークンバケット（1 分ぶんまで貯められ、超過分は借りとして扱う）"""
+
+    def __init__(self, tokens_per_minute: float):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = tokens_per_minute
+        self._updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self) -> bool:
+        self.refill()
+        return self.tokens > 0
+
+
+class Ticket:
+    """スケジューラーの順番待ち 1 件（acquire() で返り、release() で返却）"""
+
+    __slots__ = ("priority", "cost", "finish", "enqueued", "granted")
+
+    def __init__(self, priority: str, cost: int, finish: float):
+        self.priority = priority
+        self.cost = cost
+        self.finish = finish
+        self.enqueued = time.perf_counter()
+        self.granted = False
+
+
+class Scheduler:
+    """優先度クラス付き WFQ スケジューラー（全クライアントで共有）"""
+
+    def __init__(
+        self,
+        capacity: int = 8,
+        classes: tuple[PriorityClass, ...] = DEFAULT_CLASSES,
+        default_class: str = INTERACTIVE,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        self.capacity = capacity
+        self.classes = {c.name: c for c in classes}
+        if default_class not in self.classes:
+            raise ValueError(f"優先度クラス {default_class} がありません")
+        self.default_class = default_class
+        self.budgets = {
+            c.name: TokenBudget(c.tokens_per_minute) for c in classes if c.tokens_per_minute
+        }
+        self._queues: dict[str, deque] = {name: deque() for name in self.classes}
+        self._last_finish = {name: 0.0 for name in self.classes}
+        self._virtual_time = 0.0
+        self.inflight = {name: 0 for name in self.classes}
+        self.dispatched = {name: 0 for name in self.classes}
+        self.tokens = {name: 0 for name in self.classes}
+        self._cond = threading.Condition()
+
+        registry = registry or metrics.get_registry()
+        self._queue_time = registry.histogram(
+            "aigateway_scheduler_queue_seconds",
+            "送信までの待機時間",
+            ("priority",),
+            buckets=QUEUE_TIME_BUCKETS,
+        )
+        self._queued_gauge = registry.gauge(
+            "aigateway_scheduler_queued", "待機中の呼び出し数", ("priority",)
+        )
+        self._inflight_gauge = registry.gauge(
+            "aigateway_scheduler_inflight", "実行中の呼び出し数", ("priority",)
+        )
+        self._tokens = registry.counter(
+            "aigateway_scheduler_tokens_total", "消費したトークン数（実績）", ("priority",)
+        )
+
+    def _max_inflight(self, name: str) -> int:
+        return max(1, int(self.capacity * self.classes[name].max_share))
+
+    def _dispatch(self) -> None:
+        """空きがある限り、送信可能なクラスの先頭から仮想終了時刻の早いものを許可"""
+        granted = False
+        while sum(self.inflight.values()) < self.capacity:
+            best = None
+            for name, queue in self._queues.items():
+                if not queue or self.inflight[name] >= self._max_inflight(name):
+                    continue
+                budget = self.budgets.get(name)
+                if budget is not None and not budget.available():
+                    continue
+                if best is None or queue[0].finish < best.finish:
+                    best = queue[0]
+            if best is None:
+                break
+            self._queues[best.priority].popleft()
+            best.granted = True
+            granted = True
+            self._virtual_time = best.finish
+            self.inflight[best.priority] += 1
+            self.dispatched[best.priority] += 1
+            budget = self.budgets.get(best.priority)
+            if budget is not None:
+                budget.tokens -= best.cost
+            self._queued_gauge.set(len(self._queues[best.priority]), priority=best.priority)
+            self._inflight_gauge.set(self.inflight[best.priority], priority=best.priority)
+        if granted:
+            self._cond.notify_all()
+
+    def acquire(self, priority: Optional[str], cost: int, timeout: Optional[float] = None) -> Ticket:
+        """cost（推定トークン数）ぶんの順番を待って実行枠を確保（timeout 秒を過ぎたら TimeoutError）"""
+        priority = priority or self.default_class
+        if priority not in self.classes:
+            raise ValueError(f"優先度クラス {priority} がありません（{', '.join(self.classes)}）")
+        with self._cond:
+            start = max(self._virtual_time, self._last_finish[priority])
+            ticket = Ticket(priority, cost, start + max(cost, 1) / self.classes[priority].weight)
+            self._last_finish[priority] = ticket.finish
+            self._queues[priority].append(ticket)
+            self._queued_gauge.set(len(self._queues[priority]), priority=priority)
+            self._dispatch()
+            while not ticket.granted:
+                waited = time.perf_counter() - ticket.enqueued
+                if timeout is not None and waited >= timeout:
+                    self._queues[priority].remove(ticket)
+                    self._queued_gauge.set(len(self._queues[priority]), priority=priority)
+                    raise TimeoutError(f"{priority} の順番を {timeout:g} 秒以内に確保できませんでした")
+                # トークン予算の補充を拾うため定期的に再評価
+                wait = 0.1 if timeout is None else min(0.1, timeout - waited)
+                self._cond.wait(timeout=wait)
+                if not ticket.granted:
+                    self._dispatch()
+        self._queue_time.observe(time.perf_counter() - ticket.enqueued, priority=priority)
+        return ticket
+
+    def release(self, ticket: Ticket, tokens: Optional[int] = None) -> None:
+        """実行枠を返却（tokens に実績のトークン数を渡すと予算を補正）"""
+        used = tokens if tokens is not None else ticket.cost
+        with self._cond:
+            self.inflight[ticket.priority] -= 1
+            self.tokens[ticket.priority] += used
+            budget = self.budgets.get(ticket.priority)
+            if budget is not None:
+                budget.tokens -= used - ticket.cost
+            self._inflight_gauge.set(self.inflight[ticket.priority], priority=ticket.priority)
+            self._dispatch()
+        self._tokens.inc(used, priority=ticket.priority)
+
+    @staticmethod
+    def estimate_cost(prompt_tokens: int, max_tokens: Optional[int] = None) -> int:
+        """推定トークン数（プロンプト + 出力上限、不明なら既定の見積もり）"""
+        return prompt_tokens + (max_tokens or DEFAULT_EXPECTED_OUTPUT_TOKENS)
+
+    def report(self) -> list[dict]:
+        """クラスごとの送信数・待機時間・トークン数"""
+        rows = []
+        for name, cls in self.classes.items():
+            rows.append({
+                "priority": name,
+                "weight": cls.weight,
+                "dispatched": self.dispatched[name],
+                "queued": len(self._queues[name]),
+                "queue_p50": self._queue_time.quantile(0.5, priority=name),
+                "queue_p95": self._queue_time.quantile(0.95, priority=name),
+                "tokens": self.tokens[name],
+            })
+        return rows
+
+    def print_report(self) -> None:
+        """レポートを表形式で出力"""
+        print(f"\nScheduler (capacity {self.capacity}):")
+        for row in self.report():
+            p50 = f"{row['queue_p50'] * 1000:.0f}ms" if row["queue_p50"] is not None else "-"
+            p95 = f"{row['queue_p95'] * 1000:.0f}ms" if row["queue_p95"] is not None else "-"
+            print(
+                f"  - {row['priority']} (weight {row['weight']:g}): dispatched={row['dispatched']}, "
+                f"queue p50={p50}, p95={p95}, tokens={row['tokens']}"
+            )
+
+
+def parse_budgets(values: list[str]) -> dict[str, float]:
+    """"batch=200000" 形式のトークン予算指定を解析"""
+    budgets = {}
+    for value in values:
+        name, sep, tpm = value.partition("=")
+        if not sep:
+            raise ValueError(f"トークン予算は クラス名=トークン/分 の形式で指定してください: {value}")
+        budgets[name] = float(tpm)
+    return budgets
+
+
+def add_scheduler_arguments(parser: argparse.ArgumentParser) -> None:
+    """優先度スケジューラー用の CLI 引数を追加"""
+    group = parser.add_argument_group("scheduler")
+    group.add_argument(
+        "--scheduler-capacity",
+        type=int,
+        default=int(os.getenv("AIGATEWAY_SCHEDULER_CAPACITY", "0")) or None,
+        help="優先度スケジューラーを有効化し、同時実行数をこの値に制限（環境変数 AIGATEWAY_SCHEDULER_CAPACITY）",
+    )
+    group.add_argument(
+        "--priority",
+        choices=[c.name for c in DEFAULT_CLASSES],
+        help="この実行の呼び出しの優先度クラス (default: interactive、background は batch)",
+    )
+    group.add_argument(
+        "--token-budget",
+        action="append",
+        default=[],
+        metavar="CLASS=TPM",
+        help="クラスごとのトークン予算（例: batch=200000、複数指定可）",
+    )
+
+
+def create_scheduler(args: argparse.Namespace) -> Optional[Scheduler]:
+    """CLI 引数に応じてスケジューラーを作成（無効なら None）"""
+    if not args.scheduler_capacity:
+        return None
+    budgets = parse_budgets(args.token_budget)
+    classes = tuple(
+        PriorityClass(c.name, c.weight, c.max_share, budgets.get(c.name, c.tokens_per_minute))
+        for c in DEFAULT_CLASSES
+    )
+    return Scheduler(args.scheduler_capacity, classes, default_class=args.priority or INTERACTIVE)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="優先度スケジューラーの模擬負荷テスト",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python scheduler.py
+  python scheduler.py --capacity 4 --batch-clients 50 --duration 10
+        """
+    )
+    parser.add_argument("--capacity", type=int, default=8, help="同時実行数 (default: 8)")
+    parser.add_argument("--interactive-clients", type=int, default=4, help="interactive の呼び出し元スレッド数 (default: 4)")
+    parser.add_argument("--batch-clients", type=int, default=32, help="batch の呼び出し元スレッド数 (default: 32)")
+    parser.add_argument("--duration", "-d", type=float, default=5.0, help="実行時間（秒） (default: 5)")
+    parser.add_argument("--service-time", type=float, default=0.05, help="1000 トークンあたりの処理時間（秒） (default: 0.05)")
+    args = parser.parse_args()
+
+    scheduler = Scheduler(args.capacity)
+    deadline = time.monotonic() + args.duration
+
+    def client(priority: str, cost: int, think_time: float) -> None:
+        while time.monotonic() < deadline:
+            ticket = scheduler.acquire(priority, cost)
+            time.sleep(args.service_time * cost / 1000 * random.uniform(0.8, 1.2))
+            scheduler.release(ticket)
+            time.sleep(think_time * random.random())
+
+    threads = [
+        threading.Thread(target=client, args=(INTERACTIVE, 500, 0.2), daemon=True)
+        for _ in range(args.interactive_clients)
+    ] + [
+        threading.Thread(target=client, args=(BATCH, 2000, 0.0), daemon=True)
+        for _ in range(args.batch_clients)
+    ]
+    print(f"Capacity: {args.capacity}, interactive: {args.interactive_clients}, batch: {args.batch_clients}")
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scheduler.print_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+リクエスト合流（single-flight）モジュール
+
+同一内容（モデル・入力・パラメーターのハッシュが一致）のリクエストが同時に
+実行中の場合、最初の 1 件（リーダー）だけを AI Gateway に送信し、後続（フォロワー）は
+リーダーの結果を待って共有します。ストリーミングの場合は 1 本のストリームを
+複数の購読者に配信します（途中から合流した購読者には先頭から再生）。
+
+注意: フォロワーはリーダーと同一のレスポンスオブジェクトを受け取ります。
+      結果を書き換える場合は呼び出し側でコピーしてください。
+"""
+
+import contextvars
+import hashlib
+import threading
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+import metrics
+from prompt_cache import canonical_json
+
+
+def request_key(**params: Any) -> str:
+    """リクエスト内容（model / messages / input / その他パラメーター）のハッシュ"""
+    payload = canonical_json({k: v for k, v in params.items() if v is not None})
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    """実行中の非ストリーミング呼び出し"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _StreamCall:
+    """実行中のストリーミング呼び出し（チャンクを購読者へ配信）"""
+
+    def __init__(self):
+        self.chunks: list = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+
+class SingleFlight:
+    """同一キーの同時実行を 1 回にまとめる"""
+
+    def __init__(self, group: str = "default", registry: Optional[metrics.MetricsRegistry] = None):
+        self.group = group
+        self._lock = threading.Lock()
+        self._calls: dict[str, _Call] = {}
+        self._streams: dict[str, _StreamCall] = {}
+
+        registry = registry or metrics.get_registry()
+        self._leaders = registry.counter(
+            "aigateway_singleflight_leader_requests_total",
+            "single-flight で実際に送信したリクエスト数",
+            ("group", "kind"),
+        )
+        self._coalesced = registry.counter(
+            "aigateway_singleflight_coalesced_requests_total",
+            "実行中のリクエストに合流して送信を省略したリクエスト数",
+            ("group", "kind"),
+        )
+
+    @property
+    def coalesced(self) -> int:
+        """合流したリクエストの累計"""
+        return int(
+            self._coalesced.value(group=self.group, kind="unary")
+            + self._coalesced.value(group=self.group, kind="stream")
+        )
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        fn を実行して結果を返す
+
+        同一 key の呼び出しが実行中なら fn は呼ばず、その結果（または例外）を共有します。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._coalesced.inc(group=self.group, kind="unary")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self._leaders.inc(group=self.group, kind="unary")
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def do_stream(self, key: str, fn: Callable[[], Iterable]) -> Iterator:
+        """
+        fn が返すストリームを購読するイテレーターを返す
+
+        同一 key のストリームが配信中なら新たに送信せず、そのストリームを購読します。
+        ストリームはバックグラウンドスレッドで読み進めるため、購読者ごとの読み取り速度に
+        依存せず、購読者が途中で離脱しても他の購読者には影響しません。
+        """
+        with self._lock:
+            call = self._streams.get(key)
+            leader = call is None
+            if leader:
+                call = self._streams[key] = _StreamCall()
+            with call.cond:
+                call.subscribers += 1
+
+        if leader:
+            self._leaders.inc(group=self.group, kind="stream")
+            # デッドライン・親スパン等のコンテキストをリーダーのストリームを読むスレッドに引き継ぐ
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._pump, key, call, fn),
+                name="singleflight-stream",
+                daemon=True,
+            ).start()
+        else:
+            self._coalesced.inc(group=self.group, kind="stream")
+        return self._subscribe(call)
+
+    def _pump(self, key: str, call: _StreamCall, fn: Callable[[], Iterable]) -> None:
+        stream = None
+        try:
+            stream = iter(fn())
+            for chunk in stream:
+                with call.cond:
+                    call.chunks.append(chunk)
+                    call.cond.notify_all()
+                    if call.subscribers:
+                        continue
+                # 購読者が全員離脱した: do_stream と同じ順にロックを取り、新たな合流を締め切ってから
+                # 再確認する（途中で打ち切ったストリームに合流して、欠けた結果を正常終了として受け取らないように）
+                with self._lock, call.cond:
+                    abandoned = call.subscribers == 0
+                    if abandoned and self._streams.get(key) is call:
+                        del self._streams[key]
+                if abandoned:
+                    break
+        except BaseException as e:
+            call.error = e
+        finally:
+            if stream is not None and hasattr(stream, "close"):
+                # 打ち切った場合もストリーム（ChatClient._stream）を閉じて接続と実行枠を返す
+                stream.close()
+            with self._lock:
+                if self._streams.get(key) is call:
+                    del self._streams[key]
+            with call.cond:
+                call.finished = True
+                call.cond.notify_all()
+
+    def _subscribe(self, call: _StreamCall) -> Iterator:
+        index = 0
+        try:
+            while True:
+                with call.cond:
+                    while index >= len(call.chunks) and not call.finished:
+                        call.cond.wait()
+                    if index >= len(call.chunks):
+                        if call.error is not None:
+                            raise call.error
+                        return
+                    chunk = call.chunks[index]
+                index += 1
+                yield chunk
+        finally:
+            with call.cond:
+                call.subscribers -= 1
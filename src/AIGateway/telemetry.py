@@ -0,0 +1,549 @@
+"""
+AI Gateway テレメトリモジュール
+
+AI Gateway クライアント向けの OpenTelemetry 計装を提供します。
+
+- 既定では無効（オプトイン）。無効時は共有の no-op スパンを返すだけなので、
+  呼び出し側のオーバーヘッドは関数呼び出し 1 回分に収まります。
+- ルートスパン単位でサンプリングし、子スパンは親の判定に従います。
+- 属性は OpenTelemetry GenAI セマンティック規約（gen_ai.*）に合わせています。
+- エクスポートは有界キュー + バックグラウンドのバッチ送信で行い、キューが
+  溢れた場合はスパンを破棄して件数を数えます（リクエスト経路をブロックしない）。
+- プロンプト / 応答内容の記録は既定で無効。有効時も切り詰め・サンプリングします。
+
+環境変数:
+    AIGATEWAY_OTEL_ENABLED: true で計装を有効化
+    AIGATEWAY_OTEL_SAMPLE_RATE: ルートスパンのサンプリング率（0.0〜1.0、既定 1.0）
+    AIGATEWAY_OTEL_EXPORTER: console / otlp / azure-monitor / none（既定 none）
+    APPLICATIONINSIGHTS_CONNECTION_STRING: azure-monitor エクスポーター用接続文字列
+    AIGATEWAY_OTEL_MAX_QUEUE_SIZE: エクスポート待ちキューの上限（既定 2048）
+    AIGATEWAY_OTEL_MAX_BATCH_SIZE: 1 回のエクスポートの最大スパン数（既定 512）
+    AIGATEWAY_OTEL_EXPORT_INTERVAL: エクスポート間隔（秒、既定 5.0）
+    AIGATEWAY_OTEL_CAPTURE_CONTENT: true でプロンプト / 応答内容を記録
+    AIGATEWAY_OTEL_CONTENT_MAX_CHARS: 記録する内容の最大文字数（既定 1000）
+    AIGATEWAY_OTEL_CONTENT_SAMPLE_RATE: 内容を記録するスパンの割合（既定 0.1）
+"""
+
+import contextvars
+import json
+import os
+import queue
+import random
+import sys
+import threading
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+import metrics
+
+try:
+    from opentelemetry.sdk.trace import SpanProcessor as _SpanProcessorBase
+except ImportError:
+    _SpanProcessorBase = object
+
+# GenAI セマンティック規約の gen_ai.system 値（Azure OpenAI）
+GEN_AI_SYSTEM = "az.ai.openai"
+
+# 計装スコープ名
+TRACER_NAME = "foundry-control-plane.aigateway"
+
+# サンプリング対象外になったルート配下では子スパンも作らない
+_suppressed: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "aigateway_telemetry_suppressed", default=False
+)
+
+
+@dataclass
+class TelemetryConfig:
+    """テレメトリ設定"""
+
+    enabled: bool = False
+    sample_rate: float = 1.0
+    exporter: str = "none"
+    connection_string: Optional[str] = None
+    max_queue_size: int = 2048
+    max_batch_size: int = 512
+    export_interval: float = 5.0
+    capture_content: bool = False
+    content_max_chars: int = 1000
+    content_sample_rate: float = 0.1
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on"}
+
+
+def load_telemetry_config() -> TelemetryConfig:
+    """環境変数からテレメトリ設定を読み込み"""
+    sample_rate = float(os.getenv("AIGATEWAY_OTEL_SAMPLE_RATE", "1.0"))
+    content_sample_rate = float(os.getenv("AIGATEWAY_OTEL_CONTENT_SAMPLE_RATE", "0.1"))
+    return TelemetryConfig(
+        enabled=_env_bool("AIGATEWAY_OTEL_ENABLED"),
+        sample_rate=min(max(sample_rate, 0.0), 1.0),
+        exporter=os.getenv("AIGATEWAY_OTEL_EXPORTER", "none").strip().lower(),
+        connection_string=os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"),
+        max_queue_size=int(os.getenv("AIGATEWAY_OTEL_MAX_QUEUE_SIZE", "2048")),
+        max_batch_size=int(os.getenv("AIGATEWAY_OTEL_MAX_BATCH_SIZE", "512")),
+        export_interval=float(os.getenv("AIGATEWAY_OTEL_EXPORT_INTERVAL", "5.0")),
+        capture_content=_env_bool("AIGATEWAY_OTEL_CAPTURE_CONTENT"),
+        content_max_chars=int(os.getenv("AIGATEWAY_OTEL_CONTENT_MAX_CHARS", "1000")),
+        content_sample_rate=min(max(content_sample_rate, 0.0), 1.0),
+    )
+
+
+class _NoopSpan:
+    """計装無効時・サンプリング対象外で返すスパン"""
+
+    __slots__ = ()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, attributes: dict) -> None:
+        pass
+
+    def add_event(self, name: str, attributes: Optional[dict] = None) -> None:
+        pass
+
+    def record_exception(self, exc: BaseException) -> None:
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _SuppressedSpan(_NoopSpan):
+    """サンプリング対象外のルートスパン（配下の子スパンも抑止）"""
+
+    __slots__ = ("_token",)
+
+    def __enter__(self) -> "_SuppressedSpan":
+        self._token = _suppressed.set(True)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        _suppressed.reset(self._token)
+        return False
+
+
+class _Span:
+    """OpenTelemetry スパンの薄いラッパー"""
+
+    __slots__ = ("_span", "_scope")
+
+    def __init__(self, span):
+        self._span = span
+        self._scope = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is not None:
+            self._span.set_attribute(key, value)
+
+    def set_attributes(self, attributes: dict) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_event(self, name: str, attributes: Optional[dict] = None) -> None:
+        self._span.add_event(name, attributes=attributes or {})
+
+    def record_exception(self, exc: BaseException) -> None:
+        from opentelemetry.trace import Status, StatusCode
+
+        self._span.record_exception(exc)
+        self._span.set_attribute("error.type", type(exc).__qualname__)
+        self._span.set_status(Status(StatusCode.ERROR, str(exc)))
+
+    def is_recording(self) -> bool:
+        return self._span.is_recording()
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """スパンを終了（コンテキストマネージャーを使わない場合）"""
+        if error is not None:
+            self.record_exception(error)
+        self._span.end()
+
+    def __enter__(self) -> "_Span":
+        from opentelemetry import trace
+
+        self._scope = trace.use_span(
+            self._span,
+            end_on_exit=False,
+            record_exception=False,
+            set_status_on_exception=False,
+        )
+        self._scope.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        try:
+            if exc is not None:
+                self.record_exception(exc)
+        finally:
+            self._scope.__exit__(exc_type, exc, tb)
+            self._span.end()
+        return False
+
+
+class _TelemetryState:
+    """プロセス内のテレメトリ状態"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.tracer = None
+        self.capture_content = False
+        self.content_max_chars = 1000
+        self.content_sample_rate = 0.1
+
+
+_state = _TelemetryState()
+
+
+def configure_telemetry(config: Optional[TelemetryConfig] = None) -> bool:
+    """
+    テレメトリを初期化
+
+    OpenTelemetry が未インストール、または無効設定の場合は何もせず False を返します。
+    既にグローバルな TracerProvider が設定済み（configure_azure_monitor 等）の場合は
+    それを利用し、エクスポーターは追加しません。
+    """
+    config = config or load_telemetry_config()
+    if not config.enabled:
+        _state.enabled = False
+        return False
+
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        print(
+            "⚠️ opentelemetry がインストールされていないためテレメトリを無効化します "
+            "(pip install opentelemetry-sdk)",
+            file=sys.stderr,
+        )
+        _state.enabled = False
+        return False
+
+    if config.exporter != "none":
+        _install_provider(config)
+
+    _state.tracer = trace.get_tracer(TRACER_NAME)
+    _state.sample_rate = config.sample_rate
+    _state.capture_content = config.capture_content
+    _state.content_max_chars = config.content_max_chars
+    _state.content_sample_rate = config.content_sample_rate
+    _state.enabled = True
+    return True
+
+
+def _install_provider(config: TelemetryConfig) -> None:
+    """TracerProvider とエクスポーターを設定（未設定の場合のみ）"""
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+
+    if isinstance(trace.get_tracer_provider(), TracerProvider):
+        return
+
+    exporter = _create_exporter(config)
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": "aigateway-client"})
+    )
+    provider.add_span_processor(
+        BoundedBatchSpanProcessor(
+            exporter,
+            max_queue_size=config.max_queue_size,
+            max_batch_size=config.max_batch_size,
+            export_interval=config.export_interval,
+        )
+    )
+    trace.set_tracer_provider(provider)
+
+
+class BoundedBatchSpanProcessor(_SpanProcessorBase):
+    """
+    有界キューとバックグラウンドスレッドでスパンをまとめてエクスポートする SpanProcessor
+
+    on_end はキューへの put_nowait のみで、キューが満杯ならスパンを破棄して
+    aigateway_telemetry_dropped_spans_total を加算します。エクスポートの遅延や
+    失敗がモデル呼び出しのレイテンシに影響することはありません。
+    """
+
+    def __init__(
+        self,
+        exporter,
+        max_queue_size: int = 2048,
+        max_batch_size: int = 512,
+        export_interval: float = 5.0,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        self.exporter = exporter
+        self.max_batch_size = max_batch_size
+        self.export_interval = export_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._wake = threading.Event()
+        self._flushed = threading.Condition()
+        self._shutdown = False
+
+        registry = registry or metrics.get_registry()
+        self.dropped = registry.counter(
+            "aigateway_telemetry_dropped_spans_total",
+            "エクスポートキューが満杯で破棄したスパン数",
+        )
+        self.exported = registry.counter(
+            "aigateway_telemetry_exported_spans_total",
+            "エクスポートしたスパン数",
+        )
+        self.export_failures = registry.counter(
+            "aigateway_telemetry_export_failures_total",
+            "エクスポートに失敗したバッチ数",
+        )
+        self.queue_size = registry.gauge(
+            "aigateway_telemetry_queue_size",
+            "エクスポート待ちのスパン数",
+        )
+
+        self._worker = threading.Thread(
+            target=self._run, name="telemetry-export", daemon=True
+        )
+        self._worker.start()
+
+    def on_start(self, span, parent_context=None) -> None:
+        pass
+
+    def on_end(self, span) -> None:
+        if self._shutdown or not span.context.trace_flags.sampled:
+            return
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped.inc()
+            return
+        if self._queue.qsize() >= self.max_batch_size:
+            self._wake.set()
+
+    def _run(self) -> None:
+        while not self._shutdown:
+            self._wake.wait(self.export_interval)
+            self._wake.clear()
+            self._export_all()
+            with self._flushed:
+                self._flushed.notify_all()
+        self._export_all()
+
+    def _export_all(self) -> None:
+        while True:
+            batch = []
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.queue_size.set(self._queue.qsize())
+            if not batch:
+                return
+            try:
+                self.exporter.export(batch)
+                self.exported.inc(len(batch))
+            except Exception:
+                self.export_failures.inc()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self._flushed:
+            self._wake.set()
+            return self._flushed.wait(timeout_millis / 1000)
+
+    def shutdown(self) -> None:
+        if self._shutdown:
+            return
+        self._shutdown = True
+        self._wake.set()
+        self._worker.join(timeout=self.export_interval + 5)
+        self.exporter.shutdown()
+
+
+def _create_exporter(config: TelemetryConfig):
+    """設定に応じたスパンエクスポーターを作成"""
+    if config.exporter == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+        return ConsoleSpanExporter()
+
+    if config.exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return OTLPSpanExporter()
+
+    if config.exporter == "azure-monitor":
+        from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter
+
+        if not config.connection_string:
+            raise ValueError(
+                "APPLICATIONINSIGHTS_CONNECTION_STRING が設定されていません。"
+            )
+        return AzureMonitorTraceExporter(connection_string=config.connection_string)
+
+    raise ValueError(f"未対応のエクスポーター: {config.exporter}")
+
+
+def is_enabled() -> bool:
+    """計装が有効かどうか"""
+    return _state.enabled
+
+
+def start_span(name: str, attributes: Optional[dict] = None):
+    """
+    スパンを開始
+
+    コンテキストマネージャーとして使うと現在のスパンとして設定され、終了時に
+    例外も記録されます。ストリーミングのように寿命が with ブロックを超える場合は
+    戻り値の end() を明示的に呼び出してください。
+    """
+    if not _state.enabled or _suppressed.get():
+        return NOOP_SPAN
+
+    if _state.sample_rate < 1.0:
+        from opentelemetry import trace
+
+        # ルートスパンのみサンプリング判定し、子スパンは親に従う
+        parent = trace.get_current_span().get_span_context()
+        if not parent.is_valid and random.random() >= _state.sample_rate:
+            return _SuppressedSpan()
+
+    span = _state.tracer.start_span(name, attributes=_drop_none(attributes))
+    return _Span(span)
+
+
+def _drop_none(attributes: Optional[dict]) -> Optional[dict]:
+    if not attributes:
+        return None
+    return {k: v for k, v in attributes.items() if v is not None}
+
+
+def gen_ai_span(
+    operation: str,
+    model: Optional[str] = None,
+    server_url: Optional[str] = None,
+    attributes: Optional[dict] = None,
+):
+    """GenAI セマンティック規約に沿ったスパンを開始（スパン名: "{operation} {model}"）"""
+    if not _state.enabled:
+        return NOOP_SPAN
+
+    attrs = {
+        "gen_ai.system": GEN_AI_SYSTEM,
+        "gen_ai.operation.name": operation,
+        "gen_ai.request.model": model,
+    }
+    attrs.update(server_attributes(server_url))
+    if attributes:
+        attrs.update(attributes)
+    name = f"{operation} {model}" if model else operation
+    return start_span(name, attrs)
+
+
+def server_attributes(url: Optional[str]) -> dict:
+    """URL から server.address / server.port 属性を生成"""
+    if not url:
+        return {}
+    parsed = urlparse(url)
+    return {
+        "server.address": parsed.hostname,
+        "server.port": parsed.port or (443 if parsed.scheme == "https" else 80),
+    }
+
+
+def get_field(obj: Any, key: str, default: Any = None) -> Any:
+    """dict / SDK オブジェクトの両方から値を取得"""
+    if obj is None:
+        return default
+    if isinstance(obj, Mapping):
+        return obj.get(key, default)
+    return getattr(obj, key, default)
+
+
+def usage_tokens(usage: Any) -> tuple[Optional[int], Optional[int]]:
+    """
+    usage から (入力トークン, 出力トークン) を取得
+
+    Chat Completions（prompt_tokens / completion_tokens）と
+    Responses API（input_tokens / output_tokens）の両形式に対応します。
+    """
+    if usage is None:
+        return None, None
+    input_tokens = get_field(usage, "input_tokens")
+    if input_tokens is None:
+        input_tokens = get_field(usage, "prompt_tokens")
+    output_tokens = get_field(usage, "output_tokens")
+    if output_tokens is None:
+        output_tokens = get_field(usage, "completion_tokens")
+    return input_tokens, output_tokens
+
+
+def set_response_attributes(span, response: Any) -> None:
+    """レスポンス（dict / SDK オブジェクト）から gen_ai.response.* / usage 属性を設定"""
+    if not span.is_recording() or response is None:
+        return
+
+    span.set_attribute("gen_ai.response.id", get_field(response, "id"))
+    span.set_attribute("gen_ai.response.model", get_field(response, "model"))
+
+    choices = get_field(response, "choices")
+    if choices:
+        reasons = [r for r in (get_field(c, "finish_reason") for c in choices) if r]
+        if reasons:
+            span.set_attribute("gen_ai.response.finish_reasons", reasons)
+    else:
+        status = get_field(response, "status")
+        if status:
+            span.set_attribute("gen_ai.response.finish_reasons", [status])
+
+    input_tokens, output_tokens = usage_tokens(get_field(response, "usage"))
+    span.set_attribute("gen_ai.usage.input_tokens", input_tokens)
+    span.set_attribute("gen_ai.usage.output_tokens", output_tokens)
+
+
+def record_content(span, attribute: str, content: Any) -> None:
+    """
+    プロンプト / 応答内容をスパン属性として記録
+
+    AIGATEWAY_OTEL_CAPTURE_CONTENT=true の場合のみ、content_sample_rate の割合の
+    スパンに content_max_chars 文字まで切り詰めて記録します。
+    """
+    if not _state.capture_content or content is None or not span.is_recording():
+        return
+    if _state.content_sample_rate < 1.0:
+        # 入力と出力で判定が食い違わないよう、スパン ID から決定的にサンプリング
+        span_id = span._span.get_span_context().span_id
+        if (span_id % 10000) >= _state.content_sample_rate * 10000:
+            return
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False, default=str)
+    if len(content) > _state.content_max_chars:
+        span.set_attribute(f"{attribute}.truncated", True)
+        content = content[: _state.content_max_chars]
+    span.set_attribute(attribute, content)
+
+
+def record_first_token(span, elapsed: float) -> None:
+    """最初のトークン到着までの時間（TTFT, 秒）を記録"""
+    if not span.is_recording():
+        return
+    span.set_attribute("gen_ai.response.time_to_first_token", elapsed)
+    span.add_event("gen_ai.first_token", {"elapsed_s": elapsed})
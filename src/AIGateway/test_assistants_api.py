@@ -11,102 +11,87 @@ Note: 新規開発では Responses API が推奨されています。
 
 import argparse
 import sys
-import time
 
 import requests
 
+import circuit_breaker
+import concurrency
+import deadline
+import key_pool
+import metrics
+import profiling
+import telemetry
+import traffic_replay
+import usage_ledger
+import warmup
 from config import get_config
+from gateway_client import GatewayClient, add_request_hook
 
 
-class AssistantsAPIClient:
+class AssistantsAPIClient(GatewayClient):
     """Assistants API クライアント"""
     
-    def __init__(self, base_url: str, api_key: str, api_version: str):
-        self.base_url = base_url
-        self.api_version = api_version
-        self.headers = {
-            "api-key": api_key,
-            "Content-Type": "application/json"
-        }
-    
-    def _url(self, path: str) -> str:
-        return f"{self.base_url}{path}?api-version={self.api_version}"
+    api_name = "assistants"
     
     def create_assistant(self, name: str, model: str, instructions: str) -> dict:
         """Assistant を作成"""
-        response = requests.post(
-            self._url("/assistants"),
-            headers=self.headers,
+        return self._request(
+            "POST",
+            "/assistants",
             json={
                 "name": name,
                 "model": model,
                 "instructions": instructions
-            }
+            },
+            operation="create_agent",
+            model=model
         )
-        response.raise_for_status()
-        return response.json()
     
     def delete_assistant(self, assistant_id: str) -> dict:
         """Assistant を削除"""
-        response = requests.delete(
-            self._url(f"/assistants/{assistant_id}"),
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
+        return self._request("DELETE", f"/assistants/{assistant_id}")
     
     def list_assistants(self) -> dict:
         """Assistant 一覧を取得"""
-        response = requests.get(
-            self._url("/assistants"),
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
+        return self._request("GET", "/assistants")
     
     def create_thread(self) -> dict:
         """Thread を作成"""
-        response = requests.post(
-            self._url("/threads"),
-            headers=self.headers,
-            json={}
-        )
-        response.raise_for_status()
-        return response.json()
+        return self._request("POST", "/threads", json={})
+    
+    def delete_thread(self, thread_id: str) -> dict:
+        """Thread を削除"""
+        return self._request("DELETE", f"/threads/{thread_id}")
     
     def add_message(self, thread_id: str, content: str, role: str = "user") -> dict:
         """Thread にメッセージを追加"""
-        response = requests.post(
-            self._url(f"/threads/{thread_id}/messages"),
-            headers=self.headers,
+        return self._request(
+            "POST",
+            f"/threads/{thread_id}/messages",
             json={
                 "role": role,
                 "content": content
             }
         )
-        response.raise_for_status()
-        return response.json()
     
     def create_run(self, thread_id: str, assistant_id: str) -> dict:
         """Run を作成"""
-        response = requests.post(
-            self._url(f"/threads/{thread_id}/runs"),
-            headers=self.headers,
+        return self._request(
+            "POST",
+            f"/threads/{thread_id}/runs",
             json={
                 "assistant_id": assistant_id
-            }
+            },
+            operation="invoke_agent"
         )
-        response.raise_for_status()
-        return response.json()
     
     def get_run(self, thread_id: str, run_id: str) -> dict:
         """Run のステータスを取得"""
-        response = requests.get(
-            self._url(f"/threads/{thread_id}/runs/{run_id}"),
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
+        return self._request("GET", f"/threads/{thread_id}/runs/{run_id}")
+    
+    def cancel_run(self, thread_id: str, run_id: str) -> dict:
+        """Run をキャンセル"""
+        return self._request("POST", f"/threads/{thread_id}/runs/{run_id}/cancel")
     
     def wait_for_run(
         self, 
@@ -115,30 +100,53 @@ class AssistantsAPIClient:
         timeout: int = 60,
         poll_interval: float = 1.0
     ) -> dict:
-        """Run の完了を待機"""
+        """
+        Run の完了を待機
+        
+        timeout と外側のデッドラインの早い方を過ぎた場合（DeadlineExceeded）や、
+        待機が中断された場合（Ctrl+C・ポーリングの失敗等）は Run をキャンセルします。
+        """
         terminal_states = {"completed", "failed", "cancelled", "expired"}
-        start_time = time.time()
+        polls = 0
         
-        while True:
-            run = self.get_run(thread_id, run_id)
-            status = run["status"]
-            
-            if status in terminal_states:
-                return run
-            
-            if time.time() - start_time > timeout:
-                raise TimeoutError(f"Run did not complete within {timeout} seconds")
-            
-            time.sleep(poll_interval)
+        with deadline.within(timeout) as budget, \
+                telemetry.start_span("poll run", {"gen_ai.thread.run.id": run_id}) as span:
+            try:
+                while True:
+                    run = self.get_run(thread_id, run_id)
+                    polls += 1
+                    status = run["status"]
+                    
+                    if status in terminal_states:
+                        telemetry.set_response_attributes(span, run)
+                        return run
+                    
+                    budget.check(f"Run did not complete within {budget.budget:g} seconds")
+                    
+                    budget.sleep(poll_interval)
+            except BaseException:
+                self._abandon_run(thread_id, run_id)
+                raise
+            finally:
+                span.set_attribute("aigateway.poll.count", polls)
+    
+    def _abandon_run(self, thread_id: str, run_id: str) -> None:
+        """結果を待たなくなった Run をキャンセルし、節約できたトークン数を記録"""
+        try:
+            with deadline.shielded():
+                run = self.cancel_run(thread_id, run_id)
+        except Exception as e:
+            print(f"   ⚠️  {run_id} をキャンセルできませんでした: {e}", file=sys.stderr)
+            return
+        if run.get("status") in ("cancelling", "cancelled"):
+            _, output_tokens = telemetry.usage_tokens(run.get("usage"))
+            saved = deadline.estimate_tokens_saved(run.get("max_completion_tokens"), output_tokens)
+            deadline.record_cancellation(self.api_name, saved)
+            print(f"   🛑 {run_id} をキャンセルしました", file=sys.stderr)
     
     def get_messages(self, thread_id: str) -> dict:
         """Thread のメッセージを取得"""
-        response = requests.get(
-            self._url(f"/threads/{thread_id}/messages"),
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
+        return self._request("GET", f"/threads/{thread_id}/messages")
 
 
 def test_full_workflow(client: AssistantsAPIClient, model: str, cleanup: bool = True):
@@ -252,6 +260,7 @@ Examples:
   python test_assistants_api.py --model gpt-4o-mini
   python test_assistants_api.py --list
   python test_assistants_api.py --no-cleanup
+  python test_assistants_api.py --profile --profile-stacks assistants.folded
         """
     )
     parser.add_argument(
@@ -268,6 +277,15 @@ Examples:
         action="store_true",
         help="テスト後に Assistant を削除しない"
     )
+    metrics.add_metrics_arguments(parser)
+    traffic_replay.add_record_arguments(parser)
+    usage_ledger.add_ledger_arguments(parser)
+    circuit_breaker.add_breaker_arguments(parser)
+    concurrency.add_concurrency_arguments(parser)
+    deadline.add_deadline_arguments(parser)
+    warmup.add_warmup_arguments(parser)
+    key_pool.add_key_pool_arguments(parser)
+    profiling.add_profile_arguments(parser)
     
     args = parser.parse_args()
     
@@ -284,19 +302,72 @@ Examples:
     print(f"API Version: {config.api_version}")
     print(f"Model: {model}")
     
+    # テレメトリ初期化（AIGATEWAY_OTEL_ENABLED=true の場合のみ）
+    if telemetry.configure_telemetry():
+        print("Telemetry: enabled")
+    
+    # メトリクス出力（--metrics-port / --metrics-json 指定時のみ）
+    gateway_metrics = metrics.start_metrics(args)
+    if gateway_metrics:
+        add_request_hook(gateway_metrics.observe)
+    
+    # トラフィック記録（--record 指定時のみ、traffic_replay.py で再生）
+    recorder = traffic_replay.start_recording(args)
+    if recorder:
+        add_request_hook(recorder.observe)
+    
+    # 使用量台帳（--ledger 指定時のみ、usage_ledger.py で集計）
+    ledger = usage_ledger.start_ledger(args, config.cost_table_path)
+    if ledger:
+        add_request_hook(ledger.observe)
+    
+    # プロファイリング（--profile / --profile-stacks 指定時のみ、クライアント作成前に開始）
+    profiler = profiling.start_profiling(args)
+    if profiler:
+        add_request_hook(profiler.observe)
+    
+    # サーキットブレーカー（--circuit-breaker 指定時のみ）
+    breakers = circuit_breaker.create_breakers(args)
+    
+    # 適応型同時実行数制限（--adaptive-concurrency 指定時のみ）
+    limits = concurrency.create_limits(args)
+    
+    # サブスクリプションキーの負荷分散（APIM_API_KEYS に 2 つ以上指定時のみ）
+    keys = key_pool.create_key_pool(args, config.api_keys)
+    if keys:
+        print(f"Subscription keys: {len(keys)}")
+    
     # クライアント作成
     client = AssistantsAPIClient(
         base_url=config.base_url_chat,
         api_key=config.api_key,
-        api_version=config.api_version
+        api_version=config.api_version,
+        circuit_breakers=breakers,
+        concurrency_limits=limits,
+        deadline=args.deadline,
+        key_pool=keys
     )
     
+    # 接続の事前ウォームアップ（--warmup 指定時のみ）
+    warm = warmup.warm_up(args, client)
+    
     try:
         if args.list:
             list_assistants(client)
         else:
             test_full_workflow(client, model, cleanup=not args.no_cleanup)
         
+        if breakers:
+            breakers.print_report()
+        if limits:
+            limits.print_report()
+        if keys:
+            keys.print_report()
+        if warm:
+            warm.print_report()
+        if profiler:
+            profiler.print_report()
+        
     except requests.exceptions.HTTPError as e:
         print(f"\n❌ HTTP エラー: {e}", file=sys.stderr)
         if e.response is not None:
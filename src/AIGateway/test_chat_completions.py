@@ -6,15 +6,56 @@ AI Gateway 経由で Azure OpenAI の Chat Completions API をテストします
 """
 
 import argparse
+import asyncio
 import json
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
 
-from openai import AzureOpenAI
-
+import circuit_breaker
+import concurrency
+import deadline
+import key_pool
+import metrics
+import profiling
+import scheduler
+import telemetry
+import tools
+import traffic_replay
+import usage_ledger
+import warmup
 from config import get_config
+from gateway_client import ChatClient, add_request_hook, create_chat_client
+from prompt_cache import PromptCacheBuilder, PromptTemplate
+from router import AUTO_MODEL, ModelRouter
+from hedging import HedgePolicy, Hedger
+from singleflight import SingleFlight
+
+# マルチターン会話の system プロンプト（毎ターン同一プレフィックスとして送信）
+ASSISTANT_TEMPLATE = PromptTemplate(
+    name="assistant",
+    system="あなたは親切なアシスタントです。"
+)
+
+# function calling テスト用のメッセージ（1 ターンで複数の tool_calls を返させる）
+TOOL_MESSAGE = "東京・ニューヨーク・ロンドンの現在時刻と天気を教えてください。"
+
+
+def get_current_time(timezone: str) -> str:
+    """指定したタイムゾーン（IANA 形式、例: Asia/Tokyo）の現在時刻を返す"""
+    return datetime.now(ZoneInfo(timezone)).isoformat(timespec="seconds")
 
 
-def test_simple_chat(client: AzureOpenAI, model: str, message: str) -> None:
+async def get_weather(city: str) -> dict:
+    """指定した都市の現在の天気を返す（デモ用の固定値）"""
+    # 外部 API 呼び出しの待ち時間を模擬
+    await asyncio.sleep(1.0)
+    return {"city": city, "condition": "晴れ", "temperature_c": 20}
+
+
+def test_simple_chat(client: ChatClient, model: str, message: str) -> None:
     """シンプルなチャット完了テスト"""
     
     print(f"\n{'='*60}")
@@ -24,7 +65,7 @@ def test_simple_chat(client: AzureOpenAI, model: str, message: str) -> None:
     print(f"Message: {message}")
     print("-" * 60)
     
-    response = client.chat.completions.create(
+    response = client.create(
         model=model,
         messages=[
             {"role": "user", "content": message}
@@ -43,7 +84,7 @@ def test_simple_chat(client: AzureOpenAI, model: str, message: str) -> None:
     print(f"  - Total tokens: {response.usage.total_tokens}")
 
 
-def test_streaming(client: AzureOpenAI, model: str, message: str) -> None:
+def test_streaming(client: ChatClient, model: str, message: str) -> None:
     """ストリーミングレスポンステスト"""
     
     print(f"\n{'='*60}")
@@ -54,7 +95,7 @@ def test_streaming(client: AzureOpenAI, model: str, message: str) -> None:
     print("-" * 60)
     print("\nStreaming response:")
     
-    stream = client.chat.completions.create(
+    stream = client.create(
         model=model,
         messages=[
             {"role": "user", "content": message}
@@ -74,25 +115,26 @@ def test_streaming(client: AzureOpenAI, model: str, message: str) -> None:
     print(f"✅ ストリーミング完了 (Total chars: {len(full_response)})")
 
 
-def test_multi_turn(client: AzureOpenAI, model: str) -> None:
+def test_multi_turn(client: ChatClient, model: str) -> None:
     """マルチターン会話テスト"""
     
     print(f"\n{'='*60}")
     print("Multi-turn 会話テスト")
     print(f"{'='*60}")
     
+    # system プロンプトを先頭に固定し、毎ターン同一のプレフィックスで送信
+    builder = PromptCacheBuilder()
     messages = [
-        {"role": "system", "content": "あなたは親切なアシスタントです。"},
         {"role": "user", "content": "私の名前は田中太郎です。覚えておいてください。"}
     ]
     
-    print(f"\n[Turn 1] User: {messages[1]['content']}")
+    print(f"\n[Turn 1] User: {messages[0]['content']}")
     
-    response1 = client.chat.completions.create(
+    response1 = client.create(
         model=model,
-        messages=messages,
-        max_tokens=100
+        **builder.chat_request(ASSISTANT_TEMPLATE, messages, max_tokens=100)
     )
+    builder.record(ASSISTANT_TEMPLATE, response1)
     
     assistant_msg1 = response1.choices[0].message.content
     print(f"[Turn 1] Assistant: {assistant_msg1}")
@@ -101,20 +143,126 @@ def test_multi_turn(client: AzureOpenAI, model: str) -> None:
     messages.append({"role": "assistant", "content": assistant_msg1})
     messages.append({"role": "user", "content": "私の名前は何でしたか？"})
     
-    print(f"\n[Turn 2] User: {messages[3]['content']}")
+    print(f"\n[Turn 2] User: {messages[2]['content']}")
     
-    response2 = client.chat.completions.create(
+    response2 = client.create(
         model=model,
-        messages=messages,
-        max_tokens=100
+        **builder.chat_request(ASSISTANT_TEMPLATE, messages, max_tokens=100)
     )
+    builder.record(ASSISTANT_TEMPLATE, response2)
     
     assistant_msg2 = response2.choices[0].message.content
     print(f"[Turn 2] Assistant: {assistant_msg2}")
     
+    builder.print_report()
+    if not ASSISTANT_TEMPLATE.cacheable(model):
+        print("  (プレフィックスが 1,024 トークン未満のため、キャッシュは会話が長くなってから有効になります)")
+    
     print(f"\n✅ マルチターン会話完了")
 
 
+def test_coalescing(client: ChatClient, model: str, message: str, concurrency: int) -> None:
+    """同一リクエストの同時実行を single-flight で合流させるテスト"""
+    
+    print(f"\n{'='*60}")
+    print("Single-flight 合流テスト")
+    print(f"{'='*60}")
+    print(f"Model: {model}")
+    print(f"Concurrent requests: {concurrency}")
+    print("-" * 60)
+    
+    single_flight = SingleFlight(group="chat")
+    client.single_flight = single_flight
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [
+                pool.submit(
+                    client.create,
+                    model=model,
+                    messages=[{"role": "user", "content": message}],
+                    max_tokens=200
+                )
+                for _ in range(concurrency)
+            ]
+            responses = [f.result() for f in futures]
+    finally:
+        client.single_flight = None
+    
+    unique_ids = {r.id for r in responses}
+    print(f"\n✅ {len(responses)} 件の呼び出しに対し、送信したリクエストは {len(unique_ids)} 件")
+    print(f"   Coalesced: {single_flight.coalesced}")
+
+
+def test_hedging(
+    client: ChatClient,
+    model: str,
+    fallback_model: str,
+    message: str,
+    requests_count: int
+) -> None:
+    """ヘッジリクエスト（p95 超過でバックアップ送信）のテスト"""
+    
+    print(f"\n{'='*60}")
+    print("Hedged requests テスト")
+    print(f"{'='*60}")
+    print(f"Primary: {model}")
+    print(f"Backup: {fallback_model or model}")
+    print(f"Requests: {requests_count}")
+    print("-" * 60)
+    
+    hedger = Hedger(HedgePolicy(fallback_model=fallback_model, min_samples=5))
+    try:
+        for i in range(requests_count):
+            start = time.perf_counter()
+            response = hedger.call(
+                lambda deployment: client.create(
+                    model=deployment,
+                    messages=[{"role": "user", "content": message}],
+                    max_tokens=200
+                ),
+                model
+            )
+            elapsed = time.perf_counter() - start
+            print(f"  [{i + 1}] {elapsed:.2f}s  model={response.model}")
+    finally:
+        hedger.shutdown()
+    
+    report = hedger.report()
+    print(f"\n✅ Hedge rate: {report['hedge_rate']:.1%} "
+          f"({report['hedged']}/{report['calls']}, backup wins: {report['backup_wins']})")
+    for name, stats in report["models"].items():
+        if stats["p99_improvement"] is not None:
+            print(f"   {name}: p99 {stats['primary_p99']:.2f}s → {stats['effective_p99']:.2f}s "
+                  f"(improvement {stats['p99_improvement']:.2f}s)")
+
+
+def test_tool_calling(client: ChatClient, model: str, message: str, registry: tools.ToolRegistry) -> None:
+    """function calling テスト（返された tool_calls を並列実行して 1 回で返す）"""
+    
+    registry.register(get_current_time)
+    registry.register(get_weather)
+    
+    print(f"\n{'='*60}")
+    print("Tool calling テスト")
+    print(f"{'='*60}")
+    print(f"Model: {model}")
+    print(f"Message: {message}")
+    print(f"Tools: {', '.join(registry.tools)}")
+    print("-" * 60)
+    
+    messages = [{"role": "user", "content": message}]
+    response = registry.run(client, model, messages, max_tokens=300)
+    
+    for msg in messages:
+        if msg["role"] == "tool":
+            print(f"  [tool] {msg['tool_call_id']}: {msg['content']}")
+    
+    print(f"\n✅ 成功!")
+    print(f"\nContent:")
+    print(response.choices[0].message.content)
+    registry.print_report()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Chat Completions API 動作確認",
@@ -125,11 +273,18 @@ Examples:
   python test_chat_completions.py --message "Azure AI Foundry とは？"
   python test_chat_completions.py --model gpt-4o-mini --streaming
   python test_chat_completions.py --multi-turn
+  python test_chat_completions.py --model auto --all
+  python test_chat_completions.py --coalesce 10
+  python test_chat_completions.py --hedge 50
+  python test_chat_completions.py --tools --tool-timeout 5
+  python test_chat_completions.py --all --record traffic.jsonl.gz
+  python test_chat_completions.py --all --ledger usage/
+  python test_chat_completions.py --coalesce 20 --profile --profile-stacks chat.folded
         """
     )
     parser.add_argument(
         "--model", "-m",
-        help="使用するモデル名（デフォルト: 環境変数 DEFAULT_MODEL）"
+        help="使用するモデル名（auto でルーターが選択、デフォルト: 環境変数 DEFAULT_MODEL）"
     )
     parser.add_argument(
         "--message",
@@ -146,11 +301,39 @@ Examples:
         action="store_true",
         help="マルチターン会話をテスト"
     )
+    parser.add_argument(
+        "--coalesce",
+        type=int,
+        metavar="N",
+        help="同一リクエストを N 並列で送信し、single-flight で合流させる"
+    )
+    parser.add_argument(
+        "--hedge",
+        type=int,
+        metavar="N",
+        help="N 回のリクエストをヘッジ付きで送信（バックアップ先: 環境変数 FALLBACK_MODEL）"
+    )
+    parser.add_argument(
+        "--tools",
+        action="store_true",
+        help="function calling をテスト（tool_calls をローカルで並列実行）"
+    )
     parser.add_argument(
         "--all", "-a",
         action="store_true",
         help="すべてのテストを実行"
     )
+    metrics.add_metrics_arguments(parser)
+    traffic_replay.add_record_arguments(parser)
+    usage_ledger.add_ledger_arguments(parser)
+    circuit_breaker.add_breaker_arguments(parser)
+    concurrency.add_concurrency_arguments(parser)
+    scheduler.add_scheduler_arguments(parser)
+    deadline.add_deadline_arguments(parser)
+    warmup.add_warmup_arguments(parser)
+    key_pool.add_key_pool_arguments(parser)
+    tools.add_tool_arguments(parser)
+    profiling.add_profile_arguments(parser)
     
     args = parser.parse_args()
     
@@ -166,14 +349,71 @@ Examples:
     print(f"AI Gateway Endpoint: {config.apim_endpoint}")
     print(f"API Version: {config.api_version}")
     
+    # テレメトリ初期化（AIGATEWAY_OTEL_ENABLED=true の場合のみ）
+    if telemetry.configure_telemetry():
+        print("Telemetry: enabled")
+    
+    # メトリクス出力（--metrics-port / --metrics-json 指定時のみ）
+    gateway_metrics = metrics.start_metrics(args)
+    if gateway_metrics:
+        add_request_hook(gateway_metrics.observe)
+    
+    # トラフィック記録（--record 指定時のみ、traffic_replay.py で再生）
+    recorder = traffic_replay.start_recording(args)
+    if recorder:
+        add_request_hook(recorder.observe)
+    
+    # 使用量台帳（--ledger 指定時のみ、usage_ledger.py で集計）
+    ledger = usage_ledger.start_ledger(args, config.cost_table_path)
+    if ledger:
+        add_request_hook(ledger.observe)
+    
+    # プロファイリング（--profile / --profile-stacks 指定時のみ、クライアント作成前に開始）
+    profiler = profiling.start_profiling(args)
+    if profiler:
+        add_request_hook(profiler.observe)
+    
     # OpenAI クライアント作成（APIM 経由）
-    # AI Gateway のパスは /openai/deployments/{model}/... なので
-    # azure_endpoint に /openai を追加
-    client = AzureOpenAI(
-        api_key=config.api_key,
-        api_version=config.api_version,
-        azure_endpoint=f"{config.apim_endpoint}/openai"
-    )
+    client = create_chat_client(config)
+    
+    # サーキットブレーカー（--circuit-breaker 指定時のみ）
+    client.circuit_breakers = circuit_breaker.create_breakers(args)
+    
+    # 適応型同時実行数制限（--adaptive-concurrency 指定時のみ）
+    client.concurrency_limits = concurrency.create_limits(args)
+    
+    # 各呼び出しの時間予算（--deadline 指定時のみ）
+    client.deadline = args.deadline
+    
+    # サブスクリプションキーの負荷分散（APIM_API_KEYS に 2 つ以上指定時のみ）
+    client.key_pool = key_pool.create_key_pool(args, config.api_keys)
+    if client.key_pool:
+        print(f"Subscription keys: {len(client.key_pool)}")
+    
+    # 優先度スケジューラー（--scheduler-capacity 指定時のみ）
+    try:
+        client.scheduler = scheduler.create_scheduler(args)
+    except ValueError as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    # model=auto の場合はルーターが DEPLOYMENTS から送信先を選択
+    # （ブレーカー有効時は、回路が開いたデプロイメントからの迂回先の選択にも使う）
+    if model == AUTO_MODEL or client.circuit_breakers:
+        try:
+            # 迂回先の選択だけならコスト表にないデプロイメントは候補から外す
+            client.router = ModelRouter.from_config(config, skip_unknown=model != AUTO_MODEL)
+        except ValueError as e:
+            if model == AUTO_MODEL:
+                print(f"❌ エラー: {e}", file=sys.stderr)
+                sys.exit(1)
+            print(f"⚠️  迂回先を選べないため、回路が開いても迂回しません: {e}")
+        if client.router:
+            add_request_hook(client.router.observe)
+            print(f"Deployments: {', '.join(client.router.deployments)}")
+    
+    # 接続の事前ウォームアップ（--warmup 指定時のみ）
+    warm = warmup.warm_up(args, client)
     
     try:
         if args.all:
@@ -184,9 +424,34 @@ Examples:
             test_streaming(client, model, args.message)
         elif args.multi_turn:
             test_multi_turn(client, model)
+        elif args.coalesce:
+            test_coalescing(client, model, args.message, args.coalesce)
+        elif args.hedge:
+            test_hedging(client, model, config.fallback_model, args.message, args.hedge)
+        elif args.tools:
+            registry = tools.create_registry(args)
+            try:
+                test_tool_calling(client, model, TOOL_MESSAGE, registry)
+            finally:
+                registry.close()
         else:
             test_simple_chat(client, model, args.message)
         
+        if client.router:
+            client.router.print_report()
+        if client.circuit_breakers:
+            client.circuit_breakers.print_report()
+        if client.concurrency_limits:
+            client.concurrency_limits.print_report()
+        if client.scheduler:
+            client.scheduler.print_report()
+        if client.key_pool:
+            client.key_pool.print_report()
+        if warm:
+            warm.print_report()
+        if profiler:
+            profiler.print_report()
+        
         print(f"\n{'='*60}")
         print("✅ すべてのテストが正常に完了しました")
         print(f"{'='*60}")
@@ -11,27 +11,59 @@ Chat Completions と Assistants API の機能を統合しています。
 
 import argparse
 import sys
-import time
+from functools import lru_cache
+from typing import Optional
 
 import requests
 
+import circuit_breaker
+import concurrency
+import deadline
+import key_pool
+import fastjson
+import metrics
+import profiling
+import scheduler
+import telemetry
+import tokens
+import traffic_replay
+import usage_ledger
+import warmup
 from config import get_config
+from gateway_client import GatewayClient, add_request_hook, resolve_model, total_tokens
+from router import AUTO_MODEL, ModelRouter
+from singleflight import request_key
 
+# バックグラウンドレスポンスの終了状態
+TERMINAL_STATES = {"completed", "failed", "cancelled", "expired", "incomplete"}
 
-class ResponsesAPIClient:
+
+@lru_cache(maxsize=64)
+def _body_template(
+    model: str, instructions: Optional[str], background: bool, store: Optional[bool]
+) -> fastjson.BodyTemplate:
+    """リクエスト本文の固定部分（呼び出しごとに変わらない部分）"""
+    fixed = {"model": model}
+    # instructions はプロンプト先頭に置かれるため、固定の system プロンプトはここで渡す
+    if instructions:
+        fixed["instructions"] = instructions
+    if background:
+        fixed["background"] = True
+        fixed["store"] = True  # background requires store=true
+    elif store is not None:
+        fixed["store"] = store
+    return fastjson.BodyTemplate(fixed)
+
+
+class ResponsesAPIClient(GatewayClient):
     """Responses API クライアント"""
     
-    def __init__(self, base_url: str, api_key: str, api_version: str = "2025-03-01-preview"):
-        self.base_url = base_url
-        self.api_version = api_version
-        self.headers = {
-            "api-key": api_key,
-            "Content-Type": "application/json"
-        }
+    api_name = "responses"
     
-    def _url(self, path: str) -> str:
-        """API URL を構築（api-version パラメータ付き）"""
-        return f"{self.base_url}{path}?api-version={self.api_version}"
+    def __init__(self, base_url: str, api_key: str, api_version: str = "2025-03-01-preview", **kwargs):
+        super().__init__(base_url, api_key, api_version, **kwargs)
+        # 完了まで実行枠を保持しているバックグラウンドレスポンス（response_id → Ticket）
+        self._background_tickets: dict = {}
     
     def create_response(
         self, 
@@ -39,40 +71,72 @@ class ResponsesAPIClient:
         input_text: str,
         previous_response_id: str = None,
         background: bool = False,
-        store: bool = True
+        store: bool = True,
+        instructions: str = None,
+        priority: str = None
     ) -> dict:
-        """レスポンスを生成"""
+        """
+        レスポンスを生成（model="auto" や回路が開いている場合はルーターが送信先を選択）
+        
+        スケジューラーが設定されていれば priority クラス（background=True の既定は batch）の
+        順番を待ってから送信します。
+        """
+        
+        model = resolve_model(
+            self.api_name,
+            model,
+            self.router,
+            self.circuit_breakers,
+            lambda unavailable: self.router.route_responses(
+                input_text, instructions, unavailable=unavailable
+            ),
+        )
         
-        body = {
-            "model": model,
-            "input": input_text
-        }
+        # model / instructions / store 等の固定部分はエンコード済みのテンプレートを再利用
+        template = _body_template(model, instructions, background, store)
+        body = template.render(input=input_text, previous_response_id=previous_response_id)
         
-        if previous_response_id:
-            body["previous_response_id"] = previous_response_id
+        if background and priority is None:
+            priority = scheduler.BATCH
         
-        if background:
-            body["background"] = True
-            body["store"] = True  # background requires store=true
-        elif store is not None:
-            body["store"] = store
+        def send():
+            return self._post_response(body, model, priority, background, input_text, instructions)
         
-        response = requests.post(
-            self._url("/responses"),
-            headers=self.headers,
-            json=body
+        if self.single_flight is not None:
+            return self.single_flight.do(request_key(**body.source), send)
+        return send()
+    
+    def _post_response(self, body, model, priority, background, input_text, instructions) -> dict:
+        """スケジューラーの順番を待って送信（バックグラウンドは完了まで実行枠を保持）"""
+        if self.scheduler is None:
+            return self._request("POST", "/responses", json=body, operation="chat", model=model)
+        
+        prompt_tokens = tokens.estimate_responses_tokens(model, input_text, instructions)
+        budget = deadline.start(self.deadline)
+        ticket = self.scheduler.acquire(
+            priority,
+            self.scheduler.estimate_cost(prompt_tokens),
+            timeout=budget.remaining() if budget is not None else None
         )
-        response.raise_for_status()
-        return response.json()
+        try:
+            response = self._request("POST", "/responses", json=body, operation="chat", model=model)
+        except Exception:
+            self.scheduler.release(ticket)
+            raise
+        if background and response.get("status") not in TERMINAL_STATES:
+            self._background_tickets[response["id"]] = ticket
+        else:
+            self.scheduler.release(ticket, total_tokens(response))
+        return response
     
     def get_response(self, response_id: str) -> dict:
-        """レスポンスのステータスを取得"""
-        response = requests.get(
-            self._url(f"/responses/{response_id}"),
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
+        """レスポンスのステータスを取得（終了していれば保持中の実行枠を返却）"""
+        response = self._request("GET", f"/responses/{response_id}")
+        if self._background_tickets and response.get("status") in TERMINAL_STATES:
+            ticket = self._background_tickets.pop(response_id, None)
+            if ticket is not None:
+                self.scheduler.release(ticket, total_tokens(response))
+        return response
     
     def wait_for_response(
         self, 
@@ -80,31 +144,61 @@ class ResponsesAPIClient:
         timeout: int = 120,
         poll_interval: float = 2.0
     ) -> dict:
-        """バックグラウンドレスポンスの完了を待機"""
-        terminal_states = {"completed", "failed", "cancelled", "expired"}
-        start_time = time.time()
+        """
+        バックグラウンドレスポンスの完了を待機
         
-        while True:
-            resp = self.get_response(response_id)
-            status = resp.get("status", "unknown")
-            
-            if status in terminal_states:
-                return resp
-            
-            if time.time() - start_time > timeout:
-                raise TimeoutError(f"Response did not complete within {timeout} seconds")
-            
-            print(f"   Status: {status}...", flush=True)
-            time.sleep(poll_interval)
+        timeout と外側のデッドラインの早い方を過ぎた場合（DeadlineExceeded）や、
+        待機が中断された場合（Ctrl+C・ポーリングの失敗等）はレスポンスをキャンセルします。
+        """
+        polls = 0
+        
+        with deadline.within(timeout) as budget, \
+                telemetry.start_span("poll response", {"gen_ai.response.id": response_id}) as span:
+            try:
+                while True:
+                    resp = self.get_response(response_id)
+                    polls += 1
+                    status = resp.get("status", "unknown")
+                    
+                    if status in TERMINAL_STATES:
+                        telemetry.set_response_attributes(span, resp)
+                        return resp
+                    
+                    budget.check(f"Response did not complete within {budget.budget:g} seconds")
+                    
+                    print(f"   Status: {status}...", flush=True)
+                    budget.sleep(poll_interval)
+            except BaseException:
+                self._abandon(response_id)
+                raise
+            finally:
+                span.set_attribute("aigateway.poll.count", polls)
+    
+    def _abandon(self, response_id: str) -> None:
+        """結果を待たなくなったレスポンスをキャンセルし、節約できたトークン数を記録"""
+        try:
+            with deadline.shielded():
+                response = self.cancel_response(response_id)
+        except Exception as e:
+            print(f"   ⚠️  {response_id} をキャンセルできませんでした: {e}", file=sys.stderr)
+            # 以降ポーリングしないため、実行枠は推定トークン数で返却する
+            ticket = self._background_tickets.pop(response_id, None)
+            if ticket is not None:
+                self.scheduler.release(ticket)
+            return
+        if response.get("status") == "cancelled":
+            _, output_tokens = telemetry.usage_tokens(response.get("usage"))
+            saved = deadline.estimate_tokens_saved(response.get("max_output_tokens"), output_tokens)
+            deadline.record_cancellation(self.api_name, saved)
+            print(f"   🛑 {response_id} をキャンセルしました", file=sys.stderr)
     
     def cancel_response(self, response_id: str) -> dict:
         """バックグラウンドレスポンスをキャンセル"""
-        response = requests.post(
-            self._url(f"/responses/{response_id}/cancel"),
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return response.json()
+        response = self._request("POST", f"/responses/{response_id}/cancel")
+        ticket = self._background_tickets.pop(response_id, None)
+        if ticket is not None:
+            self.scheduler.release(ticket, total_tokens(response))
+        return response
 
 
 def extract_text_output(response: dict) -> str:
@@ -239,14 +333,16 @@ Examples:
   python test_responses_api.py
   python test_responses_api.py --message "Azure AI Foundry とは？"
   python test_responses_api.py --model gpt-4o-mini
+  python test_responses_api.py --model auto
   python test_responses_api.py --multi-turn
   python test_responses_api.py --background
   python test_responses_api.py --all
+  python test_responses_api.py --all --profile
         """
     )
     parser.add_argument(
         "--model", "-m",
-        help="使用するモデル名（デフォルト: 環境変数 DEFAULT_MODEL）"
+        help="使用するモデル名（auto でルーターが選択、デフォルト: 環境変数 DEFAULT_MODEL）"
     )
     parser.add_argument(
         "--message",
@@ -268,6 +364,16 @@ Examples:
         action="store_true",
         help="すべてのテストを実行"
     )
+    metrics.add_metrics_arguments(parser)
+    traffic_replay.add_record_arguments(parser)
+    usage_ledger.add_ledger_arguments(parser)
+    circuit_breaker.add_breaker_arguments(parser)
+    concurrency.add_concurrency_arguments(parser)
+    scheduler.add_scheduler_arguments(parser)
+    deadline.add_deadline_arguments(parser)
+    warmup.add_warmup_arguments(parser)
+    key_pool.add_key_pool_arguments(parser)
+    profiling.add_profile_arguments(parser)
     
     args = parser.parse_args()
     
@@ -284,13 +390,80 @@ Examples:
     print(f"Model: {model}")
     print(f"API Version: {config.api_version}")
     
+    # テレメトリ初期化（AIGATEWAY_OTEL_ENABLED=true の場合のみ）
+    if telemetry.configure_telemetry():
+        print("Telemetry: enabled")
+    
+    # メトリクス出力（--metrics-port / --metrics-json 指定時のみ）
+    gateway_metrics = metrics.start_metrics(args)
+    if gateway_metrics:
+        add_request_hook(gateway_metrics.observe)
+    
+    # トラフィック記録（--record 指定時のみ、traffic_replay.py で再生）
+    recorder = traffic_replay.start_recording(args)
+    if recorder:
+        add_request_hook(recorder.observe)
+    
+    # 使用量台帳（--ledger 指定時のみ、usage_ledger.py で集計）
+    ledger = usage_ledger.start_ledger(args, config.cost_table_path)
+    if ledger:
+        add_request_hook(ledger.observe)
+    
+    # プロファイリング（--profile / --profile-stacks 指定時のみ、クライアント作成前に開始）
+    profiler = profiling.start_profiling(args)
+    if profiler:
+        add_request_hook(profiler.observe)
+    
+    # サーキットブレーカー（--circuit-breaker 指定時のみ）
+    breakers = circuit_breaker.create_breakers(args)
+    
+    # 適応型同時実行数制限（--adaptive-concurrency 指定時のみ）
+    limits = concurrency.create_limits(args)
+    
+    # 優先度スケジューラー（--scheduler-capacity 指定時のみ、background は batch クラス）
+    try:
+        request_scheduler = scheduler.create_scheduler(args)
+    except ValueError as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    # model=auto の場合はルーターが DEPLOYMENTS から送信先を選択
+    # （ブレーカー有効時は、回路が開いたデプロイメントからの迂回先の選択にも使う）
+    router = None
+    if model == AUTO_MODEL or breakers:
+        try:
+            # 迂回先の選択だけならコスト表にないデプロイメントは候補から外す
+            router = ModelRouter.from_config(config, skip_unknown=model != AUTO_MODEL)
+        except ValueError as e:
+            if model == AUTO_MODEL:
+                print(f"❌ エラー: {e}", file=sys.stderr)
+                sys.exit(1)
+            print(f"⚠️  迂回先を選べないため、回路が開いても迂回しません: {e}")
+        if router:
+            add_request_hook(router.observe)
+            print(f"Deployments: {', '.join(router.deployments)}")
+    
+    # サブスクリプションキーの負荷分散（APIM_API_KEYS に 2 つ以上指定時のみ）
+    keys = key_pool.create_key_pool(args, config.api_keys)
+    if keys:
+        print(f"Subscription keys: {len(keys)}")
+    
     # クライアント作成
     client = ResponsesAPIClient(
         base_url=config.base_url_responses,
         api_key=config.api_key,
-        api_version=config.api_version
+        api_version=config.api_version,
+        router=router,
+        circuit_breakers=breakers,
+        concurrency_limits=limits,
+        scheduler=request_scheduler,
+        deadline=args.deadline,
+        key_pool=keys
     )
     
+    # 接続の事前ウォームアップ（--warmup 指定時のみ）
+    warm = warmup.warm_up(args, client)
+    
     try:
         if args.all:
             test_simple_response(client, model, args.message)
@@ -303,6 +476,21 @@ Examples:
         else:
             test_simple_response(client, model, args.message)
         
+        if router:
+            router.print_report()
+        if breakers:
+            breakers.print_report()
+        if limits:
+            limits.print_report()
+        if request_scheduler:
+            request_scheduler.print_report()
+        if keys:
+            keys.print_report()
+        if warm:
+            warm.print_report()
+        if profiler:
+            profiler.print_report()
+        
         print(f"\n{'='*60}")
         print("✅ すべてのテストが正常に完了しました")
         print(f"{'='*60}")
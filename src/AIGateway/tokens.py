@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+トークン数見積もりモジュール
+
+Chat Completions の messages / Responses API の input のプロンプトトークン数を
+送信前にローカルで見積もります（レート制限・切り詰め・コスト / レイテンシ予測用）。
+
+- tiktoken がインストールされていればモデルに対応するエンコーディングで正確に数え、
+  なければ文字種ベースのヒューリスティックで（やや多めに）見積もります。
+- テキスト・メッセージ単位の LRU キャッシュを持つため、繰り返し送る system プロンプトや
+  マルチターンの過去ターンは再エンコードせず、新しいメッセージ分だけ計算します。
+
+使用方法:
+    python tokens.py "Azure AI Foundry とは？"
+    python tokens.py --model gpt-4o-mini --file prompt.txt
+"""
+
+import argparse
+import json
+import time
+from functools import lru_cache
+from typing import Any, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Chat Completions のメッセージごとのオーバーヘッド（gpt-4o 系）
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+# アシスタント応答のプライミング（<|start|>assistant<|message|>）
+REPLY_PRIMING_TOKENS = 3
+# 画像入力（detail=low 相当）の固定見積もり
+IMAGE_TOKENS = 85
+# 出力トークン数が不明な場合の見積もり
+DEFAULT_EXPECTED_OUTPUT_TOKENS = 256
+
+# モデル名のプレフィックス → エンコーディング
+_MODEL_ENCODINGS = (
+    ("gpt-4o", "o200k_base"),
+    ("gpt-4.1", "o200k_base"),
+    ("gpt-5", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-35", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+)
+DEFAULT_ENCODING = "o200k_base"
+
+# メッセージ単位キャッシュの対象になる単純なメッセージのキー
+_SIMPLE_MESSAGE_KEYS = {"role", "content", "name"}
+
+
+def encoding_name_for_model(model: str) -> str:
+    """デプロイメント名 / モデル名からエンコーディング名を推定"""
+    name = model.lower()
+    for prefix, encoding in _MODEL_ENCODINGS:
+        if name.startswith(prefix):
+            return encoding
+    return DEFAULT_ENCODING
+
+
+def _heuristic_count(text: str) -> int:
+    """tiktoken がない場合の見積もり（ASCII は約 4 文字 / トークン、それ以外は 1 文字 / トークン）"""
+    ascii_chars = sum(1 for c in text if c < "\x80")
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class TokenCounter:
+    """エンコーディング単位のトークンカウンター（LRU キャッシュ付き）"""
+
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING, cache_size: int = 4096):
+        self.encoding_name = encoding_name
+        self.encoding = tiktoken.get_encoding(encoding_name) if tiktoken else None
+        # インスタンスごとにキャッシュを持たせる
+        self.count_text = lru_cache(maxsize=cache_size)(self._count_text)
+        self._count_message_key = lru_cache(maxsize=cache_size)(self._count_message_key_uncached)
+
+    @property
+    def exact(self) -> bool:
+        """tiktoken による正確な計数かどうか"""
+        return self.encoding is not None
+
+    def _count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return _heuristic_count(text)
+
+    def count_content(self, content: Any) -> int:
+        """メッセージの content（文字列またはコンテンツパーツ配列）のトークン数"""
+        if content is None:
+            return 0
+        if isinstance(content, str):
+            return self.count_text(content)
+        total = 0
+        for part in content:
+            if isinstance(part, str):
+                total += self.count_text(part)
+                continue
+            part_type = part.get("type", "")
+            if "image" in part_type:
+                total += IMAGE_TOKENS
+            elif "text" in part:
+                total += self.count_text(part["text"])
+            else:
+                total += self.count_text(json.dumps(part, ensure_ascii=False, sort_keys=True))
+        return total
+
+    def _count_message_key_uncached(self, role: str, name: Optional[str], content: str) -> int:
+        tokens = TOKENS_PER_MESSAGE + self.count_text(role) + self.count_text(content)
+        if name:
+            tokens += TOKENS_PER_NAME + self.count_text(name)
+        return tokens
+
+    def count_message(self, message: dict) -> int:
+        """Chat Completions メッセージ 1 件のトークン数（オーバーヘッド込み）"""
+        role = message.get("role", "")
+        name = message.get("name")
+        content = message.get("content")
+        if isinstance(content, str) and message.keys() <= _SIMPLE_MESSAGE_KEYS:
+            return self._count_message_key(role, name, content)
+
+        tokens = TOKENS_PER_MESSAGE + self.count_text(role) + self.count_content(content)
+        if name:
+            tokens += TOKENS_PER_NAME + self.count_text(name)
+        for call in message.get("tool_calls") or ():
+            function = call.get("function", {})
+            tokens += self.count_text(function.get("name", ""))
+            tokens += self.count_text(function.get("arguments", ""))
+        if message.get("tool_call_id"):
+            tokens += self.count_text(message["tool_call_id"])
+        return tokens
+
+    def count_tools(self, tools: Optional[list]) -> int:
+        """tools 定義のトークン数（JSON 文字列として近似）"""
+        if not tools:
+            return 0
+        return self.count_text(json.dumps(tools, ensure_ascii=False, sort_keys=True))
+
+    def count_chat(self, messages: list, tools: Optional[list] = None) -> int:
+        """Chat Completions リクエストのプロンプトトークン数"""
+        total = REPLY_PRIMING_TOKENS + self.count_tools(tools)
+        for message in messages:
+            total += self.count_message(message)
+        return total
+
+    def count_responses_input(self, input: Any, instructions: Optional[str] = None) -> int:
+        """Responses API リクエスト（input / instructions）のプロンプトトークン数"""
+        total = REPLY_PRIMING_TOKENS
+        if instructions:
+            total += TOKENS_PER_MESSAGE + self.count_text(instructions)
+        if input is None:
+            return total
+        if isinstance(input, str):
+            return total + TOKENS_PER_MESSAGE + self.count_text(input)
+        for item in input:
+            if isinstance(item, str):
+                total += TOKENS_PER_MESSAGE + self.count_text(item)
+            elif item.get("type", "message") == "message" or "role" in item:
+                total += self.count_message(item)
+            else:
+                total += self.count_text(json.dumps(item, ensure_ascii=False, sort_keys=True))
+        return total
+
+    def cache_info(self) -> dict:
+        """キャッシュのヒット状況"""
+        return {
+            "text": self.count_text.cache_info()._asdict(),
+            "message": self._count_message_key.cache_info()._asdict(),
+        }
+
+
+_counters: dict[str, TokenCounter] = {}
+
+
+def get_counter(model: str) -> TokenCounter:
+    """モデルに対応する共有 TokenCounter を取得"""
+    encoding_name = encoding_name_for_model(model)
+    counter = _counters.get(encoding_name)
+    if counter is None:
+        counter = _counters[encoding_name] = TokenCounter(encoding_name)
+    return counter
+
+
+def estimate_chat_tokens(model: str, messages: list, tools: Optional[list] = None) -> int:
+    """Chat Completions のプロンプトトークン数を見積もり"""
+    return get_counter(model).count_chat(messages, tools)
+
+
+def estimate_responses_tokens(model: str, input: Any, instructions: Optional[str] = None) -> int:
+    """Responses API のプロンプトトークン数を見積もり"""
+    return get_counter(model).count_responses_input(input, instructions)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="プロンプトトークン数の見積もり",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python tokens.py "Azure AI Foundry とは？"
+  python tokens.py --model gpt-4o-mini --file prompt.txt
+  python tokens.py --system "あなたは親切なアシスタントです。" "こんにちは"
+        """
+    )
+    parser.add_argument("text", nargs="?", help="見積もるテキスト（user メッセージ）")
+    parser.add_argument("--file", "-f", help="テキストを読み込むファイル")
+    parser.add_argument("--system", help="system メッセージ")
+    parser.add_argument("--model", "-m", default="gpt-4o", help="モデル名 (default: gpt-4o)")
+
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+    elif args.text:
+        text = args.text
+    else:
+        parser.error("text または --file を指定してください")
+
+    messages = []
+    if args.system:
+        messages.append({"role": "system", "content": args.system})
+    messages.append({"role": "user", "content": text})
+
+    counter = get_counter(args.model)
+    start = time.perf_counter()
+    tokens = counter.count_chat(messages)
+    cold = time.perf_counter() - start
+
+    iterations = 1000
+    start = time.perf_counter()
+    for _ in range(iterations):
+        counter.count_chat(messages)
+    warm = (time.perf_counter() - start) / iterations
+
+    print(f"Model: {args.model} (encoding: {counter.encoding_name})")
+    print(f"Method: {'tiktoken' if counter.exact else 'heuristic (pip install tiktoken で正確な計数)'}")
+    print(f"Chat prompt tokens: {tokens}")
+    print(f"Responses input tokens: {counter.count_responses_input(text, args.system)}")
+    print(f"Time: cold {cold * 1e6:.1f} µs / cached {warm * 1e6:.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+ローカルツール実行モジュール（Chat Completions の function calling 用）
+
+Python 関数をツールとして登録し、モデルが 1 ターンで返した複数の tool_calls を
+並列に実行して、結果をまとめて 1 回のフォローアップリクエストで返します。
+
+- 同期関数はスレッドプール、async 関数は専用スレッドの asyncio イベントループで実行します。
+- ツールごとにタイムアウトを設定できます（デッドライン設定時は残り時間で打ち切り）。
+  タイムアウトや例外はエラー内容を tool メッセージとしてモデルに返します。
+- 同一ツール・同一引数の結果は TTL 付きでキャッシュし、同じバッチ内の重複呼び出しは 1 回に合流します。
+
+注意: Python のスレッドは外部から停止できないため、タイムアウトした同期ツールは
+      バックグラウンドで最後まで実行されます（結果は破棄）。async ツールはキャンセルされます。
+"""
+
+import argparse
+import asyncio
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Optional
+
+import deadline
+import metrics
+from prompt_cache import canonical_json
+
+DEFAULT_TOOL_TIMEOUT = 10.0
+DEFAULT_CACHE_TTL = 300.0
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_ROUNDS = 4
+
+# 型注釈 → JSON Schema の型
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "array", dict: "object"}
+
+
+@dataclass
+class Tool:
+    """登録済みツール"""
+
+    name: str
+    fn: Callable[..., Any]
+    description: str
+    parameters: dict
+    timeout: float = DEFAULT_TOOL_TIMEOUT
+    cacheable: bool = True
+
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.fn)
+
+    def definition(self) -> dict:
+        """Chat Completions の tools パラメーター形式"""
+        return {
+            "type": "function",
+            "function": {"name": self.name, "description": self.description, "parameters": self.parameters},
+        }
+
+
+@dataclass
+class ToolResult:
+    """ツール 1 呼び出しの結果"""
+
+    tool_call_id: str
+    name: str
+    content: str
+    seconds: float = 0.0
+    cached: bool = False
+    error: Optional[str] = None
+
+    def message(self) -> dict:
+        """会話履歴に追加する tool メッセージ"""
+        return {"role": "tool", "tool_call_id": self.tool_call_id, "content": self.content}
+
+
+@dataclass
+class _ToolStats:
+    calls: int = 0
+    cached: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    seconds: float = 0.0
+
+
+@dataclass
+class BatchReport:
+    """1 ターン分の tool_calls の実行結果"""
+
+    calls: int
+    wall_seconds: float
+    serial_seconds: float
+    results: list = field(default_factory=list)
+
+
+def parameters_from_signature(fn: Callable[..., Any]) -> dict:
+    """関数シグネチャから JSON Schema（parameters）を生成"""
+    properties = {}
+    required = []
+    for name, param in inspect.signature(fn).parameters.items():
+        schema = {"type": _JSON_TYPES.get(param.annotation, "string")}
+        properties[name] = schema
+        if param.default is inspect.Parameter.empty:
+            required.append(name)
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def _call_fields(call: Any) -> tuple[str, str, str]:
+    """tool_call（SDK オブジェクト / dict）から id・名前・引数 JSON を取り出す"""
+    if isinstance(call, dict):
+        function = call.get("function") or {}
+        return call.get("id", ""), function.get("name", ""), function.get("arguments") or "{}"
+    return call.id, call.function.name, call.function.arguments or "{}"
+
+
+def _to_content(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def assistant_message(message: Any) -> dict:
+    """tool_calls を含む assistant メッセージを会話履歴用の dict に変換"""
+    calls = []
+    for call in message.tool_calls or ():
+        call_id, name, arguments = _call_fields(call)
+        calls.append({"id": call_id, "type": "function", "function": {"name": name, "arguments": arguments}})
+    return {"role": "assistant", "content": message.content, "tool_calls": calls}
+
+
+class ToolRegistry:
+    """ツールの登録と並列実行"""
+
+    def __init__(
+        self,
+        default_timeout: float = DEFAULT_TOOL_TIMEOUT,
+        cache_ttl: float = DEFAULT_CACHE_TTL,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        registry: Optional[metrics.MetricsRegistry] = None,
+    ):
+        self.default_timeout = default_timeout
+        self.cache_ttl = cache_ttl
+        self.tools: dict[str, Tool] = {}
+        self.batches: list[BatchReport] = []
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        # (ツール名, 正規化した引数) → (有効期限, 結果)
+        self._cache: dict[tuple[str, str], tuple[float, str]] = {}
+        self._stats: dict[str, _ToolStats] = {}
+
+        registry = registry or metrics.get_registry()
+        self._calls = registry.counter(
+            "aigateway_tool_calls_total",
+            "ローカルツールの呼び出し数",
+            ("tool", "outcome"),
+        )
+        self._duration = registry.histogram(
+            "aigateway_tool_duration_seconds",
+            "ローカルツールの実行時間（秒）",
+            ("tool",),
+        )
+
+    def register(
+        self,
+        fn: Optional[Callable[..., Any]] = None,
+        *,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        parameters: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        cacheable: bool = True,
+    ):
+        """
+        ツールを登録（デコレーターとしても使用可）
+
+        description を省略すると docstring の 1 行目、parameters を省略すると
+        型注釈から生成したスキーマを使います。
+        """
+        def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+            tool = Tool(
+                name=name or func.__name__,
+                fn=func,
+                description=description or (inspect.getdoc(func) or "").split("\n")[0],
+                parameters=parameters or parameters_from_signature(func),
+                timeout=timeout or self.default_timeout,
+                cacheable=cacheable,
+            )
+            self.tools[tool.name] = tool
+            return func
+        return decorator(fn) if fn else decorator
+
+    def definitions(self) -> list[dict]:
+        """Chat Completions に渡す tools"""
+        return [tool.definition() for tool in self.tools.values()]
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        """async ツール用のイベントループ（初回に専用スレッドで起動）"""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="tool-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _cached(self, key: tuple[str, str]) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            self._cache.pop(key, None)
+            return None
+
+    def _submit(self, tool: Tool, arguments: dict) -> Future:
+        if tool.is_async:
+            return asyncio.run_coroutine_threadsafe(tool.fn(**arguments), self._event_loop())
+        # デッドライン等のコンテキストをツール内の呼び出しに引き継ぐ
+        ctx = contextvars.copy_context()
+        return self._pool.submit(ctx.run, tool.fn, **arguments)
+
+    def _record(self, name: str, outcome: str, seconds: float) -> None:
+        self._calls.inc(tool=name, outcome=outcome)
+        with self._lock:
+            stats = self._stats.setdefault(name, _ToolStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            if outcome == "cached":
+                stats.cached += 1
+            elif outcome == "timeout":
+                stats.timeouts += 1
+            elif outcome == "error":
+                stats.errors += 1
+        if outcome != "cached":
+            self._duration.observe(seconds, tool=name)
+
+    def execute(self, tool_calls: Iterable[Any]) -> list[ToolResult]:
+        """
+        tool_calls をすべて並列に実行し、呼び出し順に結果を返す
+
+        失敗したツールも例外は送出せず、エラー内容を content に入れて返します
+        （モデルが別の方法で回答できるように）。
+        """
+        start = time.monotonic()
+        budget = deadline.current()
+        plans = []
+        inflight: dict[tuple[str, str], tuple[Future, float]] = {}
+        # 各呼び出しの完了時刻（収集順に待つため、実行時間は完了時に記録）
+        finished_at: dict[tuple[str, str], float] = {}
+
+        for call in tool_calls:
+            call_id, name, raw_arguments = _call_fields(call)
+            tool = self.tools.get(name)
+            if tool is None:
+                plans.append((call_id, name, None, None, f"unknown tool: {name}"))
+                continue
+            try:
+                arguments = json.loads(raw_arguments or "{}")
+            except json.JSONDecodeError as e:
+                plans.append((call_id, name, None, None, f"invalid arguments: {e}"))
+                continue
+            if not isinstance(arguments, dict):
+                plans.append((call_id, name, None, None, "invalid arguments: expected a JSON object"))
+                continue
+
+            key = (name, canonical_json(arguments))
+            cached = self._cached(key) if tool.cacheable else None
+            if cached is not None:
+                plans.append((call_id, name, key, None, cached))
+                continue
+            if key not in inflight:
+                timeout = tool.timeout
+                if budget:
+                    timeout = min(timeout, budget.remaining())
+                try:
+                    future = self._submit(tool, arguments)
+                except Exception as e:
+                    # 引数名の誤り等で呼び出し自体が失敗した（async ツールはここでコルーチンを作る）
+                    plans.append((call_id, name, None, None, f"{type(e).__name__}: {e}"))
+                    continue
+                future.add_done_callback(lambda _, key=key: finished_at.setdefault(key, time.monotonic()))
+                inflight[key] = (future, timeout)
+            plans.append((call_id, name, key, inflight[key], None))
+
+        results = []
+        collected: dict[tuple[str, str], ToolResult] = {}
+        for call_id, name, key, running, value in plans:
+            if running is None:
+                # 未登録・引数不正（key なし）またはキャッシュヒット
+                error = value if key is None else None
+                content = _to_content({"error": error}) if error else value
+                outcome = "error" if error else "cached"
+                self._record(name, outcome, 0.0)
+                results.append(ToolResult(call_id, name, content, cached=not error, error=error))
+                continue
+
+            if key in collected:
+                # 同一バッチ内の重複呼び出しは最初の結果を共有
+                shared = collected[key]
+                self._record(name, "cached", 0.0)
+                results.append(ToolResult(call_id, name, shared.content, cached=True, error=shared.error))
+                continue
+
+            future, timeout = running
+            error = None
+            try:
+                content = _to_content(future.result(timeout=max(0.0, start + timeout - time.monotonic())))
+                outcome = "ok"
+            except FutureTimeoutError:
+                future.cancel()
+                error = f"timed out after {timeout:.1f}s"
+                outcome = "timeout"
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                outcome = "error"
+            seconds = timeout if outcome == "timeout" else finished_at.get(key, time.monotonic()) - start
+            if error:
+                content = _to_content({"error": error})
+            elif self.tools[name].cacheable:
+                with self._lock:
+                    self._cache[key] = (time.monotonic() + self.cache_ttl, content)
+
+            self._record(name, outcome, seconds)
+            result = ToolResult(call_id, name, content, seconds=seconds, error=error)
+            collected[key] = result
+            results.append(result)
+
+        self.batches.append(BatchReport(
+            calls=len(results),
+            wall_seconds=time.monotonic() - start,
+            serial_seconds=sum(r.seconds for r in collected.values()),
+            results=results,
+        ))
+        return results
+
+    def run(
+        self,
+        client: Any,
+        model: str,
+        messages: list,
+        max_rounds: int = DEFAULT_MAX_ROUNDS,
+        **params: Any,
+    ) -> Any:
+        """
+        ツール呼び出しを含む会話を完了まで進め、最終レスポンスを返す
+
+        各ターンの tool_calls は並列に実行し、すべての結果を 1 回のリクエストで返します。
+        max_rounds に達したら tool_choice="none" で最終回答を求めます。
+        messages には assistant / tool メッセージが追記されます。
+        """
+        for round_index in range(max_rounds + 1):
+            if round_index == max_rounds:
+                params["tool_choice"] = "none"
+            response = client.create(model=model, messages=messages, tools=self.definitions(), **params)
+            message = response.choices[0].message
+            if not message.tool_calls:
+                return response
+            messages.append(assistant_message(message))
+            messages.extend(result.message() for result in self.execute(message.tool_calls))
+        return response
+
+    def close(self) -> None:
+        """スレッドプールとイベントループを停止"""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+    def print_report(self) -> None:
+        """ツール別の実行回数・キャッシュヒット・タイムアウトと並列化の効果を表示"""
+        if not self._stats:
+            return
+        print(f"\n{'='*60}")
+        print("Tool 実行レポート")
+        print(f"{'='*60}")
+        for name, stats in sorted(self._stats.items()):
+            executed = stats.calls - stats.cached
+            avg = stats.seconds / executed if executed else 0.0
+            print(f"  {name}: calls={stats.calls} cached={stats.cached} "
+                  f"errors={stats.errors} timeouts={stats.timeouts} avg={avg:.2f}s")
+        for i, batch in enumerate(self.batches, 1):
+            print(f"  [Turn {i}] {batch.calls} calls: wall {batch.wall_seconds:.2f}s "
+                  f"(serial {batch.serial_seconds:.2f}s)")
+
+
+def add_tool_arguments(parser: argparse.ArgumentParser) -> None:
+    """ツール実行のオプションを追加"""
+    parser.add_argument(
+        "--tool-timeout",
+        type=float,
+        default=float(os.getenv("AIGATEWAY_TOOL_TIMEOUT", str(DEFAULT_TOOL_TIMEOUT))),
+        metavar="SECONDS",
+        help=f"ツール 1 呼び出しのタイムアウト秒数（デフォルト: {DEFAULT_TOOL_TIMEOUT:.0f}）"
+    )
+    parser.add_argument(
+        "--tool-cache-ttl",
+        type=float,
+        default=DEFAULT_CACHE_TTL,
+        metavar="SECONDS",
+        help=f"ツール結果のキャッシュ有効秒数（0 で無効、デフォルト: {DEFAULT_CACHE_TTL:.0f}）"
+    )
+
+
+def create_registry(args: argparse.Namespace) -> ToolRegistry:
+    """コマンドライン引数から ToolRegistry を作成"""
+    return ToolRegistry(default_timeout=args.tool_timeout, cache_ttl=args.tool_cache_ttl)
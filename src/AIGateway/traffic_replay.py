@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+トラフィック記録・再生モジュール
+
+AI Gateway クライアントの呼び出し（リクエスト本文・送信時刻・レスポンスのメタデータ）を
+追記専用のログに記録し、同じトラフィックを新しい Gateway 設定に対して再生します。
+
+- 記録: RequestEvent フックとして登録（--record traffic.jsonl.gz）。同一の本文は 1 回だけ
+  書き出して参照で共有し、拡張子が .gz なら gzip 圧縮します。
+- 再生: オープンループ（前のリクエストの完了を待たない）で、記録時の到着間隔を
+  --speed 倍速で再現します。レイテンシは予定送信時刻から計測するため、
+  クライアント側の詰まりも結果に含まれます。
+- 比較: 2 つのログのレイテンシ分布（p50 / p90 / p99 等）とエラー率を比較します。
+
+注意: ログにはプロンプト本文が含まれます。取り扱いに注意してください。
+
+使用方法:
+    python test_chat_completions.py --all --record traffic.jsonl.gz
+    python traffic_replay.py replay traffic.jsonl.gz --speed 2 --record replay.jsonl.gz
+    python traffic_replay.py compare traffic.jsonl.gz replay.jsonl.gz
+"""
+
+import argparse
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from gateway_client import (
+    GatewayClient,
+    RequestEvent,
+    add_request_hook,
+    create_chat_client,
+    route_of,
+)
+from prompt_cache import canonical_json
+
+LOG_VERSION = 1
+
+# 比較レポートの分位点
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TrafficRecorder:
+    """RequestEvent を追記専用ログに書き出すフック"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = _open(path, "a")
+        self._lock = threading.Lock()
+        self._bodies: set[str] = set()
+        self._origin: Optional[float] = None
+        self.records = 0
+
+    def observe(self, event: RequestEvent) -> None:
+        """gateway_client.add_request_hook に登録して使用"""
+        body_id = None
+        body_line = None
+        if event.body is not None:
+            payload = canonical_json(event.body)
+            body_id = hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+            body_line = f'{{"type":"body","id":"{body_id}","body":{payload}}}\n'
+
+        started_at = event.started_at or time.time() - event.duration
+        with self._lock:
+            if self._origin is None:
+                self._origin = started_at
+                self._write({"type": "header", "version": LOG_VERSION, "started_at": started_at})
+            if body_id is not None and body_id not in self._bodies:
+                self._bodies.add(body_id)
+                self._file.write(body_line)
+            self._write({
+                "type": "request",
+                "t": round(started_at - self._origin, 6),
+                "api": event.api,
+                "op": event.operation,
+                "model": event.model,
+                "path": event.path,
+                "body": body_id,
+                "status": event.status_code,
+                "duration": round(event.duration, 6),
+                "ttft": round(event.ttft, 6) if event.ttft is not None else None,
+                "in": event.input_tokens,
+                "out": event.output_tokens,
+                "throttled": event.throttled,
+                "retries": event.retries,
+                "error": event.error,
+            })
+            self.records += 1
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+@dataclass
+class TrafficRecord:
+    """ログ中のリクエスト 1 件"""
+
+    t: float
+    api: str
+    op: str
+    model: Optional[str]
+    path: Optional[str]
+    body: Optional[dict]
+    status: Optional[int]
+    duration: float
+    ttft: Optional[float] = None
+    error: Optional[str] = None
+    throttled: int = 0
+
+
+def read_log(path: str) -> Iterator[TrafficRecord]:
+    """ログを読み、本文の参照を解決したリクエストを順に返す"""
+    bodies: dict[str, dict] = {}
+    # 複数回の記録を追記したログは、ヘッダーごとに時刻の基準をずらして連結
+    base = 0.0
+    last = 0.0
+    with _open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record.get("type")
+            if kind == "header":
+                base = last
+            elif kind == "body":
+                bodies[record["id"]] = record["body"]
+            elif kind == "request":
+                last = base + record["t"]
+                yield TrafficRecord(
+                    t=last,
+                    api=record["api"],
+                    op=record["op"],
+                    model=record.get("model"),
+                    path=record.get("path"),
+                    body=bodies.get(record.get("body")),
+                    status=record.get("status"),
+                    duration=record["duration"],
+                    ttft=record.get("ttft"),
+                    error=record.get("error"),
+                    throttled=record.get("throttled", 0),
+                )
+
+
+def replayable(record: TrafficRecord) -> bool:
+    """再生可能か（本文付きの作成系リクエストで、過去の ID に依存しないもの）"""
+    if record.body is None or not record.path:
+        return False
+    if route_of("POST", record.path) != f"POST {record.path}":
+        return False
+    return "previous_response_id" not in record.body
+
+
+@dataclass
+class ReplayResult:
+    """再生したリクエスト 1 件の結果"""
+
+    t: float
+    api: str
+    # 予定送信時刻から完了までの秒数
+    latency: float
+    # 予定送信時刻からの送信遅れ
+    lag: float
+    error: Optional[str] = None
+
+
+class TrafficReplayer:
+    """記録したトラフィックをオープンループで再生"""
+
+    def __init__(self, config, speed: float = 1.0, max_inflight: int = 256):
+        if speed <= 0:
+            raise ValueError("speed は 0 より大きい値を指定してください")
+        self.speed = speed
+        self.chat = create_chat_client(config)
+        self._raw: dict[str, GatewayClient] = {}
+        self._config = config
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="replay")
+        self._lock = threading.Lock()
+        self.results: list[ReplayResult] = []
+        self.skipped = 0
+
+    def _raw_client(self, api: str):
+        client = self._raw.get(api)
+        if client is None:
+            client = self._raw[api] = GatewayClient(
+                self._config.base_url_responses, self._config.api_key, self._config.api_version
+            )
+            # メトリクスの api ラベルを記録時と揃える
+            client.api_name = api
+        return client
+
+    def _send(self, record: TrafficRecord) -> None:
+        body = dict(record.body)
+        if record.api == "chat":
+            model = body.pop("model")
+            messages = body.pop("messages")
+            response = self.chat.create(model, messages, **body)
+            if body.get("stream"):
+                for _ in response:
+                    pass
+        else:
+            operation = record.op if " " not in record.op else None
+            self._raw_client(record.api)._request(
+                "POST", record.path, json=body, operation=operation, model=record.model
+            )
+
+    def _run(self, record: TrafficRecord, scheduled: float) -> None:
+        lag = time.perf_counter() - scheduled
+        error = None
+        try:
+            self._send(record)
+        except Exception as e:
+            error = type(e).__name__
+        result = ReplayResult(
+            t=record.t, api=record.api, latency=time.perf_counter() - scheduled, lag=lag, error=error
+        )
+        with self._lock:
+            self.results.append(result)
+
+    def replay(self, records: list[TrafficRecord]) -> list[ReplayResult]:
+        """記録時の到着間隔を speed 倍速で再現して送信し、すべての完了を待つ"""
+        records = sorted(records, key=lambda r: r.t)
+        origin = time.perf_counter()
+        first = records[0].t if records else 0.0
+        for record in records:
+            if not replayable(record):
+                self.skipped += 1
+                continue
+            scheduled = origin + (record.t - first) / self.speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._pool.submit(self._run, record, scheduled)
+        self._pool.shutdown(wait=True)
+        return self.results
+
+
+def _quantile(sorted_values: list[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def ks_statistic(a: list[float], b: list[float]) -> float:
+    """2 標本コルモゴロフ–スミルノフ統計量（分布の最大乖離、0〜1）"""
+    a, b = sorted(a), sorted(b)
+    i = j = 0
+    d = 0.0
+    while i < len(a) and j < len(b):
+        x = min(a[i], b[j])
+        while i < len(a) and a[i] <= x:
+            i += 1
+        while j < len(b) and b[j] <= x:
+            j += 1
+        d = max(d, abs(i / len(a) - j / len(b)))
+    return d
+
+
+def summarize(durations: list[float], errors: int = 0, throttled: int = 0) -> dict:
+    """レイテンシ分布の要約"""
+    values = sorted(durations)
+    summary = {"count": len(values) + errors, "errors": errors, "throttled": throttled}
+    for q in QUANTILES:
+        summary[f"p{int(q * 100)}"] = _quantile(values, q)
+    summary["max"] = values[-1] if values else None
+    return summary
+
+
+def summarize_log(path: str) -> dict[str, dict]:
+    """ログを API 別（と全体）に要約"""
+    groups: dict[str, dict] = {}
+    for record in read_log(path):
+        for key in (record.api, "all"):
+            group = groups.setdefault(key, {"durations": [], "errors": 0, "throttled": 0})
+            if record.error:
+                group["errors"] += 1
+            else:
+                group["durations"].append(record.duration)
+            group["throttled"] += record.throttled
+    return {
+        key: {**summarize(g["durations"], g["errors"], g["throttled"]), "durations": g["durations"]}
+        for key, g in groups.items()
+    }
+
+
+def _fmt(value: Optional[float]) -> str:
+    return f"{value * 1000:8.1f}ms" if value is not None else f"{'-':>10}"
+
+
+def print_comparison(baseline_path: str, candidate_path: str) -> None:
+    """2 つのログのレイテンシ分布を比較して出力"""
+    baseline = summarize_log(baseline_path)
+    candidate = summarize_log(candidate_path)
+    columns = [f"p{int(q * 100)}" for q in QUANTILES] + ["max"]
+
+    print(f"\n{'='*60}")
+    print(f"Baseline:  {baseline_path}")
+    print(f"Candidate: {candidate_path}")
+    print(f"{'='*60}")
+    for api in sorted(baseline.keys() | candidate.keys(), key=lambda k: (k == "all", k)):
+        a = baseline.get(api)
+        b = candidate.get(api)
+        print(f"\n[{api}]")
+        print(f"  {'':10}" + "".join(f"{c:>12}" for c in columns) + f"{'count':>8}{'errors':>8}")
+        for label, s in (("baseline", a), ("candidate", b)):
+            if s is None:
+                print(f"  {label:10}  (no data)")
+                continue
+            print(
+                f"  {label:10}" + "".join(f"  {_fmt(s[c])}" for c in columns)
+                + f"{s['count']:>8}{s['errors']:>8}"
+            )
+        if a and b:
+            deltas = []
+            for c in columns:
+                if a[c] and b[c] is not None:
+                    deltas.append(f"{(b[c] - a[c]) / a[c]:+11.1%} ")
+                else:
+                    deltas.append(f"{'-':>11} ")
+            print(f"  {'delta':10}" + "".join(deltas))
+            if a["durations"] and b["durations"]:
+                print(f"  KS statistic: {ks_statistic(a['durations'], b['durations']):.3f}")
+
+
+def add_record_arguments(parser: argparse.ArgumentParser) -> None:
+    """トラフィック記録用の CLI 引数を追加"""
+    parser.add_argument(
+        "--record",
+        default=os.getenv("AIGATEWAY_TRAFFIC_RECORD"),
+        metavar="PATH",
+        help="呼び出しを記録するログファイル（.gz で圧縮、再生用）",
+    )
+
+
+def start_recording(args: argparse.Namespace) -> Optional[TrafficRecorder]:
+    """CLI 引数に応じて記録を開始（指定がなければ None）"""
+    if not args.record:
+        return None
+    recorder = TrafficRecorder(args.record)
+    atexit.register(recorder.close)
+    print(f"Recording: {args.record}")
+    return recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="トラフィックの記録・再生・比較",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python test_chat_completions.py --all --record traffic.jsonl.gz
+  python traffic_replay.py summary traffic.jsonl.gz
+  python traffic_replay.py replay traffic.jsonl.gz --speed 2 --record replay.jsonl.gz
+  python traffic_replay.py compare traffic.jsonl.gz replay.jsonl.gz
+        """
+    )
+    parser.add_argument("command", choices=["summary", "replay", "compare"])
+    parser.add_argument("logs", nargs="+", help="トラフィックログ（compare は 2 つ）")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率 (default: 1.0)")
+    parser.add_argument("--max-inflight", type=int, default=256, help="同時実行数の上限 (default: 256)")
+    add_record_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        for path in args.logs:
+            print(f"\n{path}")
+            for api, s in summarize_log(path).items():
+                print(
+                    f"  - {api}: count={s['count']}, errors={s['errors']}, 429={s['throttled']}, "
+                    f"p50={_fmt(s['p50']).strip()}, p99={_fmt(s['p99']).strip()}"
+                )
+        return
+
+    if args.command == "compare":
+        if len(args.logs) != 2:
+            parser.error("compare には 2 つのログを指定してください")
+        print_comparison(*args.logs)
+        return
+
+    from config import get_config
+
+    try:
+        config = get_config()
+    except ValueError as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    recorder = start_recording(args)
+    if recorder:
+        add_request_hook(recorder.observe)
+
+    records = [r for path in args.logs for r in read_log(path)]
+    replayer = TrafficReplayer(config, speed=args.speed, max_inflight=args.max_inflight)
+    print(f"Replaying {len(records)} requests at {args.speed}x ...")
+    start = time.perf_counter()
+    results = replayer.replay(records)
+    elapsed = time.perf_counter() - start
+
+    errors = sum(1 for r in results if r.error)
+    summary = summarize([r.latency for r in results if not r.error], errors)
+    lags = sorted(r.lag for r in results)
+
+    print(f"\n{'='*60}")
+    print(f"✅ Replayed {len(results)} requests in {elapsed:.1f}s (skipped {replayer.skipped})")
+    print(f"   Latency: p50={_fmt(summary['p50']).strip()}, p99={_fmt(summary['p99']).strip()}, errors={errors}")
+    print(f"   Send lag: p99={_fmt(_quantile(lags, 0.99)).strip()}")
+    print(f"{'='*60}")
+    if recorder:
+        recorder.close()
+        print_comparison(args.logs[0], args.record)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+"""
+使用量台帳モジュール
+
+AI Gateway クライアントのすべての呼び出しについて、トークン数・所要時間・推定コストを
+追記専用の列指向ファイル（台帳）に記録し、モデル別・時間帯別に集計します。
+
+- 記録: RequestEvent フックとして登録（--ledger DIR）。呼び出しごとの追記は
+  型付き配列（array）への append だけで、flush_rows 件または flush_interval 秒ごとに
+  1 ブロックとしてまとめて書き出します。ファイルは rotate_rows 件ごとに切り替えます。
+- 形式: ブロック = マジック + ヘッダー（JSON: 行数・列の型・文字列列の辞書）+ 列ごとの生バイト列。
+  文字列列（api / operation / model / error）はブロックごとの辞書でコード化します。
+  書き込み途中で終了した末尾のブロックは読み込み時に無視します。
+- 集計: 数百万行でも列単位で読み込み、(model, hour) 等のグループごとに
+  件数・エラー率・429・p50 / p95 / p99 レイテンシ・TTFT・トークン数・コストを算出します。
+- エクスポート: pyarrow がインストールされていれば Parquet に変換できます（DuckDB / pandas 等で分析）。
+
+使用方法:
+    python test_chat_completions.py --all --ledger usage/
+    python usage_ledger.py summary usage/ --by model,hour --since 24h
+    python usage_ledger.py export usage/ --parquet usage.parquet
+"""
+
+import argparse
+import atexit
+import itertools
+import json
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+
+from gateway_client import RequestEvent
+from router import DeploymentCost, find_cost, load_cost_table
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+MAGIC = b"AGL1"
+FILE_SUFFIX = ".ulg"
+
+DEFAULT_FLUSH_ROWS = 4096
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_ROTATE_ROWS = 1_000_000
+
+# 文字列コードは 'H'（2 バイト）のため、1 ブロックの行数はこれ以下に抑える
+MAX_BLOCK_ROWS = 65535
+
+# 整数列で値がないことを表す
+MISSING = -1
+
+# 数値列: (列名, array の型コード)
+NUMERIC_COLUMNS = (
+    ("ts", "d"),             # 送信時刻（UNIX 秒）
+    ("duration", "f"),       # 所要時間（秒、リトライ込み）
+    ("ttft", "f"),           # 最初のトークンまで（秒、なければ NaN）
+    ("input_tokens", "i"),
+    ("output_tokens", "i"),
+    ("cached_tokens", "i"),
+    ("status", "h"),         # 0 は応答なし
+    ("throttled", "B"),
+    ("retries", "B"),
+    ("cost", "d"),           # 推定コスト（USD、単価不明なら NaN）
+)
+
+# 辞書エンコードする文字列列
+STRING_COLUMNS = ("api", "operation", "model", "error")
+
+# 集計のグループキー
+GROUP_KEYS = ("model", "api", "operation", "hour", "day")
+
+QUANTILES = (0.50, 0.95, 0.99)
+
+
+def _int_or_missing(value: Optional[int]) -> int:
+    return MISSING if value is None else int(value)
+
+
+class _BlockBuilder:
+    """書き出し前の 1 ブロック分の列"""
+
+    def __init__(self):
+        self.columns = {name: array(code) for name, code in NUMERIC_COLUMNS}
+        self.codes = {name: array("H") for name in STRING_COLUMNS}
+        self.dicts: dict[str, dict[Optional[str], int]] = {name: {} for name in STRING_COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.columns["ts"])
+
+    def _code(self, column: str, value: Optional[str]) -> int:
+        mapping = self.dicts[column]
+        code = mapping.get(value)
+        if code is None:
+            code = mapping[value] = len(mapping)
+        return code
+
+    def append(self, event: RequestEvent, cost: float) -> None:
+        c = self.columns
+        c["ts"].append(event.started_at or time.time() - event.duration)
+        c["duration"].append(event.duration)
+        c["ttft"].append(event.ttft if event.ttft is not None else math.nan)
+        c["input_tokens"].append(_int_or_missing(event.input_tokens))
+        c["output_tokens"].append(_int_or_missing(event.output_tokens))
+        c["cached_tokens"].append(_int_or_missing(event.cached_tokens))
+        c["status"].append(event.status_code or 0)
+        c["throttled"].append(min(event.throttled, 255))
+        c["retries"].append(min(event.retries, 255))
+        c["cost"].append(cost)
+        for name, value in (
+            ("api", event.api),
+            ("operation", event.operation),
+            ("model", event.model),
+            ("error", event.error),
+        ):
+            self.codes[name].append(self._code(name, value))
+
+    def encode(self) -> bytes:
+        """マジック + ヘッダー長 + ヘッダー + 列データ"""
+        arrays = [(name, col) for name, col in self.columns.items()]
+        arrays += [(name, col) for name, col in self.codes.items()]
+        header = {
+            "rows": len(self),
+            "byteorder": sys.byteorder,
+            "columns": [[name, col.typecode, col.itemsize * len(col)] for name, col in arrays],
+            "dicts": {name: list(mapping) for name, mapping in self.dicts.items()},
+        }
+        header_bytes = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return b"".join(
+            [MAGIC, struct.pack("<I", len(header_bytes)), header_bytes] + [col.tobytes() for _, col in arrays]
+        )
+
+
+@dataclass
+class Block:
+    """読み込んだ 1 ブロック（columns は数値列と文字列列のコード、dicts はコード → 文字列）"""
+
+    rows: int
+    columns: dict[str, array]
+    dicts: dict[str, list]
+
+    def strings(self, name: str) -> list:
+        """文字列列を行ごとの値に展開"""
+        values = self.dicts[name]
+        return [values[code] for code in self.columns[name]]
+
+
+def read_ledger(path: str) -> Iterator[Block]:
+    """台帳ファイルのブロックを順に読み込む"""
+    with open(path, "rb") as f:
+        data = f.read()
+    view = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        if offset + 8 > len(data):
+            # 書き込み途中で終了した末尾のブロック
+            return
+        if data[offset:offset + 4] != MAGIC:
+            print(f"⚠️ {path}: 不正なブロックを検出したため以降を無視します（offset={offset}）", file=sys.stderr)
+            return
+        (header_len,) = struct.unpack_from("<I", data, offset + 4)
+        start = offset + 8 + header_len
+        if start > len(data):
+            return
+        header = json.loads(bytes(view[offset + 8:start]))
+        end = start + sum(nbytes for _, _, nbytes in header["columns"])
+        if end > len(data):
+            # 書き込み途中で終了した末尾のブロック
+            return
+        columns = {}
+        position = start
+        for name, typecode, nbytes in header["columns"]:
+            col = array(typecode)
+            col.frombytes(view[position:position + nbytes])
+            if header["byteorder"] != sys.byteorder:
+                col.byteswap()
+            columns[name] = col
+            position += nbytes
+        yield Block(header["rows"], columns, header["dicts"])
+        offset = end
+
+
+def ledger_files(paths: Iterable[str]) -> list[str]:
+    """ディレクトリ指定を台帳ファイルの一覧に展開"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(FILE_SUFFIX)
+            )
+        else:
+            files.append(path)
+    return files
+
+
+class UsageLedger:
+    """RequestEvent を列指向の台帳に追記するフック"""
+
+    def __init__(
+        self,
+        directory: str,
+        costs: Optional[dict[str, DeploymentCost]] = None,
+        flush_rows: int = DEFAULT_FLUSH_ROWS,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        rotate_rows: int = DEFAULT_ROTATE_ROWS,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.costs = costs if costs is not None else load_cost_table()
+        self.flush_rows = min(flush_rows, MAX_BLOCK_ROWS)
+        self.flush_interval = flush_interval
+        self.rotate_rows = rotate_rows
+        self.rows = 0
+        self.files: list[str] = []
+        self._block = _BlockBuilder()
+        self._last_flush = time.monotonic()
+        # 追記（_lock）とファイル書き込み（_write_lock）を分け、書き込み中も追記を止めない
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._file = None
+        self._file_rows = 0
+        self._unit_costs: dict[Optional[str], Optional[DeploymentCost]] = {}
+
+    def _cost(self, event: RequestEvent) -> float:
+        if event.input_tokens is None and event.output_tokens is None:
+            return math.nan
+        unit = self._unit_costs.get(event.model, False)
+        if unit is False:
+            unit = self._unit_costs[event.model] = find_cost(self.costs, event.model) if event.model else None
+        if unit is None:
+            return math.nan
+        return unit.actual(event.input_tokens or 0, event.output_tokens or 0, event.cached_tokens or 0)
+
+    def observe(self, event: RequestEvent) -> None:
+        """gateway_client.add_request_hook に登録して使用"""
+        cost = self._cost(event)
+        with self._lock:
+            self._block.append(event, cost)
+            self.rows += 1
+            if len(self._block) < self.flush_rows and time.monotonic() - self._last_flush < self.flush_interval:
+                return
+            block = self._swap()
+        self._write(block)
+
+    def _swap(self) -> _BlockBuilder:
+        block, self._block = self._block, _BlockBuilder()
+        self._last_flush = time.monotonic()
+        return block
+
+    def _write(self, block: _BlockBuilder) -> None:
+        data = block.encode()
+        with self._write_lock:
+            if self._file is None or self._file_rows >= self.rotate_rows:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._file_rows += len(block)
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        name = f"usage-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{len(self.files)}{FILE_SUFFIX}"
+        path = os.path.join(self.directory, name)
+        self._file = open(path, "ab")
+        self._file_rows = 0
+        self.files.append(path)
+
+    def flush(self) -> None:
+        """バッファ中の行を書き出す"""
+        with self._lock:
+            if not len(self._block):
+                return
+            block = self._swap()
+        self._write(block)
+
+    def close(self) -> None:
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@dataclass
+class _Group:
+    count: int = 0
+    errors: int = 0
+    throttled: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+    durations: array = field(default_factory=lambda: array("f"))
+    ttfts: array = field(default_factory=lambda: array("f"))
+
+
+def _quantile(sorted_values, q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def _key_column(block: Block, key: str) -> list:
+    if key == "hour":
+        return [int(t // 3600) * 3600 for t in block.columns["ts"]]
+    if key == "day":
+        return [int(t // 86400) * 86400 for t in block.columns["ts"]]
+    return block.strings(key)
+
+
+def aggregate(
+    paths: Iterable[str],
+    by: tuple[str, ...] = ("model", "hour"),
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> list[dict]:
+    """台帳をグループ別に集計（hour / day は UTC の区切り）"""
+    groups: dict[tuple, _Group] = {}
+    for path in ledger_files(paths):
+        for block in read_ledger(path):
+            c = block.columns
+            keys = zip(*(_key_column(block, key) for key in by)) if by else itertools.repeat(())
+            error_codes = {i for i, value in enumerate(block.dicts["error"]) if value is not None}
+            rows = zip(
+                keys, c["ts"], c["duration"], c["ttft"], c["status"], c["throttled"], c["error"],
+                c["input_tokens"], c["output_tokens"], c["cached_tokens"], c["cost"],
+            )
+            for key, ts, duration, ttft, status, throttled, error, inp, out, cached, cost in rows:
+                if (since is not None and ts < since) or (until is not None and ts >= until):
+                    continue
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = _Group()
+                group.count += 1
+                group.throttled += throttled
+                if error in error_codes or status == 0 or status >= 400:
+                    group.errors += 1
+                else:
+                    group.durations.append(duration)
+                    if not math.isnan(ttft):
+                        group.ttfts.append(ttft)
+                if inp > 0:
+                    group.input_tokens += inp
+                if out > 0:
+                    group.output_tokens += out
+                if cached > 0:
+                    group.cached_tokens += cached
+                if not math.isnan(cost):
+                    group.cost += cost
+
+    results = []
+    for key, group in sorted(groups.items(), key=lambda item: tuple("" if v is None else v for v in item[0])):
+        durations = sorted(group.durations)
+        ttfts = sorted(group.ttfts)
+        row = dict(zip(by, key))
+        row.update({
+            "count": group.count,
+            "errors": group.errors,
+            "error_rate": group.errors / group.count,
+            "throttled": group.throttled,
+            **{f"p{int(q * 100)}": _quantile(durations, q) for q in QUANTILES},
+            "ttft_p95": _quantile(ttfts, 0.95),
+            "input_tokens": group.input_tokens,
+            "output_tokens": group.output_tokens,
+            "cached_tokens": group.cached_tokens,
+            "cost": group.cost,
+        })
+        results.append(row)
+    return results
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """"24h" / "7d" / "30m"（現在からの相対）または ISO 形式の日時を UNIX 秒に変換"""
+    if not value:
+        return None
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if value[-1] in units and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()
+    return parsed.timestamp()
+
+
+def _format_key(name: str, value) -> str:
+    if name == "hour":
+        return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%d %H:00")
+    if name == "day":
+        return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%d")
+    return "-" if value is None else str(value)
+
+
+def _ms(value: Optional[float]) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+
+def print_summary(rows: list[dict], by: tuple[str, ...]) -> None:
+    """集計結果を表形式で出力"""
+    headers = [f"{key} (UTC)" if key in ("hour", "day") else key for key in by]
+    headers += ["count", "err%", "429", "p50", "p95", "p99", "ttft p95", "in tok", "out tok", "cost $"]
+    table = []
+    for row in rows:
+        table.append([_format_key(key, row[key]) for key in by] + [
+            f"{row['count']:,}",
+            f"{row['error_rate']:.1%}",
+            f"{row['throttled']:,}",
+            _ms(row["p50"]),
+            _ms(row["p95"]),
+            _ms(row["p99"]),
+            _ms(row["ttft_p95"]),
+            f"{row['input_tokens']:,}",
+            f"{row['output_tokens']:,}",
+            f"{row['cost']:.4f}",
+        ])
+    widths = [max(len(h), *(len(r[i]) for r in table)) if table else len(h) for i, h in enumerate(headers)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    print("  ".join("-" * w for w in widths))
+    for r in table:
+        print("  ".join(v.ljust(w) if i < len(by) else v.rjust(w) for i, (v, w) in enumerate(zip(r, widths))))
+
+    count = sum(r["count"] for r in rows)
+    print(
+        f"\n合計: {count:,} calls, errors={sum(r['errors'] for r in rows):,}, "
+        f"tokens={sum(r['input_tokens'] + r['output_tokens'] for r in rows):,}, "
+        f"cost=${sum(r['cost'] for r in rows):.4f}"
+    )
+
+
+def export_parquet(paths: Iterable[str], output: str) -> int:
+    """台帳を Parquet に変換（要 pyarrow）、書き出した行数を返す"""
+    if pyarrow is None:
+        raise RuntimeError("Parquet への変換には pyarrow が必要です: pip install pyarrow")
+    writer = None
+    rows = 0
+    try:
+        for path in ledger_files(paths):
+            for block in read_ledger(path):
+                c = block.columns
+                arrays = {
+                    "ts": pyarrow.array(
+                        [int(t * 1_000_000) for t in c["ts"]], pyarrow.timestamp("us", tz="UTC")
+                    ),
+                }
+                for name, _ in NUMERIC_COLUMNS[1:]:
+                    values = c[name].tolist()
+                    if c[name].typecode == "i":
+                        arrays[name] = pyarrow.array(values, pyarrow.int32(), mask=[v == MISSING for v in values])
+                    else:
+                        # NaN（値なし）は null にする
+                        arrays[name] = pyarrow.array(values, from_pandas=True)
+                for name in STRING_COLUMNS:
+                    arrays[name] = pyarrow.DictionaryArray.from_arrays(
+                        pyarrow.array(c[name].tolist(), pyarrow.uint16()),
+                        pyarrow.array(block.dicts[name], pyarrow.string()),
+                    )
+                table = pyarrow.table(arrays)
+                if writer is None:
+                    writer = parquet.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+                rows += block.rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def add_ledger_arguments(parser: argparse.ArgumentParser) -> None:
+    """使用量台帳用の CLI 引数を追加"""
+    parser.add_argument(
+        "--ledger",
+        default=os.getenv("AIGATEWAY_USAGE_LEDGER"),
+        metavar="DIR",
+        help="呼び出しごとのトークン数・所要時間・コストを記録するディレクトリ（usage_ledger.py で集計）",
+    )
+
+
+def start_ledger(args: argparse.Namespace, cost_table_path: Optional[str] = None) -> Optional[UsageLedger]:
+    """CLI 引数に応じて台帳への記録を開始（指定がなければ None）"""
+    if not args.ledger:
+        return None
+    ledger = UsageLedger(args.ledger, costs=load_cost_table(cost_table_path))
+    atexit.register(ledger.close)
+    print(f"Usage ledger: {args.ledger}")
+    return ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="使用量台帳の集計・エクスポート",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python test_chat_completions.py --all --ledger usage/
+  python usage_ledger.py summary usage/
+  python usage_ledger.py summary usage/ --by model,hour --since 24h
+  python usage_ledger.py summary usage/ --by model --since 2025-06-01 --json
+  python usage_ledger.py export usage/ --parquet usage.parquet
+        """
+    )
+    parser.add_argument("command", choices=["summary", "export"])
+    parser.add_argument("paths", nargs="+", help="台帳ディレクトリまたはファイル")
+    parser.add_argument(
+        "--by",
+        default="model,hour",
+        help=f"グループキー（カンマ区切り、{' / '.join(GROUP_KEYS)}、default: model,hour）"
+    )
+    parser.add_argument("--since", help='集計開始（"24h" / "7d" 等の相対指定、または ISO 形式の日時）')
+    parser.add_argument("--until", help="集計終了（--since と同じ形式）")
+    parser.add_argument("--json", action="store_true", help="集計結果を JSON で出力")
+    parser.add_argument("--parquet", metavar="PATH", help="export の出力先 Parquet ファイル")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        if not args.parquet:
+            parser.error("export には --parquet を指定してください")
+        try:
+            rows = export_parquet(args.paths, args.parquet)
+        except RuntimeError as e:
+            print(f"❌ エラー: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"✅ {rows:,} 行を {args.parquet} に書き出しました")
+        return
+
+    by = tuple(key.strip() for key in args.by.split(",") if key.strip())
+    unknown = [key for key in by if key not in GROUP_KEYS]
+    if unknown:
+        parser.error(f"--by に指定できるのは {', '.join(GROUP_KEYS)} です: {', '.join(unknown)}")
+    try:
+        since, until = parse_time(args.since), parse_time(args.until)
+    except ValueError as e:
+        parser.error(f"日時の形式が正しくありません: {e}")
+
+    start = time.perf_counter()
+    rows = aggregate(args.paths, by, since, until)
+    elapsed = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+        return
+    print_summary(rows, by)
+    print(f"({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+接続の事前ウォームアップモジュール
+
+短時間で終わるスクリプトやベンチマークでは、最初のリクエストが DNS 解決・TCP 接続・
+TLS ハンドシェイク・APIM のコールドパスの待ち時間をまとめて負担するため、
+所要時間や p99 が実際より悪く見えます。--warmup N を指定すると、最初の呼び出しの前に
+
+- エンドポイントのホスト名を解決してキャッシュし（DNSCache、TTL 付き）、
+- N 本の接続を並列に開いて接続プールに入れておき、
+- 新規接続（cold）と確立済み接続（warm）での応答時間、最初の呼び出しの所要時間を表示します。
+
+ウォームアップの要求は GET /models で、応答のステータスは問いません（接続が確立できれば十分）。
+RequestEvent は発行しないため、リクエスト数・レイテンシのメトリクスには含まれません。
+
+使用方法:
+    python test_chat_completions.py --warmup 4
+    python test_responses_api.py --warmup 8 --dns-ttl 60
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+import openai
+
+import metrics
+from gateway_client import (
+    DEFAULT_POOL_SIZE,
+    ChatClient,
+    GatewayClient,
+    RequestEvent,
+    add_request_hook,
+    create_session,
+)
+
+# DNS キャッシュの既定の有効期間（秒）
+DEFAULT_DNS_TTL = 300.0
+
+# ウォームアップ要求 1 件あたりのタイムアウト（秒）
+PROBE_TIMEOUT = 30.0
+
+# warm（確立済み接続）の応答時間を測る回数
+WARM_PROBES = 3
+
+
+class DNSCache:
+    """
+    socket.getaddrinfo の結果を TTL 付きでキャッシュ
+
+    install() するとプロセス内のすべての名前解決（requests / httpx とも）がキャッシュを経由します。
+    解決に失敗した結果はキャッシュしません。
+    """
+
+    def __init__(self, ttl: float = DEFAULT_DNS_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[tuple, tuple[float, list]] = {}
+        self._lock = threading.Lock()
+        self._resolve = socket.getaddrinfo
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return list(entry[1])
+        result = self._resolve(host, port, family, type, proto, flags)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self.misses += 1
+        return list(result)
+
+    def install(self) -> None:
+        socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self) -> None:
+        socket.getaddrinfo = self._resolve
+
+
+_dns_cache: Optional[DNSCache] = None
+
+
+def install_dns_cache(ttl: float = DEFAULT_DNS_TTL) -> DNSCache:
+    """プロセス共通の DNS キャッシュを有効化（2 回目以降は TTL だけ更新）"""
+    global _dns_cache
+    if _dns_cache is None:
+        _dns_cache = DNSCache(ttl)
+        _dns_cache.install()
+    _dns_cache.ttl = ttl
+    return _dns_cache
+
+
+@dataclass
+class WarmupReport:
+    """1 クライアント分のウォームアップ結果"""
+
+    api: str
+    host: str
+    addresses: list[str] = field(default_factory=list)
+    dns_seconds: Optional[float] = None
+    # 新規接続での応答時間（並列に開いた接続ごと）
+    cold: list[float] = field(default_factory=list)
+    # 確立済み接続での応答時間
+    warm: list[float] = field(default_factory=list)
+    failed: int = 0
+    error: Optional[str] = None
+    # ウォームアップ後の最初の呼び出し
+    first_request: Optional[RequestEvent] = None
+
+
+def _probe(client) -> Callable[[], None]:
+    """接続を 1 本使う軽量な要求（ステータスは問わない）"""
+    if isinstance(client, ChatClient):
+        sdk = client.client.with_options(timeout=PROBE_TIMEOUT)
+
+        def probe() -> None:
+            try:
+                sdk.models.list()
+            except openai.APIStatusError:
+                pass
+
+        return probe
+
+    url = client._url("/models")
+
+    def probe() -> None:
+        # 本文を読み切ると接続がプールに戻る
+        client.session.get(url, headers=client.headers, timeout=PROBE_TIMEOUT).content
+
+    return probe
+
+
+def _target_url(client) -> str:
+    if isinstance(client, ChatClient):
+        return str(client.client.base_url)
+    return client.base_url
+
+
+class Warmup:
+    """クライアントの接続を事前に開き、cold / warm の応答時間を比較"""
+
+    def __init__(self, connections: int, dns_cache: Optional[DNSCache] = None):
+        self.connections = connections
+        self.dns_cache = dns_cache
+        self.reports: list[WarmupReport] = []
+        self._seconds = metrics.get_registry().gauge(
+            "aigateway_warmup_seconds",
+            "ウォームアップで計測した応答時間の中央値（phase=dns / cold / warm）",
+            ("api", "phase"),
+        )
+
+    def run(self, client) -> WarmupReport:
+        """DNS 解決と connections 本の接続の確立を行う"""
+        parts = urlsplit(_target_url(client))
+        report = WarmupReport(api=client.api_name, host=parts.hostname or "")
+        self.reports.append(report)
+
+        start = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(
+                report.host, parts.port or (443 if parts.scheme == "https" else 80), type=socket.SOCK_STREAM
+            )
+        except OSError as e:
+            report.error = f"DNS 解決に失敗しました: {e}"
+            return report
+        report.dns_seconds = time.perf_counter() - start
+        report.addresses = sorted({info[4][0] for info in infos})
+
+        if isinstance(client, GatewayClient):
+            # 並列に開いた接続をすべてプールに残せるようにする
+            client.session = create_session(max(self.connections, DEFAULT_POOL_SIZE))
+        probe = _probe(client)
+        # 全スレッドが揃ってから送り、要求ごとに別の接続を使わせる
+        barrier = threading.Barrier(self.connections)
+
+        def timed(wait: bool) -> Optional[float]:
+            if wait:
+                barrier.wait()
+            started = time.perf_counter()
+            try:
+                probe()
+            except Exception as e:
+                report.error = f"{type(e).__name__}: {e}"
+                return None
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix="warmup") as pool:
+            results = list(pool.map(timed, [True] * self.connections))
+        report.cold = [r for r in results if r is not None]
+        report.failed = len(results) - len(report.cold)
+        if report.cold:
+            for _ in range(WARM_PROBES):
+                elapsed = timed(False)
+                if elapsed is not None:
+                    report.warm.append(elapsed)
+
+        for phase, values in (
+            ("dns", [report.dns_seconds]),
+            ("cold", report.cold),
+            ("warm", report.warm),
+        ):
+            if values:
+                self._seconds.set(statistics.median(values), api=report.api, phase=phase)
+        return report
+
+    def observe(self, event: RequestEvent) -> None:
+        """リクエストフック: ウォームアップ後の最初の呼び出しを記録"""
+        for report in self.reports:
+            if report.api == event.api and report.first_request is None:
+                report.first_request = event
+
+    def print_summary(self) -> None:
+        """ウォームアップ直後の 1 行サマリー"""
+        for report in self.reports:
+            if report.error and not report.cold:
+                print(f"⚠️  ウォームアップ ({report.api}): {report.error}")
+                continue
+            print(
+                f"🔥 ウォームアップ ({report.api}): {report.host} に {len(report.cold)} 本の接続を確立"
+                + (f"（{report.failed} 本失敗）" if report.failed else "")
+            )
+
+    def print_report(self) -> None:
+        """cold / warm の応答時間と最初の呼び出しの所要時間を出力"""
+
+        def ms(value: Optional[float]) -> str:
+            return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+        print("\nWarm-up:")
+        for report in self.reports:
+            print(f"  - {report.api}: {report.host} ({', '.join(report.addresses) or '-'})")
+            print(f"    DNS:   {ms(report.dns_seconds)}")
+            if report.cold:
+                print(
+                    f"    cold:  median={ms(statistics.median(report.cold))}, "
+                    f"max={ms(max(report.cold))} ({len(report.cold)} connections)"
+                )
+            if report.warm:
+                print(f"    warm:  median={ms(statistics.median(report.warm))}")
+            if report.first_request is not None:
+                event = report.first_request
+                print(f"    first: {ms(event.duration)} ({event.operation})")
+            if report.error:
+                print(f"    error: {report.error}")
+        if self.dns_cache is not None:
+            print(f"  DNS cache: hits={self.dns_cache.hits}, misses={self.dns_cache.misses}")
+
+
+def add_warmup_arguments(parser: argparse.ArgumentParser) -> None:
+    """ウォームアップ用の CLI 引数を追加"""
+    value = os.getenv("AIGATEWAY_WARMUP")
+    group = parser.add_argument_group("warm-up")
+    group.add_argument(
+        "--warmup",
+        type=int,
+        metavar="N",
+        default=int(value) if value else 0,
+        help="最初の呼び出しの前に N 本の接続を並列に開く（0 で無効。環境変数 AIGATEWAY_WARMUP）",
+    )
+    group.add_argument(
+        "--dns-ttl",
+        type=float,
+        default=DEFAULT_DNS_TTL,
+        help="DNS キャッシュの有効期間（秒） (default: 300)",
+    )
+
+
+def warm_up(args: argparse.Namespace, *clients) -> Optional[Warmup]:
+    """CLI 引数に応じて clients の接続をウォームアップ（無効なら None）"""
+    if args.warmup <= 0:
+        return None
+    warmup = Warmup(args.warmup, install_dns_cache(args.dns_ttl))
+    for client in clients:
+        warmup.run(client)
+    add_request_hook(warmup.observe)
+    warmup.print_summary()
+    return warmup